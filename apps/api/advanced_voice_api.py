@@ -4,17 +4,23 @@ Advanced FastAPI Voice Service
 Features: TTS, Voice Conversion, Real-time streaming, Multi-language support
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 import uvicorn
 import torch
 import torchaudio
-import io
 import os
 import json
+import logging
+import struct
+import time
+import uuid
+from collections import deque
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 try:
     import whisper  # optional, provided by the 'asr' extra
 except Exception:  # pragma: no cover - optional dependency
@@ -22,7 +28,9 @@ except Exception:  # pragma: no cover - optional dependency
 import librosa
 import numpy as np
 from pydantic import BaseModel
-from murr import MurrTTS, MurrVC
+from murr import MurrTTS, MurrVC, UnknownVoiceError, VoiceRegistry, WorkerPool
+
+logger = logging.getLogger(__name__)
 
 # Pydantic models for API
 class TTSRequest(BaseModel):
@@ -31,6 +39,8 @@ class TTSRequest(BaseModel):
     cfg_weight: float = 0.5
     voice_profile: Optional[str] = None
     language: str = "en"
+    seed: Optional[int] = None  # same seed (and inputs) -> same audio, served from the audio cache
+    voice_id: Optional[str] = None  # a voice enrolled with POST /voices/
 
 class VoiceProfile(BaseModel):
     name: str
@@ -54,17 +64,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def wav_stream_header(sample_rate: int, n_channels: int = 1, bits_per_sample: int = 16) -> bytes:
+    """RIFF/WAV header for PCM audio of unknown length (sizes set to 0xFFFFFFFF, as most players expect for streams)."""
+    byte_rate = sample_rate * n_channels * bits_per_sample // 8
+    block_align = n_channels * bits_per_sample // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, n_channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+def wav_to_pcm16(wav: torch.Tensor) -> bytes:
+    """(1, N) float waveform in [-1, 1] -> little-endian 16-bit PCM bytes."""
+    return (wav.clamp(-1, 1) * 32767).round().to(torch.int16).numpy().tobytes()
+
 # Global models and configurations
 class VoiceService:
     def __init__(self):
         self.device = self.get_device()
         self.tts_model = None
         self.vc_model = None
+        # at most MURR_WORKERS requests per model run at once (on shallow copies sharing the models). T3 decodes on
+        # the continuous-batching thread either way, so the workers mostly bound concurrent S3Gen work.
+        self.n_workers = int(os.getenv("MURR_WORKERS", "2"))
+        self.tts_pool = None
+        self.vc_pool = None
         self.whisper_model = None
+        # enrolled voices, shared by TTS and VC (MURR_VOICES_DIR, at most MURR_MAX_LOADED_VOICES in memory)
+        self.voices = VoiceRegistry(
+            os.getenv("MURR_VOICES_DIR", "voices"),
+            device=self.device,
+            max_loaded=int(os.getenv("MURR_MAX_LOADED_VOICES", "32")),
+        )
         self.voice_profiles = self.load_voice_profiles()
         self.temp_dir = Path("./temp_audio")
         self.temp_dir.mkdir(exist_ok=True)
         self.models_loaded = False
+        self.stream_ttfb_ms = deque(maxlen=100)  # time to first audio byte of recent /tts/stream/ requests
         
     def get_device(self):
         if torch.cuda.is_available():
@@ -78,9 +114,19 @@ class VoiceService:
         """Load all AI models"""
         try:
             if not self.tts_model:
-                self.tts_model = MurrTTS.from_pretrained(device=self.device)
+                # MURR_T3_QUANT=int8|int4 serves T3 with weight-only quantized linears (CPU)
+                t3_quant = os.getenv("MURR_T3_QUANT") or None
+                self.tts_model = MurrTTS.from_pretrained(device=self.device, t3_quant=t3_quant)
+                # concurrent /tts/ requests share one T3 decode batch
+                self.tts_model.enable_continuous_batching(max_batch_size=16)
+                # seeded requests are cached (MURR_AUDIO_CACHE_DIR adds a disk tier shared across workers)
+                self.tts_model.enable_audio_cache(cache_dir=os.getenv("MURR_AUDIO_CACHE_DIR") or None)
+                self.tts_model.use_voice_registry(self.voices)
+                self.tts_pool = WorkerPool(self.tts_model, n_workers=self.n_workers)
             if not self.vc_model:
                 self.vc_model = MurrVC.from_pretrained(device=self.device)
+                self.vc_model.use_voice_registry(self.voices)
+                self.vc_pool = WorkerPool(self.vc_model, n_workers=self.n_workers)
             if whisper is not None and not self.whisper_model:
                 self.whisper_model = whisper.load_model("base")
             self.models_loaded = True
@@ -125,6 +171,8 @@ async def root():
         "endpoints": {
             "tts": "/tts/",
             "voice_conversion": "/voice-conversion/",
+            "voice_conversion_stream": "/voice-conversion/stream/",
+            "voices": "/voices/",
             "transcribe": "/transcribe/",
             "voice_profiles": "/voice-profiles/",
             "health": "/health/"
@@ -142,7 +190,16 @@ async def health_check():
             "vc": voice_service.vc_model is not None,
             "whisper": voice_service.whisper_model is not None
         },
-        "all_models_ready": voice_service.models_loaded
+        "all_models_ready": voice_service.models_loaded,
+        "workers": {
+            "n_workers": voice_service.n_workers,
+            "idle_tts": voice_service.tts_pool.n_idle if voice_service.tts_pool else None,
+            "idle_vc": voice_service.vc_pool.n_idle if voice_service.vc_pool else None,
+        },
+        "stream_ttfb_ms": {
+            "last": voice_service.stream_ttfb_ms[-1] if voice_service.stream_ttfb_ms else None,
+            "p50": float(np.median(voice_service.stream_ttfb_ms)) if voice_service.stream_ttfb_ms else None,
+        },
     }
 
 @app.post("/tts/")
@@ -156,11 +213,23 @@ async def text_to_speech(request: TTSRequest):
             profile = voice_service.voice_profiles[request.voice_profile]
             exag = profile["exaggeration"]
             cfg = profile["cfg_weight"]
-        wav = voice_service.tts_model.generate(request.text, exaggeration=exag, cfg_weight=cfg)
-        temp_file = voice_service.temp_dir / f"tts_{hash(request.text)}.wav"
+        # off the event loop, on a free worker, so concurrent requests can meet in the T3 scheduler
+        wav = await run_in_threadpool(
+            voice_service.tts_pool.run, "generate", request.text, exaggeration=exag, cfg_weight=cfg, seed=request.seed,
+            voice_id=request.voice_id,
+        )
+        temp_file = voice_service.temp_dir / f"tts_{uuid.uuid4().hex}.wav"
         torchaudio.save(str(temp_file), wav, voice_service.tts_model.sr)
-        return FileResponse(str(temp_file), media_type="audio/wav", filename="generated_speech.wav")
+        return FileResponse(
+            str(temp_file), media_type="audio/wav", filename="generated_speech.wav",
+            background=BackgroundTask(temp_file.unlink, missing_ok=True),
+        )
+    except HTTPException:
+        raise
+    except UnknownVoiceError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
     except Exception as e:
+        logger.exception("/tts/ failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tts/stream/")
@@ -168,41 +237,171 @@ async def text_to_speech_stream(request: TTSRequest):
     try:
         if not voice_service.tts_model or not voice_service.models_loaded:
             raise HTTPException(status_code=503, detail="TTS model not loaded")
+        if request.voice_id is not None and request.voice_id not in voice_service.voices:
+            raise HTTPException(status_code=404, detail=f"unknown voice_id {request.voice_id!r}")
+        started = time.perf_counter()
         def generate_audio():
-            if not voice_service.tts_model:
-                raise ValueError("TTS model not available")
-            wav = voice_service.tts_model.generate(request.text, exaggeration=request.exaggeration, cfg_weight=request.cfg_weight)
-            buffer = io.BytesIO()
-            sample_rate = getattr(voice_service.tts_model, 'sr', 22050)
-            torchaudio.save(buffer, wav, int(sample_rate), format="wav")
-            buffer.seek(0)
-            while True:
-                chunk = buffer.read(8192)
-                if not chunk:
-                    break
+            # 16-bit PCM WAV of unknown length: the header goes out with the first audio, then each S3Gen chunk
+            # as soon as it is vocoded (Starlette runs this generator in a worker thread).
+            tts_model = voice_service.tts_model
+            sample_rate = int(getattr(tts_model, 'sr', 22050))
+            first = True
+            for wav in voice_service.tts_pool.stream("generate_stream", request.text, exaggeration=request.exaggeration, cfg_weight=request.cfg_weight, seed=request.seed, voice_id=request.voice_id):
+                chunk = wav_to_pcm16(wav)
+                if first:
+                    chunk = wav_stream_header(sample_rate) + chunk
+                    ttfb_ms = (time.perf_counter() - started) * 1000
+                    voice_service.stream_ttfb_ms.append(ttfb_ms)
+                    logger.debug("/tts/stream/ time to first byte: %.0f ms", ttfb_ms)
+                    first = False
                 yield chunk
+            if first:  # no audio at all: still a valid (empty) WAV
+                yield wav_stream_header(sample_rate)
         return StreamingResponse(generate_audio(), media_type="audio/wav", headers={"Content-Disposition": "attachment; filename=stream.wav"})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/voice-conversion/")
-async def voice_conversion(source_audio: UploadFile = File(...), target_audio: UploadFile = File(...)):
+async def voice_conversion(
+    source_audio: UploadFile = File(...),
+    target_audio: Optional[UploadFile] = File(None),
+    voice_id: Optional[str] = Form(None),
+):
     try:
         if not voice_service.vc_model:
             raise HTTPException(status_code=503, detail="Voice conversion model not loaded")
-        source_path = voice_service.temp_dir / f"source_{source_audio.filename}"
-        target_path = voice_service.temp_dir / f"target_{target_audio.filename}"
+        if target_audio is None and voice_id is None:
+            raise HTTPException(status_code=400, detail="Send a target_audio or a voice_id")
+        source_path = voice_service.temp_dir / f"source_{uuid.uuid4().hex}_{source_audio.filename}"
+        target_path = voice_service.temp_dir / f"target_{uuid.uuid4().hex}_{target_audio.filename}" if target_audio else None
+        try:
+            with open(source_path, "wb") as f:
+                f.write(await source_audio.read())
+            if voice_id is not None:
+                wav = await run_in_threadpool(voice_service.vc_pool.run, "generate", audio=str(source_path), voice_id=voice_id)
+            else:
+                with open(target_path, "wb") as f:
+                    f.write(await target_audio.read())
+                wav = await run_in_threadpool(
+                    voice_service.vc_pool.run, "generate", audio=str(source_path), target_voice_path=str(target_path),
+                )
+        finally:
+            source_path.unlink(missing_ok=True)
+            if target_path is not None:
+                target_path.unlink(missing_ok=True)
+        result_path = voice_service.temp_dir / f"voice_conversion_{uuid.uuid4().hex}.wav"
+        torchaudio.save(str(result_path), wav, voice_service.vc_model.sr)
+        return FileResponse(
+            str(result_path), media_type="audio/wav", filename="voice_converted.wav",
+            background=BackgroundTask(result_path.unlink, missing_ok=True),
+        )
+    except HTTPException:
+        raise
+    except UnknownVoiceError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except Exception as e:
+        logger.exception("/voice-conversion/ failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/voice-conversion/stream/")
+async def voice_conversion_stream(
+    source_audio: UploadFile = File(...),
+    voice_id: str = Form(...),
+):
+    """Convert a (long) source to an enrolled voice, streamed as 16-bit PCM WAV one source window at a time."""
+    if not voice_service.vc_model:
+        raise HTTPException(status_code=503, detail="Voice conversion model not loaded")
+    if voice_id not in voice_service.voices:
+        raise HTTPException(status_code=404, detail=f"unknown voice_id {voice_id!r}")
+    source_path = voice_service.temp_dir / f"source_{uuid.uuid4().hex}_{source_audio.filename}"
+    try:
         with open(source_path, "wb") as f:
             f.write(await source_audio.read())
-        with open(target_path, "wb") as f:
-            f.write(await target_audio.read())
-        wav = voice_service.vc_model.generate(audio=str(source_path), target_voice_path=str(target_path))
-        result_path = voice_service.temp_dir / "voice_conversion_result.wav"
-        torchaudio.save(str(result_path), wav, voice_service.vc_model.sr)
-        return FileResponse(str(result_path), media_type="audio/wav", filename="voice_converted.wav")
+    except BaseException:
+        source_path.unlink(missing_ok=True)
+        raise
+
+    def convert_audio():
+        sample_rate = voice_service.vc_model.sr
+        try:
+            yield wav_stream_header(sample_rate)
+            for wav in voice_service.vc_pool.stream("generate_stream", audio=str(source_path), voice_id=voice_id):
+                yield wav_to_pcm16(wav)
+        finally:
+            source_path.unlink(missing_ok=True)
+    # the generator's `finally` only runs once it has started; the background task covers a stream never read
+    return StreamingResponse(
+        convert_audio(), media_type="audio/wav", headers={"Content-Disposition": "attachment; filename=voice_converted.wav"},
+        background=BackgroundTask(source_path.unlink, missing_ok=True),
+    )
+
+@app.post("/voices/")
+async def enroll_voice(reference_audio: UploadFile = File(...)):
+    """Enroll a reference clip once; pass the returned voice_id to /tts/, /tts/stream/ and /voice-conversion/."""
+    try:
+        if not voice_service.tts_model:
+            raise HTTPException(status_code=503, detail="TTS model not loaded")
+        reference_path = voice_service.temp_dir / f"enroll_{uuid.uuid4().hex}_{reference_audio.filename}"
+        try:
+            with open(reference_path, "wb") as f:
+                f.write(await reference_audio.read())
+            voice_id = await run_in_threadpool(voice_service.tts_pool.run, "enroll_voice", str(reference_path))
+        finally:
+            reference_path.unlink(missing_ok=True)
+        return {"voice_id": voice_id}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/voices/batch/")
+async def enroll_voices(reference_audios: List[UploadFile] = File(...)):
+    """Enroll many reference clips in one batched pass; returns their voice_ids in upload order."""
+    try:
+        if not voice_service.tts_model:
+            raise HTTPException(status_code=503, detail="TTS model not loaded")
+        reference_paths = []
+        try:
+            for reference_audio in reference_audios:
+                reference_path = voice_service.temp_dir / f"enroll_{uuid.uuid4().hex}_{reference_audio.filename}"
+                reference_paths.append(reference_path)
+                with open(reference_path, "wb") as f:
+                    f.write(await reference_audio.read())
+            voice_ids = await run_in_threadpool(
+                voice_service.tts_pool.run, "enroll_voices", [str(path) for path in reference_paths],
+            )
+        finally:
+            for reference_path in reference_paths:
+                reference_path.unlink(missing_ok=True)
+        return {"voice_ids": voice_ids}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/voices/")
+async def list_voices():
+    return {"voices": voice_service.voices.list_voices()}
+
+@app.delete("/voices/{voice_id}")
+async def delete_voice(voice_id: str):
+    if voice_id not in voice_service.voices:
+        raise HTTPException(status_code=404, detail=f"unknown voice_id {voice_id!r}")
+    voice_service.voices.remove(voice_id)
+    voice_service.voices.save_index()
+    return {"deleted": voice_id}
+
+@app.get("/voices/{voice_id}/similar/")
+async def similar_voices(voice_id: str, k: int = 5):
+    """The k enrolled voices closest to voice_id by speaker embedding (cosine similarity), most similar first."""
+    try:
+        similar = voice_service.voices.similar_voices(voice_id, k=k)
+    except UnknownVoiceError:
+        raise HTTPException(status_code=404, detail=f"unknown voice_id {voice_id!r}")
+    return {"voice_id": voice_id, "similar": [{"voice_id": v, "similarity": score} for v, score in similar]}
+
 @app.post("/transcribe/")
 async def transcribe_audio(audio_file: UploadFile = File(...)):
     try:
@@ -211,7 +410,7 @@ async def transcribe_audio(audio_file: UploadFile = File(...)):
         audio_path = voice_service.temp_dir / f"transcribe_{audio_file.filename}"
         with open(audio_path, "wb") as f:
             f.write(await audio_file.read())
-        result = voice_service.whisper_model.transcribe(str(audio_path))
+        result = await run_in_threadpool(voice_service.whisper_model.transcribe, str(audio_path))
         return {"text": result["text"], "language": result["language"], "segments": result.get("segments", [])}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
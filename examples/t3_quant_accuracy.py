@@ -0,0 +1,88 @@
+"""
+Check a weight-only quantized T3 against the full-precision one before serving it (CPU).
+
+For each sentence, speech tokens are generated with the full-precision model, then both models score that same
+sequence (teacher forcing). The script reports how often their most likely next token agrees, the KL divergence
+between their next-token distributions, and the decode speed of each model.
+
+    python examples/t3_quant_accuracy.py --mode int8
+    python examples/t3_quant_accuracy.py --mode int4 --ckpt-dir weights
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from murr import MurrTTS
+
+
+SENTENCES = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog.",
+    "Please call Stella and ask her to bring these things with her from the store.",
+]
+
+
+def speech_logits(t3, t3_cond, text_tokens, speech_tokens):
+    "Teacher-forced next-token logits over the speech tokens that can be emitted: (T, n_speech_logits)."
+    embeds, len_cond = t3.prepare_input_embeds(t3_cond=t3_cond, text_tokens=text_tokens, speech_tokens=speech_tokens)
+    hidden = t3.tfmr(inputs_embeds=embeds).last_hidden_state
+    hidden = hidden[:, len_cond + text_tokens.size(1):]
+    return t3.speech_head(hidden)[0, :, :t3.n_speech_logits].float()
+
+
+def tokens_per_second(t3, t3_cond, text_tokens, max_new_tokens):
+    start = time.perf_counter()
+    tokens = t3.inference(t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=max_new_tokens, cfg_weight=0.5)
+    return tokens.size(-1) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["int8", "int4"], default="int8")
+    parser.add_argument("--group-size", type=int, default=128, help="int4 only: input channels per scale / zero")
+    parser.add_argument("--ckpt-dir", default=None, help="local weights (default: MurrTTS.from_pretrained)")
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.ckpt_dir is not None:
+        model = MurrTTS.from_local(args.ckpt_dir, "cpu")
+    else:
+        model = MurrTTS.from_pretrained("cpu")
+    t3 = model.t3
+    t3_q = copy.deepcopy(t3).quantize(args.mode, group_size=args.group_size)
+    t3_cond = model.conds.t3
+
+    agree, n_tokens, kl_sum = 0, 0, 0.0
+    speed, speed_q = [], []
+    with torch.inference_mode():
+        for text in SENTENCES:
+            text_tokens = model._tokenize_text(text)
+            torch.manual_seed(args.seed)
+            speech_tokens = t3.inference(
+                t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=args.max_new_tokens, cfg_weight=0.5,
+            )
+            bos = torch.full((1, 1), t3.hp.start_speech_token, dtype=torch.long)
+            speech_tokens = torch.cat([bos, speech_tokens], dim=1)
+
+            ref = speech_logits(t3, t3_cond, text_tokens, speech_tokens)
+            quant = speech_logits(t3_q, t3_cond, text_tokens, speech_tokens)
+            agree += int((ref.argmax(-1) == quant.argmax(-1)).sum())
+            n_tokens += ref.size(0)
+            kl = torch.nn.functional.kl_div(quant.log_softmax(-1), ref.log_softmax(-1), log_target=True, reduction="sum")
+            kl_sum += float(kl)
+
+            torch.manual_seed(args.seed)
+            speed.append(tokens_per_second(t3, t3_cond, text_tokens, args.max_new_tokens))
+            torch.manual_seed(args.seed)
+            speed_q.append(tokens_per_second(t3_q, t3_cond, text_tokens, args.max_new_tokens))
+
+    print(f"{args.mode}: top-1 agreement {agree / n_tokens:.2%} over {n_tokens} positions, "
+          f"mean KL(fp || {args.mode}) {kl_sum / n_tokens:.2e} nats")
+    print(f"decode (CFG): fp32 {sum(speed) / len(speed):.2f} tok/s, {args.mode} {sum(speed_q) / len(speed_q):.2f} tok/s")
+
+
+if __name__ == "__main__":
+    main()
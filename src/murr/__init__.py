@@ -9,3 +9,8 @@ __version__ = version("murrlab-voice")
 # Export public API
 from .tts import MurrTTS
 from .vc import MurrVC
+from .voice_registry import UnknownVoiceError, VoiceRegistry
+from .voice_index import VoiceIndex
+from .worker_pool import WorkerPool
+
+__all__ = ["MurrTTS", "MurrVC", "VoiceRegistry", "UnknownVoiceError", "VoiceIndex", "WorkerPool", "__version__"]
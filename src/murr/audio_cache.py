@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+import numpy as np
+import torch
+
+
+class AudioCache:
+    """
+    Content-addressed cache of synthesized waveforms, for seeded (deterministic) generations.
+
+    Two tiers:
+        * memory: an LRU of (1, N) float tensors, bounded by `max_bytes`,
+        * disk (optional, `cache_dir`): one `.npy` file per entry, shared across processes and restarts. Disk
+          entries are never pruned here; clean the directory from outside if it must stay bounded.
+
+    Keys come from `make_key`, a hash of everything the audio depends on (normalized text, voice, sampling
+    parameters, seed). `get_or_compute` also coalesces concurrent misses on the same key: the first caller
+    generates, the others wait for its result instead of generating it again.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20, cache_dir: Union[str, Path, None] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._memory: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._n_bytes = 0
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        "Stable hex digest of JSON-serializable `fields`."
+        payload = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        "The cached waveform for `key` (memory first, then disk), or `None`."
+        with self._lock:
+            wav = self._memory.get(key)
+            if wav is not None:
+                self._memory.move_to_end(key)
+                return wav.clone()
+        wav = self._load(key)
+        if wav is not None:
+            with self._lock:
+                self._remember(key, wav)
+            return wav.clone()
+        return None
+
+    def put(self, key: str, wav: torch.Tensor):
+        wav = wav.detach().cpu().float().clone()
+        self._store(key, wav)
+        with self._lock:
+            self._remember(key, wav)
+
+    def get_or_compute(self, key: str, compute: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """
+        The cached waveform for `key`, or `compute()`'s result, which is then cached. While one caller computes a
+        key, other callers asking for the same key wait for that result.
+        """
+        wav = self.get(key)
+        if wav is not None:
+            return wav
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result().clone()
+
+        try:
+            wav = self.get(key)  # it may have landed between the first lookup and taking ownership
+            if wav is None:
+                wav = compute()
+                self.put(key, wav)
+            future.set_result(wav)
+            return wav
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def clear(self):
+        "Drop the memory tier (the disk tier is left alone)."
+        with self._lock:
+            self._memory.clear()
+            self._n_bytes = 0
+
+    def _remember(self, key: str, wav: torch.Tensor):
+        # (call with the lock held)
+        n_bytes = wav.numel() * wav.element_size()
+        if n_bytes > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._n_bytes -= old.numel() * old.element_size()
+        self._memory[key] = wav
+        self._n_bytes += n_bytes
+        while self._n_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._n_bytes -= evicted.numel() * evicted.element_size()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
+
+    def _load(self, key: str) -> Optional[torch.Tensor]:
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            return torch.from_numpy(np.load(path, allow_pickle=False))
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def _store(self, key: str, wav: torch.Tensor):
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # write then rename, so concurrent readers never see a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, wav.numpy(), allow_pickle=False)
+        os.replace(tmp_path, path)
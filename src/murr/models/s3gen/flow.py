@@ -242,7 +242,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
+                  finalize,
+                  token_offset=0):
+        # `token_offset`: speech tokens of the utterance before `token`, when decoding a streaming window
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
@@ -275,7 +277,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=10,
+            prompt_len=mel_len1,
+            noise_offset=token_offset * self.token_mel_ratio,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
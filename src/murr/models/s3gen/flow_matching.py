@@ -191,7 +191,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, noise_offset=0):
         """Forward diffusion
 
         Args:
@@ -204,13 +204,19 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            prompt_len (int, optional): number of prompt frames at the start of `mu`.
+            noise_offset (int, optional): frames of the utterance before the ones that follow the prompt (a
+                streaming window), so every frame gets the same fixed noise as in offline decoding.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        z = self.rand_noise
+        if noise_offset > 0:
+            z = torch.cat([z[:, :, :prompt_len], z[:, :, prompt_len + noise_offset:]], dim=2)
+        z = z[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
@@ -26,7 +26,6 @@ from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
 from torch.nn.utils import remove_weight_norm
 from torch.nn.utils.parametrizations import weight_norm
-from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
@@ -198,9 +197,10 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, generator: torch.Generator = None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param generator: RNG for the initial phases and the noise (defaults to the global one)
         :return: [B, 1, sample_len]
         """
 
@@ -209,8 +209,8 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        # uniform in [-pi, pi), as `Uniform(-np.pi, np.pi).sample` but with an optional generator
+        phase_vec = -np.pi + 2 * np.pi * torch.rand(f0.size(0), self.harmonic_num + 1, 1, generator=generator, device=F_mat.device)
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -223,7 +223,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * torch.randn(sine_waves.shape, generator=generator, device=sine_waves.device, dtype=sine_waves.dtype)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -264,7 +264,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, generator: torch.Generator = None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -273,13 +273,13 @@ class SourceModuleHnNSF(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), generator)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
-        noise = torch.randn_like(uv) * self.sine_amp / 3
+        noise = torch.randn(uv.shape, generator=generator, device=uv.device, dtype=uv.dtype) * self.sine_amp / 3
         return sine_merge, noise, uv
 
 
@@ -460,12 +460,12 @@ class HiFTGenerator(nn.Module):
         return generated_speech, f0
 
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0), generator: torch.Generator = None) -> torch.Tensor:
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(s, generator)
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
@@ -18,7 +18,7 @@ import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
@@ -38,6 +38,17 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
+def fade_in_out(fade_in_wav: torch.Tensor, fade_out_wav: torch.Tensor, window: torch.Tensor):
+    """
+    Crossfade the tail of `fade_out_wav` into the head of `fade_in_wav`: the first half of `window` fades in, the
+    second half fades out (CosyVoice's `fade_in_out`).
+    """
+    overlap = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = fade_in_wav[..., :overlap] * window[:overlap] + fade_out_wav[..., -overlap:] * window[overlap:]
+    return fade_in_wav
+
+
 # TODO: global resampler cache
 @lru_cache(100)
 def get_resampler(src_sr, dst_sr, device):
@@ -110,7 +121,12 @@ class S3Token2Mel(torch.nn.Module):
         ref_sr: int,
         device="auto",
         ref_fade_out=True,
+        ref_wav_16: Optional[torch.Tensor] = None,
     ):
+        """
+        S3Gen's reference conditionals (`ref_dict`) from a reference waveform at `ref_sr`. Pass the same clip
+        already at 16 kHz as `ref_wav_16` to skip resampling it for the tokenizer and CAMPPlus.
+        """
         device = self.device if device == "auto" else device
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
@@ -128,33 +144,73 @@ class S3Token2Mel(torch.nn.Module):
         if ref_sr != S3GEN_SR:
             ref_wav_24 = get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
 
-        ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(device)
-        ref_mels_24_len = None
-
         # Resample to 16kHz
-        ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
-
-        # Speaker embedding
-        ref_x_vector = self.speaker_encoder.inference(ref_wav_16)
-
-        # Tokenize 16khz reference
-        ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wav_16)
-
-        # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
-        if ref_mels_24.shape[1] != 2 * ref_speech_tokens.shape[1]:
-            logging.warning(
-                "Reference mel length is not equal to 2 * reference token length.\n"
-            )
-            ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
-            ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
-
-        return dict(
-            prompt_token=ref_speech_tokens.to(device),
-            prompt_token_len=ref_speech_token_lens,
-            prompt_feat=ref_mels_24,
-            prompt_feat_len=ref_mels_24_len,
-            embedding=ref_x_vector,
-        )
+        if ref_wav_16 is None:
+            ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav)
+        ref_wav_16 = torch.atleast_2d(ref_wav_16).to(device)
+
+        return self.embed_refs([ref_wav_24], [ref_wav_16], device=device)[0]
+
+    def embed_refs(self, ref_wavs_24: List[torch.Tensor], ref_wavs_16: List[torch.Tensor], device="auto", batch_size=16):
+        """
+        Batched `embed_ref` for clips given at both 24 kHz and 16 kHz: one `ref_dict` per clip.
+
+        The S3 tokenizer takes the clips padded (it masks by length). The mel extractor and CAMPPlus do not, so
+        they batch clips of equal length only, which is exact, and is every clip once references are cut to 10 s.
+        """
+        device = self.device if device == "auto" else device
+        ref_wavs_24 = [torch.atleast_2d(wav).to(device) for wav in ref_wavs_24]
+        ref_wavs_16 = [torch.atleast_2d(wav).to(device) for wav in ref_wavs_16]
+        n_refs = len(ref_wavs_24)
+
+        ref_mels_24, ref_x_vectors = [None] * n_refs, [None] * n_refs
+        same_length = {}
+        for i, (wav_24, wav_16) in enumerate(zip(ref_wavs_24, ref_wavs_16)):
+            same_length.setdefault((wav_24.size(1), wav_16.size(1)), []).append(i)
+        for indices in same_length.values():
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                mels = self.mel_extractor(torch.cat([ref_wavs_24[i] for i in batch])).transpose(1, 2).to(device)
+                # Speaker embedding
+                x_vectors = self.speaker_encoder.inference(torch.cat([ref_wavs_16[i] for i in batch]))
+                for j, i in enumerate(batch):
+                    ref_mels_24[i], ref_x_vectors[i] = mels[j:j + 1], x_vectors[j:j + 1]
+
+        # Tokenize 16khz references
+        speech_tokens, speech_token_lens = self.tokenizer(ref_wavs_16)
+
+        ref_dicts = []
+        for i in range(n_refs):
+            ref_speech_tokens = speech_tokens[i:i + 1, :int(speech_token_lens[i])]
+            # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
+            if ref_mels_24[i].shape[1] != 2 * ref_speech_tokens.shape[1]:
+                logging.warning(
+                    "Reference mel length is not equal to 2 * reference token length.\n"
+                )
+                ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24[i].shape[1] // 2]
+            ref_dicts.append(dict(
+                prompt_token=ref_speech_tokens.to(device),
+                prompt_token_len=torch.tensor([ref_speech_tokens.shape[1]]),
+                prompt_feat=ref_mels_24[i],
+                prompt_feat_len=None,
+                embedding=ref_x_vectors[i],
+            ))
+        return ref_dicts
+
+    def _resolve_ref(self, ref_wav, ref_sr, ref_dict):
+        "The reference embedding from exactly one of a reference waveform or a precomputed `ref_dict`."
+        assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
+
+        if ref_dict is None:
+            ref_dict = self.embed_ref(ref_wav, ref_sr)
+        else:
+            # type/device casting (all values will be numpy if it's from a prod API call)
+            for rk in list(ref_dict):
+                if isinstance(ref_dict[rk], np.ndarray):
+                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+                if torch.is_tensor(ref_dict[rk]):
+                    ref_dict[rk] = ref_dict[rk].to(self.device)
+        return ref_dict
 
     def forward(
         self,
@@ -165,6 +221,7 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        token_offset: int = 0,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -181,18 +238,9 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `token_offset`: speech tokens of the utterance before `speech_tokens`, when they are a streaming window.
         """
-        assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
-
-        if ref_dict is None:
-            ref_dict = self.embed_ref(ref_wav, ref_sr)
-        else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(self.device)
+        ref_dict = self._resolve_ref(ref_wav, ref_sr, ref_dict)
 
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
@@ -204,6 +252,7 @@ class S3Token2Mel(torch.nn.Module):
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            token_offset=token_offset,
             **ref_dict,
         )
         return output_mels
@@ -268,14 +317,17 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        token_offset: int = 0,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize, token_offset=token_offset,
+        )
 
     @torch.inference_mode()
-    def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
+    def hift_inference(self, speech_feat, cache_source: torch.Tensor = None, generator: torch.Generator = None):
         if cache_source is None:
             cache_source = torch.zeros(1, 1, 0).to(self.device)
-        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
+        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source, generator=generator)
 
     @torch.inference_mode()
     def inference(
@@ -288,11 +340,141 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        generator: torch.Generator = None,
     ):
+        """
+        `generator` seeds HiFT's source excitation (harmonic phases and noise), the only random part of
+        decoding: the flow's noise is fixed. Pass a seeded one for reproducible waveforms.
+        """
         output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
-        output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+        output_wavs, output_sources = self.hift_inference(output_mels, cache_source, generator=generator)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    def stream_session(
+        self,
+        # locally-computed ref embedding (mutex with ref_dict)
+        ref_wav: Optional[torch.Tensor] = None,
+        ref_sr: Optional[int] = None,
+        # pre-computed ref embedding (prod API)
+        ref_dict: Optional[dict] = None,
+        mel_cache_len: int = 8,
+        generator: Optional[torch.Generator] = None,
+        context_tokens: Optional[int] = 50,
+    ) -> "S3GenStreamSession":
+        """
+        Start decoding one utterance incrementally: feed speech tokens to the session as they are generated and
+        get waveform chunks back (see `S3GenStreamSession`).
+
+        Each push runs the flow on the reference prompt, `context_tokens` already decoded tokens and the new ones,
+        so its cost does not grow with the utterance. `context_tokens=None` re-runs the whole utterance every
+        push instead, which matches offline decoding more closely but costs O(n^2) over an utterance.
+        """
+        ref_dict = self._resolve_ref(ref_wav, ref_sr, ref_dict)
+        return S3GenStreamSession(
+            self, ref_dict, mel_cache_len=mel_cache_len, generator=generator, context_tokens=context_tokens,
+        )
+
+
+class S3GenStreamSession:
+    """
+    Stateful, chunked token-to-waveform decoding of a single utterance, following CosyVoice2's streaming
+    `token2wav`.
+
+    Every `push` runs the flow on the new tokens, after up to `context_tokens` tokens that were already decoded
+    (with `finalize=False`, so the last `pre_lookahead_len` tokens only serve as lookahead), and keeps only the
+    mel frames that were not produced before. The flow matching noise is fixed per frame of the utterance
+    (`token_offset`), so these frames match offline decoding up to the limited left context and the extra right
+    context. Bounding the left context keeps every push the same cost, where re-running the whole utterance
+    (`context_tokens=None`, as CosyVoice2) makes streaming O(n^2) in its length. For the vocoder, the last `mel_cache_len` frames of each chunk are held back: the next
+    chunk re-renders them, reusing their source excitation (`cache_source`) so the harmonic phase carries over,
+    and the re-rendered audio is crossfaded with the held-back audio (Hann window, so the two fades sum to one).
+
+    The emitted chunks add up to exactly as many samples as offline decoding of the same tokens, and the
+    reference "spillover" fade (`trim_fade`) is applied to the start of the utterance as offline.
+    """
+
+    def __init__(
+        self,
+        s3gen: S3Token2Wav,
+        ref_dict: dict,
+        mel_cache_len: int = 8,
+        generator: Optional[torch.Generator] = None,
+        context_tokens: Optional[int] = 50,
+    ):
+        self.s3gen = s3gen
+        self.ref_dict = ref_dict
+        self.generator = generator
+        self.mel_cache_len = mel_cache_len
+        self.context_tokens = context_tokens
+        self.samples_per_frame = int(s3gen.mel2wav.f0_upsamp.scale_factor)
+        self.source_cache_len = mel_cache_len * self.samples_per_frame
+        # (CosyVoice uses a Hamming window, whose two halves sum to ~1.08 and leave a bump at every boundary)
+        self.window = torch.hann_window(2 * self.source_cache_len, periodic=True, device=s3gen.device)
+
+        self.tokens = torch.zeros(1, 0, dtype=torch.long, device=s3gen.device)
+        self.tokens_start = 0  # tokens of the utterance dropped from the front of `tokens`
+        self.token_offset = 0  # tokens whose mel frames were already vocoded
+        self.n_emitted = 0  # waveform samples returned so far
+        self.mel_cache = None  # the held-back mel frames, their source excitation and audio
+        self.source_cache = None
+        self.speech_cache = None
+        self.finished = False
+
+    @torch.inference_mode()
+    def push(self, speech_tokens: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        Add speech tokens (1D or (1, T); stop / start tokens are dropped) and decode what they make final.
+        Pass `finalize=True` with the last tokens (possibly none) to flush the rest of the utterance.
+
+        Returns a (1, N) waveform chunk, possibly empty while not enough new tokens have arrived.
+        """
+        assert not self.finished, "the stream was already finalized"
+        s3gen, flow = self.s3gen, self.s3gen.flow
+        speech_tokens = speech_tokens.to(self.tokens.device).view(1, -1)
+        self.tokens = torch.cat([self.tokens, speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE][None]], dim=1)
+
+        # Only vocode once the flow has enough new frames to cover the held-back ones.
+        n_tokens = self.tokens_start + self.tokens.size(1)
+        n_ready = n_tokens if finalize else n_tokens - flow.pre_lookahead_len
+        n_new_frames = (n_ready - self.token_offset) * flow.token_mel_ratio
+        if not finalize and n_new_frames < self.mel_cache_len:
+            return self.tokens.new_zeros(1, 0, dtype=torch.float)
+        self.finished = finalize
+        if n_tokens == 0:
+            return self.tokens.new_zeros(1, 0, dtype=torch.float)
+
+        # the new tokens and their left context; older tokens are no longer needed
+        if self.context_tokens is not None:
+            start = max(self.tokens_start, self.token_offset - self.context_tokens)
+            self.tokens = self.tokens[:, start - self.tokens_start:]
+            self.tokens_start = start
+        mels = s3gen.flow_inference(
+            self.tokens, ref_dict=self.ref_dict, finalize=finalize, token_offset=self.tokens_start,
+        )
+        mels = mels[:, :, (self.token_offset - self.tokens_start) * flow.token_mel_ratio:]
+        self.token_offset = n_ready
+
+        cache_source = torch.zeros(1, 1, 0, device=mels.device)
+        if self.mel_cache is not None:
+            mels = torch.cat([self.mel_cache, mels], dim=2)
+            cache_source = self.source_cache
+        wav, source = s3gen.hift_inference(mels, cache_source, generator=self.generator)
+        if self.speech_cache is not None:
+            wav = fade_in_out(wav, self.speech_cache, self.window)
+
+        if not finalize:
+            self.mel_cache = mels[:, :, -self.mel_cache_len:]
+            self.source_cache = source[:, :, -self.source_cache_len:]
+            self.speech_cache = wav[:, -self.source_cache_len:]
+            wav = wav[:, :-self.source_cache_len]
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip (as in `S3Token2Wav.inference`).
+        n_fade = len(s3gen.trim_fade) - self.n_emitted
+        if n_fade > 0:
+            wav[:, :n_fade] *= s3gen.trim_fade[self.n_emitted:self.n_emitted + wav.size(1)]
+        self.n_emitted += wav.size(1)
+        return wav
@@ -4,7 +4,6 @@ import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
@@ -22,7 +21,7 @@ SPEECH_VOCAB_SIZE = 6561
 class S3Tokenizer(S3TokenizerV2):
     """
     s3tokenizer.S3TokenizerV2 with the following changes:
-    - a more integrated `forward`
+    - a more integrated `forward`, with the log-mel of all wavs computed as one padded batch
     - compute `log_mel_spectrogram` using `_mel_filters` and `window` in `register_buffers`
     """
 
@@ -96,7 +95,7 @@ class S3Tokenizer(S3TokenizerV2):
     ) -> Tuple[torch.Tensor, torch.LongTensor]:
         """
         NOTE: mel-spec has a hop size of 160 points (100 frame/sec).
-        FIXME: this class inherits `nn.Module` but doesn't accept `torch.Tensor` and handles a list of wavs one by one, which is unexpected.
+        NOTE: `wavs` is a list of wavs of any lengths (or a [B, T] tensor of equal-length ones), computed as one padded batch.
 
         Args
         ----
@@ -105,15 +104,11 @@ class S3Tokenizer(S3TokenizerV2):
         NOTE: please pad the waveform if longer sequence is needed.
         """
         processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        mels, mel_lens = self.log_mel_spectrogram_batch(processed_wavs)
+        if max_len is not None:
+            mel_lens = mel_lens.clamp(max=max_len * 4)  # num_mel_frames = 4 * num_tokens
+            mels = mels[..., :int(mel_lens.max())]
+
         if accelerator is None:
             tokenizer = self
         else:
@@ -125,6 +120,43 @@ class S3Tokenizer(S3TokenizerV2):
             speech_token_lens.long().detach(),
         )
 
+    def log_mel_spectrogram_batch(self, wavs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        `log_mel_spectrogram` of several wavs in one padded STFT and mel projection: a [B, F, T] batch, zero past
+        each item's frames, and the [B] frame counts (as `s3tokenizer.utils.padding` returns them).
+
+        Each wav is reflect-padded at its own ends before batching, as `torch.stft(center=True)` pads a single
+        wav, and the `max - 8.0` floor is taken over each item's own frames, so every item is identical to
+        `log_mel_spectrogram` on that wav alone. The wavs move to the device once, as one batch.
+        """
+        half = self.n_fft // 2
+        wavs = [wav.reshape(-1) for wav in wavs]
+        wav_lens = [wav.numel() for wav in wavs]
+        audio = wavs[0].new_zeros(len(wavs), max(wav_lens) + 2 * half, dtype=torch.float)
+        for row, wav, n in zip(audio, wavs, wav_lens):
+            row[half:half + n] = wav
+            row[:half] = wav[1:half + 1].flip(0)  # reflect padding
+            row[half + n:n + 2 * half] = wav[-half - 1:-1].flip(0)
+        audio = audio.to(self.device)
+
+        mel_lens = torch.tensor(wav_lens, dtype=torch.int32) // S3_HOP  # the last STFT frame is dropped
+        stft = torch.stft(
+            audio, self.n_fft, S3_HOP,
+            window=self.window.to(self.device),
+            center=False,
+            return_complex=True
+        )
+        magnitudes = stft.abs()[..., :int(mel_lens.max())]**2  # (abs of the contiguous STFT is faster)
+
+        mel_spec = self._mel_filters.to(self.device) @ magnitudes
+
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        valid = (torch.arange(log_spec.size(-1)) < mel_lens[:, None]).to(self.device)[:, None]  # [B, 1, T]
+        log_max = log_spec.masked_fill(~valid, -float("inf")).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec.masked_fill(~valid, 0), mel_lens
+
     def log_mel_spectrogram(
         self,
         audio: torch.Tensor,
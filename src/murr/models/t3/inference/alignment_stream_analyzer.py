@@ -2,13 +2,32 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+import threading
+import weakref
 import torch
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from types import MethodType
+from typing import Optional
 
 
 logger = logging.getLogger(__name__)
 
+# The analyzer whose decode is running a forward right now, in this thread / context (see `capturing`). The
+# attention layers are shared by every concurrent decode, so what they capture is decided per forward call.
+_capturing: ContextVar[Optional["AlignmentStreamAnalyzer"]] = ContextVar("alignment_capturing", default=None)
+_hooked_layers = weakref.WeakSet()
+_hooked_layers_lock = threading.Lock()
+
+
+def _causal_mask(hidden_states, past_key_value, layer_idx):
+    "Additive (1, 1, T, past + T) causal mask for a `T`-token chunk following `past` cached tokens."
+    T = hidden_states.size(1)
+    past = 0 if past_key_value is None else past_key_value.get_seq_length(layer_idx)
+    allowed = torch.ones(T, past + T, dtype=torch.bool, device=hidden_states.device).tril(past)
+    mask = torch.zeros(T, past + T, dtype=hidden_states.dtype, device=hidden_states.device)
+    return mask.masked_fill(~allowed, torch.finfo(hidden_states.dtype).min)[None, None]
+
 
 @dataclass
 class AlignmentAnalysisResult:
@@ -54,37 +73,21 @@ class AlignmentStreamAnalyzer:
         # using it for all layers slows things down too much. We can apply it to just one layer
         # by intercepting the kwargs and adding a forward hook (credit: jrm)
         self.last_aligned_attn = None
-        self._add_attention_spy(tfmr, alignment_layer_idx)
+        self.target_layer = tfmr.layers[alignment_layer_idx].self_attn
+        _add_attention_spy(self.target_layer)
 
-    def _add_attention_spy(self, tfmr, alignment_layer_idx):
+    @contextmanager
+    def capturing(self):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
-        Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        using it for all layers slows things down too much.
-        (credit: jrm)
+        Capture the target layer's attention map for the forwards run inside this block, and only for them:
+        forwards of other decodes sharing the layer (other threads, or between two `next` calls of a stream)
+        keep the fused SDPA kernel. Don't `yield` inside the block.
         """
-
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
-
-        target_layer = tfmr.layers[alignment_layer_idx].self_attn
-        hook_handle = target_layer.register_forward_hook(attention_forward_hook)
-
-        # Backup original forward
-        original_forward = target_layer.forward
-        def patched_forward(self, *args, **kwargs):
-            kwargs['output_attentions'] = True
-            return original_forward(*args, **kwargs)
-
-        # TODO: how to unpatch it?
-        target_layer.forward = MethodType(patched_forward, target_layer)
+        token = _capturing.set(self)
+        try:
+            yield
+        finally:
+            _capturing.reset(token)
 
     def step(self, logits):
         """
@@ -152,3 +155,49 @@ class AlignmentStreamAnalyzer:
 
         self.curr_frame_pos += 1
         return logits
+
+
+def _add_attention_spy(target_layer):
+    """
+    Adds a forward pre-hook and hook to a specific attention layer, once per layer, which switch that layer to
+    `output_attentions=True` and collect its attention map while an analyzer of that layer is `capturing`, and do
+    nothing otherwise. The layer's `forward` itself is never replaced.
+    Using `output_attentions=True` is incompatible with optimized attention kernels, so
+    using it for all layers slows things down too much.
+    (credit: jrm)
+    """
+
+    def active(module) -> Optional[AlignmentStreamAnalyzer]:
+        analyzer = _capturing.get()
+        return analyzer if analyzer is not None and analyzer.target_layer is module else None
+
+    def attention_forward_pre_hook(module, args, kwargs):
+        if active(module) is None:
+            return None
+        kwargs = dict(kwargs, output_attentions=True)
+        hidden_states = kwargs['hidden_states'] if 'hidden_states' in kwargs else args[0]
+        if kwargs.get('attention_mask') is None and hidden_states.size(1) > 1:
+            # SDPA models drop the causal mask when `is_causal` can stand in for it, but the eager path we
+            # force on this layer needs it spelled out.
+            kwargs['attention_mask'] = _causal_mask(hidden_states, kwargs.get('past_key_value'), module.layer_idx)
+        return args, kwargs
+
+    def attention_forward_hook(module, input, output):
+        """
+        See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+        NOTE:
+        - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
+        - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+        """
+        analyzer = active(module)
+        if analyzer is None:
+            return
+        step_attention = output[1].cpu() # (B, 16, N, N)
+        analyzer.last_aligned_attn = step_attention[0].mean(0) # (N, N)
+
+    with _hooked_layers_lock:
+        if target_layer in _hooked_layers:
+            return
+        target_layer.register_forward_pre_hook(attention_forward_pre_hook, with_kwargs=True)
+        target_layer.register_forward_hook(attention_forward_hook)
+        _hooked_layers.add(target_layer)
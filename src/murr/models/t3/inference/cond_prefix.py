@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from transformers import DynamicCache
+
+
+@dataclass
+class CondPrefixKV:
+    """
+    Per-layer KV of the conditioning prefix (speaker projection, resampled speech prompt, emotion_adv), as
+    computed by `T3.prefill_conditioning`.
+
+    The prefix comes first and attention is causal, so its KV does not depend on the text. It can be computed once
+    per voice (and exaggeration) and reused, so prefill only runs the text and start-of-speech tokens.
+    """
+    key_cache: List[Tensor]  # per layer, (B, heads, len_cond, head_dim)
+    value_cache: List[Tensor]
+
+    @property
+    def length(self) -> int:
+        return self.key_cache[0].size(2)
+
+    def fill(self, cache, batch_size: int):
+        """
+        Write the prefix into the first slots of an empty `DynamicCache` or `StaticCache`, repeated up to
+        `batch_size` rows. The stored tensors are never written to: a dynamic cache concatenates later entries
+        into new tensors, and a static cache copies the prefix into its own buffers.
+        """
+        cache_position = torch.arange(self.length, device=self.key_cache[0].device)
+        for layer, (keys, values) in enumerate(zip(self.key_cache, self.value_cache)):
+            keys, values = _repeat_rows(keys, batch_size), _repeat_rows(values, batch_size)
+            cache.update(keys, values, layer, {"cache_position": cache_position})
+        return cache
+
+    def shared_cache(self, batch_size: int) -> "SharedPrefixCache":
+        "A `DynamicCache` for `batch_size` rows that all start with this prefix, stored once (see `SharedPrefixCache`)."
+        return SharedPrefixCache(self, batch_size)
+
+    def to(self, device):
+        return CondPrefixKV(
+            key_cache=[k.to(device) for k in self.key_cache],
+            value_cache=[v.to(device) for v in self.value_cache],
+        )
+
+
+class SharedPrefixCache(DynamicCache):
+    """
+    A `DynamicCache` whose rows all start with the same `CondPrefixKV`, e.g. CFG's conditional and unconditional
+    twins, which only differ from the text onwards. The prefix itself is stored once per voice (and exaggeration)
+    and shared by every decode; each cache copies it into its rows once, on the first update.
+
+    Each layer's keys and values live in a buffer that grows geometrically, so a decode step writes its new entry
+    in place and `key_cache` / `value_cache` are views of the filled part (prefix included). A plain
+    `DynamicCache` concatenates the whole history into a new tensor every step instead.
+    """
+
+    def __init__(self, prefix: CondPrefixKV, batch_size: int):
+        super().__init__()
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self._seen_tokens = prefix.length
+        self._key_buffers: List[Tensor] = []
+        self._value_buffers: List[Tensor] = []
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.size(-2)
+        if len(self.key_cache) <= layer_idx:
+            self._key_buffers.append(_repeat_rows(self.prefix.key_cache[layer_idx], self.batch_size).clone())
+            self._value_buffers.append(_repeat_rows(self.prefix.value_cache[layer_idx], self.batch_size).clone())
+            self.key_cache.append(self._key_buffers[layer_idx])
+            self.value_cache.append(self._value_buffers[layer_idx])
+
+        length = self.key_cache[layer_idx].size(-2)
+        self._key_buffers[layer_idx] = _write_at(self._key_buffers[layer_idx], length, key_states)
+        self._value_buffers[layer_idx] = _write_at(self._value_buffers[layer_idx], length, value_states)
+        length += key_states.size(-2)
+        self.key_cache[layer_idx] = self._key_buffers[layer_idx][..., :length, :]
+        self.value_cache[layer_idx] = self._value_buffers[layer_idx][..., :length, :]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        if len(self.key_cache) <= layer_idx:
+            return self.prefix.length
+        return self.key_cache[layer_idx].size(-2)
+
+    def crop(self, max_length: int):
+        "Keep the first `max_length` positions, counting the prefix (which is never cropped)."
+        assert max_length >= self.prefix.length, "cannot crop into the shared prefix"
+        if self.get_seq_length() <= max_length:
+            return
+        self._seen_tokens = max_length
+        for layer_idx in range(len(self.key_cache)):
+            # (the buffers keep their capacity: later updates overwrite the dropped positions)
+            self.key_cache[layer_idx] = self.key_cache[layer_idx][..., :max_length, :]
+            self.value_cache[layer_idx] = self.value_cache[layer_idx][..., :max_length, :]
+
+    def batch_select_indices(self, indices: Tensor):
+        for layer_idx in range(len(self.key_cache)):
+            length = self.key_cache[layer_idx].size(-2)
+            self._key_buffers[layer_idx] = self._key_buffers[layer_idx][indices]
+            self._value_buffers[layer_idx] = self._value_buffers[layer_idx][indices]
+            self.key_cache[layer_idx] = self._key_buffers[layer_idx][..., :length, :]
+            self.value_cache[layer_idx] = self._value_buffers[layer_idx][..., :length, :]
+        self.batch_size = len(indices)
+
+
+def _write_at(buffer: Tensor, length: int, states: Tensor) -> Tensor:
+    "Write `states` after the first `length` positions of `buffer`, first doubling its capacity if it is full."
+    needed = length + states.size(-2)
+    if needed > buffer.size(-2):
+        grown = buffer.new_empty(*buffer.shape[:-2], max(needed, 2 * buffer.size(-2)), buffer.size(-1))
+        grown[..., :length, :] = buffer[..., :length, :]
+        buffer = grown
+    buffer[..., length:needed, :] = states
+    return buffer
+
+
+def _repeat_rows(kv: Tensor, batch_size: int) -> Tensor:
+    if kv.size(0) == batch_size:
+        return kv
+    if kv.size(0) == 1:
+        return kv.expand(batch_size, -1, -1, -1)
+    assert batch_size % kv.size(0) == 0, "prefix rows must tile the batch (e.g. CFG twins)"
+    return kv.repeat(batch_size // kv.size(0), 1, 1, 1)
@@ -0,0 +1,146 @@
+from typing import List, Sequence, Union
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+RowParam = Union[float, Sequence[float], Tensor]
+
+
+def _per_row(value: RowParam, n_rows: int, device) -> Tensor:
+    "A scalar or per-row sampling parameter as a (R, 1) float tensor."
+    return torch.as_tensor(value, dtype=torch.float32, device=device).expand(n_rows).reshape(n_rows, 1)
+
+
+class SpeechTokenSampler:
+    """
+    Temperature, repetition penalty, min-p and top-p sampling for a batch of rows, each row with its own
+    parameters.
+
+    Produces the same distribution as chaining HF's `RepetitionPenaltyLogitsProcessor`, `MinPLogitsWarper` and
+    `TopPLogitsWarper`, without their per-step overhead:
+        * logits are edited in place, and top-p only sorts when some row actually uses it,
+        * the repetition penalty reads a preallocated (R, vocab) mask of tokens seen so far instead of gathering
+          over a growing `generated_ids`,
+        * emitted tokens are written into a preallocated (R, max_len) buffer rather than concatenated.
+
+    `vocab_size` is the number of logits per row, i.e. only the speech tokens that can actually be emitted
+    (see `T3.n_speech_logits`).
+    """
+
+    def __init__(
+        self,
+        initial_tokens: Tensor,
+        max_new_tokens: int,
+        vocab_size: int,
+        *,
+        temperature: RowParam = 0.8,
+        min_p: RowParam = 0.05,
+        top_p: RowParam = 1.00,
+        repetition_penalty: RowParam = 1.2,
+    ):
+        n_rows, n_initial = initial_tokens.shape
+        device = initial_tokens.device
+        self.vocab_size = vocab_size
+        self.n_initial = n_initial
+        self.temperature = _per_row(temperature, n_rows, device)
+        self.min_p = _per_row(min_p, n_rows, device)
+        self.top_p = _per_row(top_p, n_rows, device)
+        self.repetition_penalty = _per_row(repetition_penalty, n_rows, device)
+
+        self.tokens = torch.zeros(n_rows, n_initial + max_new_tokens, dtype=torch.long, device=device)
+        self.tokens[:, :n_initial] = initial_tokens
+        self.lengths = torch.full((n_rows,), n_initial, dtype=torch.long, device=device)
+        self.seen = torch.zeros(n_rows, vocab_size, dtype=torch.bool, device=device)
+        self.seen.scatter_(1, initial_tokens, True)
+        self._update_flags()
+
+    def _update_flags(self):
+        # decided once per batch composition, so the hot loop never syncs on parameter values
+        self._use_temperature = bool((self.temperature != 1.0).any())
+        self._use_penalty = bool((self.repetition_penalty != 1.0).any())
+        self._use_min_p = bool((self.min_p > 0.0).any())
+        self._use_top_p = bool((self.top_p < 1.0).any())
+
+    def __len__(self):
+        return self.tokens.size(0)
+
+    @property
+    def generated_tokens(self) -> Tensor:
+        "(R, T) tokens appended after the initial ones, up to the longest row."
+        return self.tokens[:, self.n_initial:int(self.lengths.max())]
+
+    def probs(self, logits: Tensor) -> Tensor:
+        "(R, vocab_size) sampling distribution for the next token; `logits` are modified in place."
+        logits = logits.float()
+        if self._use_temperature:
+            logits.div_(self.temperature)
+
+        if self._use_penalty:
+            # seen tokens: negative logits grow by the penalty, positive ones shrink by it
+            p = self.repetition_penalty
+            torch.where(self.seen, torch.where(logits < 0, logits * p, logits / p), logits, out=logits)
+
+        if self._use_min_p:
+            probs = logits.softmax(dim=-1)
+            min_probs = probs.amax(dim=-1, keepdim=True) * self.min_p
+            logits.masked_fill_(probs < min_probs, -float("inf"))
+
+        if self._use_top_p:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= (1 - self.top_p)
+            sorted_to_remove[:, -1] = False  # always keep the most likely token
+            logits.masked_fill_(sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove), -float("inf"))
+
+        return logits.softmax(dim=-1)
+
+    def sample(self, logits: Tensor, generator: Union[torch.Generator, Sequence[torch.Generator], None] = None) -> Tensor:
+        """
+        Draw one token per row from (R, vocab_size) `logits`, which are modified in place. Returns (R, 1) tokens;
+        call `append` with the tokens that are actually kept.
+
+        `generator` is either one RNG for the whole batch or a sequence of per-row RNGs (`None` entries use the
+        global one), so that a seeded row draws the same tokens whatever else is in the batch.
+        """
+        probs = self.probs(logits)
+        if isinstance(generator, (list, tuple)):
+            return torch.cat([
+                torch.multinomial(row[None], num_samples=1, generator=row_generator)
+                for row, row_generator in zip(probs, generator)
+            ])
+        return torch.multinomial(probs, num_samples=1, generator=generator)
+
+    def append(self, next_tokens: Tensor):
+        "Record (R, 1) emitted tokens in the history and the repetition-penalty mask."
+        self.tokens.scatter_(1, self.lengths[:, None], next_tokens)
+        self.lengths += 1
+        self.seen.scatter_(1, next_tokens, True)
+
+    def truncate(self, length: int):
+        "Roll every row back to its first `length` tokens (initial ones included), e.g. to drop rejected drafts."
+        self.lengths.fill_(length)
+        self.seen.zero_()
+        self.seen.scatter_(1, self.tokens[:, :length], True)
+
+    def select(self, index: Tensor) -> "SpeechTokenSampler":
+        "Keep only the rows in `index`, in that order (in place)."
+        for name in ("temperature", "min_p", "top_p", "repetition_penalty", "tokens", "lengths", "seen"):
+            setattr(self, name, getattr(self, name)[index])
+        self._update_flags()
+        return self
+
+    @classmethod
+    def cat(cls, samplers: List["SpeechTokenSampler"]) -> "SpeechTokenSampler":
+        "Stack samplers along the row dim; token buffers are right-padded to the widest one."
+        first = samplers[0]
+        assert all(s.vocab_size == first.vocab_size and s.n_initial == first.n_initial for s in samplers)
+        out = cls.__new__(cls)
+        out.vocab_size, out.n_initial = first.vocab_size, first.n_initial
+        for name in ("temperature", "min_p", "top_p", "repetition_penalty", "lengths", "seen"):
+            setattr(out, name, torch.cat([getattr(s, name) for s in samplers]))
+        width = max(s.tokens.size(1) for s in samplers)
+        out.tokens = torch.cat([F.pad(s.tokens, (0, width - s.tokens.size(1))) for s in samplers])
+        out._update_flags()
+        return out
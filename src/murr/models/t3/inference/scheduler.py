@@ -0,0 +1,319 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Deque, List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+from .sampler import SpeechTokenSampler
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    t3_cond: T3Cond
+    text_tokens: Tensor
+    max_new_tokens: int
+    temperature: float
+    min_p: float
+    top_p: float
+    repetition_penalty: float
+    cfg_weight: float
+    generator: Optional[torch.Generator] = None
+    future: Future = field(default_factory=Future)
+
+    @property
+    def n_rows(self):
+        return 2 if self.cfg_weight > 0.0 else 1
+
+
+class T3Scheduler:
+    """
+    Iteration-level (continuous) batching for `T3` decoding across concurrent callers.
+
+    A single worker thread owns the decode loop and one batched KV cache. Callers `submit` requests from any
+    thread and get a `Future`. At every decode step:
+        * queued requests are prefilled together and their KV is merged into the running batch (left-padded),
+        * one token is sampled for every active request,
+        * requests that hit `stop_speech_token` or their `max_new_tokens` leave the batch right away, and the
+          freed slots go to the next queued requests.
+
+    Each request keeps its own conditioning, sampling parameters and CFG setting. A CFG request takes two rows
+    (conditional then unconditional), adjacent in the batch.
+    """
+
+    def __init__(self, t3, max_batch_size: int = 16):
+        self.t3 = t3
+        self.max_batch_size = max_batch_size
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._waiting: Deque[_Request] = deque()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._active: List[_Request] = []
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[Tensor] = None  # (R, T)
+        self._position_ids: Optional[Tensor] = None  # (R,), position of the last token fed to each row
+        self._logits: Optional[Tensor] = None  # (R, vocab), pending logits for every row
+        self._sampler: Optional[SpeechTokenSampler] = None  # one row per active request
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="T3Scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        max_new_tokens: Optional[int] = None,
+        temperature: float = 0.8,
+        min_p: float = 0.05,
+        top_p: float = 1.00,
+        repetition_penalty: float = 1.2,
+        cfg_weight: float = 0.0,
+        generator: Optional[torch.Generator] = None,
+    ) -> Future:
+        """
+        Queue one utterance for decoding; thread-safe.
+
+        Args:
+            text_tokens: 1D text tokens, already wrapped in start / stop text tokens.
+            generator: RNG for this request's sampling only, so a seeded request draws the same tokens whatever
+                else is in the batch.
+
+        Returns:
+            a `Future` resolving to the 1D speech tokens, ending with `stop_speech_token` if it was emitted.
+        """
+        request = _Request(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens.view(-1),
+            max_new_tokens=max_new_tokens or self.t3.hp.max_speech_tokens,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            generator=generator,
+        )
+        self.start()
+        self._queue.put(request)
+        return request.future
+
+    def _run(self):
+        with torch.inference_mode():
+            while not self._stop.is_set():
+                try:
+                    self._step()
+                except Exception as e:
+                    logger.exception("T3Scheduler step failed, failing all active requests")
+                    for request in self._active:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    self._reset_batch()
+
+    def _step(self):
+        # Drain submissions into the worker-owned waiting line, blocking only while idle.
+        try:
+            if not self._active and not self._waiting:
+                self._waiting.append(self._queue.get(timeout=0.1))
+            while True:
+                self._waiting.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        # Fill the free slots in arrival order (an oversized request still runs alone in an empty batch).
+        arrivals = []
+        n_rows = sum(r.n_rows for r in self._active)
+        while self._waiting and (n_rows + self._waiting[0].n_rows <= self.max_batch_size or n_rows == 0):
+            request = self._waiting.popleft()
+            if not request.future.set_running_or_notify_cancel():
+                continue  # cancelled while queued (once running, a request can no longer be cancelled)
+            arrivals.append(request)
+            n_rows += request.n_rows
+        if arrivals:
+            self._admit_or_fail(arrivals)
+        if not self._active:
+            return
+
+        next_tokens = self._sample()
+        sampler = self._sampler
+        sampler.append(next_tokens)
+
+        stop_token = self.t3.hp.stop_speech_token
+        keep = []
+        tokens, lengths = next_tokens.view(-1).tolist(), sampler.lengths.tolist()
+        for i, (request, token, length) in enumerate(zip(self._active, tokens, lengths)):
+            if token == stop_token or length - sampler.n_initial >= request.max_new_tokens:
+                request.future.set_result(sampler.tokens[i, sampler.n_initial:length].clone())
+            else:
+                keep.append(i)
+
+        if len(keep) < len(self._active):
+            self._evict(keep)
+        if not self._active:
+            self._reset_batch()
+            return
+
+        self._forward(next_tokens.view(-1)[keep] if len(keep) < len(next_tokens) else next_tokens.view(-1))
+
+    def _row_index(self):
+        "(R,) index of the owning request for every row."
+        repeats = torch.tensor([r.n_rows for r in self._active])
+        return torch.repeat_interleave(torch.arange(len(self._active)), repeats)
+
+    def _admit_or_fail(self, arrivals: List[_Request]):
+        """
+        `_admit` the arrivals, failing only the ones that cannot be prefilled: the running batch is left as it was
+        (`_admit` only touches it once the prefill succeeded), and a group that fails is retried one by one so a
+        single malformed request does not take the others down.
+        """
+        try:
+            self._admit(arrivals)
+        except Exception as e:
+            if len(arrivals) > 1:
+                for request in arrivals:
+                    self._admit_or_fail([request])
+                return
+            logger.exception("T3Scheduler could not admit a request")
+            arrivals[0].future.set_exception(e)
+
+    def _admit(self, arrivals: List[_Request]):
+        "Prefill the arrivals as one left-padded batch and merge their KV into the running batch."
+        from ..t3 import _left_pad
+
+        t3 = self.t3
+        device = t3.device
+        rows, samplers = [], []
+        for request in arrivals:
+            bos = torch.full((1,), t3.hp.start_speech_token, dtype=torch.long, device=device)
+            text_tokens = request.text_tokens.to(dtype=torch.long, device=device)
+            rows.extend(t3._embed_rows(request.t3_cond, text_tokens, bos, request.cfg_weight))
+            samplers.append(SpeechTokenSampler(
+                bos[None],
+                request.max_new_tokens,
+                t3.n_speech_logits,
+                temperature=request.temperature,
+                min_p=request.min_p,
+                top_p=request.top_p,
+                repetition_penalty=request.repetition_penalty,
+            ))
+        inputs_embeds, attention_mask, position_ids = _left_pad(rows)
+
+        cache = DynamicCache()
+        output = self.t3.patched_model(
+            inputs_embeds=inputs_embeds,
+            past_key_values=cache,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = output.logits[:, -1, :]
+        position_ids = position_ids[:, -1]
+
+        # (build the merged state first, so a failure leaves the running batch untouched)
+        if not self._active:
+            sampler = SpeechTokenSampler.cat(samplers)
+        else:
+            cache, attention_mask = _merge_caches(self._cache, self._attention_mask, cache, attention_mask)
+            position_ids = torch.cat([self._position_ids, position_ids])
+            logits = torch.cat([self._logits, logits])
+            sampler = SpeechTokenSampler.cat([self._sampler] + samplers)
+        self._cache, self._attention_mask = cache, attention_mask
+        self._position_ids, self._logits, self._sampler = position_ids, logits, sampler
+        self._active.extend(arrivals)
+
+    def _sample(self) -> Tensor:
+        "Sample one token per active request from the pending logits: (S, 1)."
+        device = self._logits.device
+        n_rows = torch.tensor([r.n_rows for r in self._active], device=device)
+        cond_rows = torch.cumsum(n_rows, dim=0) - n_rows
+        uncond_rows = cond_rows + n_rows - 1  # the conditional row itself when there is no CFG twin
+        cfg_weight = torch.tensor([r.cfg_weight if r.n_rows == 2 else 0.0 for r in self._active], device=device)
+
+        logits = self._logits[cond_rows]
+        logits = logits + cfg_weight[:, None] * (logits - self._logits[uncond_rows])
+        generators = [r.generator for r in self._active]
+        return self._sampler.sample(logits, generator=generators if any(g is not None for g in generators) else None)
+
+    def _forward(self, next_tokens: Tensor):
+        "Feed one new token per active request through the backbone, refreshing the pending logits."
+        t3 = self.t3
+        row_index = self._row_index().to(next_tokens.device)
+        tokens = next_tokens[row_index][:, None]  # (R, 1)
+        embeds = t3.speech_emb(tokens)
+        if getattr(t3.hp, "input_pos_emb", None) == "learned":
+            # each request sits at its own step: the initial BOS plus the tokens it has sampled so far
+            steps = self._sampler.lengths - 1
+            embeds = embeds + t3.speech_pos_emb.emb.weight[steps[row_index]][:, None]
+
+        self._attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        self._position_ids = self._position_ids + 1
+        output = self.t3.patched_model(
+            inputs_embeds=embeds,
+            past_key_values=self._cache,
+            attention_mask=self._attention_mask,
+            position_ids=self._position_ids[:, None],
+            return_dict=True,
+        )
+        self._logits = output.logits[:, -1, :]
+
+    def _evict(self, keep: List[int]):
+        "Drop the rows of finished requests, then the leading cache columns that are now padding in every row."
+        row_index = self._row_index()
+        keep_rows = torch.isin(row_index, torch.tensor(keep, dtype=torch.long))
+        keep_rows = keep_rows.nonzero().view(-1).to(self._attention_mask.device)
+        self._active = [self._active[i] for i in keep]
+        if len(keep) == 0:
+            return
+
+        self._sampler.select(torch.tensor(keep, device=self._attention_mask.device))
+        self._cache.batch_select_indices(keep_rows)
+        self._attention_mask = self._attention_mask[keep_rows]
+        self._position_ids = self._position_ids[keep_rows]
+        self._logits = self._logits[keep_rows]
+
+        n_pad = int((self._attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        if n_pad > 0:
+            self._attention_mask = self._attention_mask[:, n_pad:]
+            for layer in range(len(self._cache)):
+                self._cache.key_cache[layer] = self._cache.key_cache[layer][:, :, n_pad:]
+                self._cache.value_cache[layer] = self._cache.value_cache[layer][:, :, n_pad:]
+
+
+def _merge_caches(cache_a: DynamicCache, mask_a: Tensor, cache_b: DynamicCache, mask_b: Tensor):
+    "Stack two batched KV caches (and their padding masks) along the batch dim, left-padding the shorter one."
+    len_a, len_b = mask_a.size(1), mask_b.size(1)
+    length = max(len_a, len_b)
+
+    def left_pad(kv, n):
+        return F.pad(kv, (0, 0, n, 0)) if n > 0 else kv  # (B, H, T, D): pad T on the left
+
+    merged = DynamicCache()
+    for layer in range(len(cache_a)):
+        keys = torch.cat([left_pad(cache_a.key_cache[layer], length - len_a), left_pad(cache_b.key_cache[layer], length - len_b)])
+        values = torch.cat([left_pad(cache_a.value_cache[layer], length - len_a), left_pad(cache_b.value_cache[layer], length - len_b)])
+        merged.update(keys, values, layer)
+    mask = torch.cat([F.pad(mask_a, (length - len_a, 0)), F.pad(mask_b, (length - len_b, 0))])
+    return merged, mask
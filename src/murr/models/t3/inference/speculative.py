@@ -0,0 +1,62 @@
+import copy
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+from transformers import LlamaModel
+
+
+def layer_skip_draft(llama: LlamaModel, n_layers: int) -> LlamaModel:
+    """
+    A `LlamaModel` that runs only the first `n_layers` decoder layers of `llama`, followed by its final norm.
+
+    Every module is shared with `llama` (no weight copies), and layer indices are unchanged, so the draft reads
+    and extends the same KV cache as the full model for those layers.
+    """
+    assert 0 < n_layers < llama.config.num_hidden_layers, "the draft must skip at least one layer"
+    config = copy.deepcopy(llama.config)
+    config.num_hidden_layers = n_layers
+    with torch.device("meta"):  # throwaway modules, replaced right below
+        draft = LlamaModel(config)
+    draft.embed_tokens = llama.embed_tokens
+    draft.layers = nn.ModuleList(llama.layers[:n_layers])
+    draft.norm = llama.norm
+    draft.rotary_emb = llama.rotary_emb
+    return draft.train(llama.training)
+
+
+def speculative_accept(
+    target_probs: Tensor,
+    draft_probs: Tensor,
+    draft_tokens: Tensor,
+    generator: torch.Generator = None,
+) -> Tuple[int, Tensor]:
+    """
+    Speculative sampling: keep draft token j with probability min(1, p_j / q_j) and stop at the first rejection,
+    drawing its replacement from norm(max(0, p_j - q_j)). When all drafts are kept, a bonus token comes from the
+    last target distribution. The output follows the target distribution exactly, whatever the draft.
+
+    Args:
+        target_probs: (k + 1, V) target distributions, for each draft position plus the one after the last draft.
+        draft_probs: (k, V) distributions the drafts were sampled from.
+        draft_tokens: (k,) drafted tokens.
+
+    Returns:
+        the number of accepted drafts and the (1, 1) token that follows them.
+    """
+    k = draft_tokens.numel()
+    rows = torch.arange(k, device=draft_tokens.device)
+    p = target_probs[rows, draft_tokens]
+    q = draft_probs[rows, draft_tokens]
+    u = torch.rand(k, generator=generator, device=p.device)
+    rejected = (u * q >= p).nonzero()
+
+    if rejected.numel() == 0:
+        n_accepted, probs = k, target_probs[k]
+    else:
+        n_accepted = int(rejected[0])
+        probs = (target_probs[n_accepted] - draft_probs[n_accepted]).clamp_(min=0)
+        if probs.sum() <= 0:  # draft and target agree, so any rejection is numerical noise
+            probs = target_probs[n_accepted]
+    next_token = torch.multinomial(probs, num_samples=1, generator=generator)
+    return n_accepted, next_token.view(1, 1)
@@ -2,6 +2,7 @@ from typing import Optional
 
 import torch
 from torch import nn as nn
+import torch.nn.functional as F
 from transformers import LlamaConfig, LlamaModel, LlamaPreTrainedModel, GenerationMixin
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
@@ -24,13 +25,19 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         latents_queue=None,
         logits_queue=None,
         alignment_stream_analyzer: 'AlignmentStreamAnalyzer'=None,
+        speech_vocab_size: Optional[int]=None,
     ):
+        """
+        :param speech_vocab_size: if given, only the first `speech_vocab_size` rows of `speech_head` are projected,
+        i.e. logits only cover the tokens that can actually be emitted.
+        """
         super().__init__(config)
         self.model = llama
         self.speech_enc = speech_enc
         self.speech_head = speech_head
         self._added_cond = False
         self.alignment_stream_analyzer = alignment_stream_analyzer
+        self.speech_vocab_size = speech_vocab_size
 
     @torch.inference_mode()
     def prepare_inputs_for_generation(
@@ -74,9 +81,12 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.Tensor]=None,
+        cache_position: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
     ):
         """
@@ -84,25 +94,33 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        S is usually 1; speculative decoding verifies several draft tokens at once.
+        :param attention_mask: optional (B, past + S) padding mask, needed when the batch is left-padded.
+        :param position_ids: optional (B, S) positions, needed so left-padded rows still start at position 0.
+        :param cache_position: optional (S,) cache slots to write, required with a `StaticCache`.
+
+        NOTE: `output_attentions=True` forces the eager attention path in every layer. Leave it off and hook a
+        single layer instead when attention maps are needed (see `AlignmentStreamAnalyzer`).
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # final (normed) tfmr layer output, (B, seq, dim)
 
-        logits = self.speech_head(hidden_states)
+        if self.speech_vocab_size is None or self.speech_head.out_features <= self.speech_vocab_size:
+            logits = self.speech_head(hidden_states)
+        else:
+            logits = F.linear(hidden_states, self.speech_head.weight[:self.speech_vocab_size])
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
 import torch
@@ -20,6 +20,9 @@ class T3Cond:
     cond_prompt_speech_tokens: Optional[Tensor] = None
     cond_prompt_speech_emb: Optional[Tensor] = None
     emotion_adv: Optional[Tensor] = 0.5
+    # `T3CondEnc.encode_voice` output, cached by `T3.prepare_conditioning`: everything but the emotion term, so a
+    # new `emotion_adv` costs one small linear. Never saved; it is recomputed after loading.
+    cond_voice_emb: Optional[Tensor] = field(default=None, repr=False)
 
     def to(self, *, device=None, dtype=None):
         "Cast to a device and dtype. Dtype casting is ignored for long/int tensors."
@@ -29,8 +32,16 @@ class T3Cond:
                 setattr(self, k, v.to(device=device, dtype=dtype if is_fp else None))
         return self
 
+    def with_emotion_adv(self, emotion_adv) -> "T3Cond":
+        "A copy with another `emotion_adv`, sharing every other input and the cached voice embedding."
+        return T3Cond(**{**self.__dict__, "emotion_adv": emotion_adv})
+
+    def saved_fields(self) -> dict:
+        "The inputs, without derived caches (what `save` and `Conditionals.save` store)."
+        return {k: v for k, v in self.__dict__.items() if k != "cond_voice_emb"}
+
     def save(self, fpath):
-        torch.save(self.__dict__, fpath)
+        torch.save(self.saved_fields(), fpath)
 
     @staticmethod
     def load(fpath, map_location="cpu"):
@@ -61,7 +72,11 @@ class T3CondEnc(nn.Module):
         if hp.use_perceiver_resampler:
             self.perceiver = Perceiver()
 
-    def forward(self, cond: T3Cond):
+    def encode_voice(self, cond: T3Cond) -> Tensor:
+        """
+        The part of the conditioning that does not depend on `emotion_adv`: the speaker projection, CLAP and the
+        (perceiver-resampled) speech prompt, (B, len_cond - n_emotion, dim).
+        """
         # Validate
         assert (cond.cond_prompt_speech_tokens is None) == (cond.cond_prompt_speech_emb is None), \
             "no embeddings for cond_prompt_speech_tokens"
@@ -81,17 +96,27 @@ class T3CondEnc(nn.Module):
         elif self.hp.use_perceiver_resampler:
             cond_prompt_speech_emb = self.perceiver(cond_prompt_speech_emb)
 
-        # Emotion Adv: must provide a value if this model uses emotion conditioning
-        cond_emotion_adv = empty  # (B, 0, dim)
-        if self.hp.emotion_adv:
-            assert cond.emotion_adv is not None
-            cond_emotion_adv = self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1))
-
-        # Concat and return
-        cond_embeds = torch.cat((
+        return torch.cat((
             cond_spkr,
             cond_clap,
             cond_prompt_speech_emb,
-            cond_emotion_adv,
         ), dim=1)
-        return cond_embeds
+
+    def encode_emotion(self, cond: T3Cond) -> Optional[Tensor]:
+        "The emotion_adv term, (B, 1, dim), or `None` for models without emotion conditioning."
+        if not self.hp.emotion_adv:
+            return None
+        # Emotion Adv: must provide a value if this model uses emotion conditioning
+        assert cond.emotion_adv is not None
+        return self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1))
+
+    def forward(self, cond: T3Cond):
+        cond_voice = cond.cond_voice_emb
+        if cond_voice is None:
+            cond_voice = self.encode_voice(cond)
+        cond_emotion_adv = self.encode_emotion(cond)
+        if cond_emotion_adv is None:
+            return cond_voice
+
+        # Concat and return
+        return torch.cat((cond_voice, cond_emotion_adv), dim=1)
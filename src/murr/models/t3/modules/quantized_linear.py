@@ -0,0 +1,112 @@
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+
+QUANT_MODES = ("int8", "int4")
+
+_HAS_INT8_KERNEL = hasattr(torch.ops.aten, "_weight_int8pack_mm")
+_HAS_INT4_KERNEL = hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu")
+_INT4_INNER_K_TILES = 2
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    `nn.Linear` with int8 weights and one scale per output channel (symmetric), about a quarter of the fp32 weight
+    memory. On CPU the matmul runs in PyTorch's `_weight_int8pack_mm` kernel on bf16 activations; on other devices
+    the weight is dequantized on the fly. Outputs are cast back to the input dtype.
+    """
+
+    def __init__(self, weight: Tensor, bias: Optional[Tensor] = None):
+        super().__init__()
+        self.out_features, self.in_features = weight.shape
+        weight = weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        weight_int8 = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+        self.register_buffer("weight_int8", weight_int8)
+        self.register_buffer("scales", scales.to(torch.bfloat16))  # the kernel wants them in the activation dtype
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+
+    def forward(self, x: Tensor) -> Tensor:
+        if _HAS_INT8_KERNEL and x.device.type == "cpu":
+            x_2d = x.reshape(-1, self.in_features).to(torch.bfloat16)
+            out = torch.ops.aten._weight_int8pack_mm(x_2d, self.weight_int8, self.scales)
+            out = out.view(*x.shape[:-1], self.out_features).to(x.dtype)
+        else:
+            out = F.linear(x, self.weight_int8.to(x.dtype) * self.scales[:, None].to(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    `nn.Linear` with 4-bit weights, quantized asymmetrically in groups of `group_size` input channels (a scale and
+    zero point per output channel and group), about an eighth of the fp32 weight memory. The matmul runs in
+    PyTorch's `_weight_int4pack_mm_for_cpu` kernel on bf16 activations, so this layer is CPU-only.
+    """
+
+    def __init__(self, weight: Tensor, bias: Optional[Tensor] = None, group_size: int = 128):
+        super().__init__()
+        assert _HAS_INT4_KERNEL, "int4 weights need torch.ops.aten._weight_int4pack_mm_for_cpu (PyTorch >= 2.6)"
+        self.out_features, self.in_features = n_out, n_in = weight.shape
+        assert n_in % group_size == 0 and n_in % (16 * _INT4_INNER_K_TILES) == 0, "unsupported input size"
+        self.group_size = group_size
+
+        # The packing kernel works on blocks of 16 output channels: pad with zero rows, sliced off in `forward`.
+        n_padded = -(-n_out // 16) * 16
+        weight = F.pad(weight.detach().float(), (0, 0, 0, n_padded - n_out))
+        weight = weight.view(n_padded, n_in // group_size, group_size)
+        w_min = weight.amin(dim=-1, keepdim=True)
+        w_max = weight.amax(dim=-1, keepdim=True)
+        scales = ((w_max - w_min) / 15).clamp(min=1e-8)
+        weight_int4 = ((weight - w_min) / scales).round().clamp(0, 15).to(torch.int32).view(n_padded, n_in)
+        zeros = w_min + 8 * scales  # the kernel dequantizes as (q - 8) * scale + zero
+
+        packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(weight_int4, _INT4_INNER_K_TILES)
+        scales_and_zeros = torch.stack([scales.view(n_padded, -1).T, zeros.view(n_padded, -1).T], dim=-1)
+        self.register_buffer("weight_int4", packed)
+        self.register_buffer("scales_and_zeros", scales_and_zeros.contiguous().to(torch.bfloat16))
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+
+    def forward(self, x: Tensor) -> Tensor:
+        x_2d = x.reshape(-1, self.in_features).to(torch.bfloat16)
+        out = torch.ops.aten._weight_int4pack_mm_for_cpu(x_2d, self.weight_int4, self.group_size, self.scales_and_zeros)
+        out = out[:, :self.out_features].reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, "
+            f"group_size={self.group_size}"
+        )
+
+
+def quantize_linear(linear: nn.Linear, mode: str, group_size: int = 128, n_rows: Optional[int] = None) -> nn.Module:
+    """
+    Weight-only quantized copy of `linear`, optionally keeping only its first `n_rows` output channels.
+    """
+    weight = linear.weight[:n_rows]
+    bias = None if linear.bias is None else linear.bias[:n_rows]
+    if mode == "int8":
+        return Int8WeightOnlyLinear(weight, bias)
+    if mode == "int4":
+        return Int4WeightOnlyLinear(weight, bias, group_size=group_size)
+    raise ValueError(f"unknown quantization mode {mode!r}, expected one of {QUANT_MODES}")
+
+
+def quantize_linears_(module: nn.Module, mode: str, group_size: int = 128) -> nn.Module:
+    "Replace every `nn.Linear` inside `module` with its weight-only quantized version, in place."
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, quantize_linear(child, mode, group_size))
+        else:
+            quantize_linears_(child, mode, group_size)
+    return module
@@ -1,14 +1,15 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
-from typing import Union, Optional, List, Any, cast
+import threading
+from contextlib import nullcontext
+from typing import Union, Optional, List, Any, Iterator, cast
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+from transformers import LlamaModel, LlamaConfig, DynamicCache, StaticCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -16,11 +17,19 @@ from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
+from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.sampler import SpeechTokenSampler
+from .inference.speculative import layer_skip_draft, speculative_accept
+from .inference.cond_prefix import CondPrefixKV
+from .modules.quantized_linear import quantize_linear, quantize_linears_
 from ..utils import AttrDict
 
 
 logger = logging.getLogger(__name__)
 
+# Static KV cache capacities are rounded up to this, so a compiled decode step is reused across requests.
+STATIC_CACHE_BUCKET = 256
+
 
 def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     B = text_tokens.size(0)
@@ -28,6 +37,40 @@ def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     assert (text_tokens == hp.stop_text_token).int().sum() >= B, "missing stop_text_token"
 
 
+def _round_up(n: int, multiple: int) -> int:
+    return -(-n // multiple) * multiple
+
+
+def _left_pad(rows: List[Tensor]):
+    """
+    Left-pad a list of (L_i, dim) embeddings into a (B, L, dim) batch. Also returns the (B, L) attention mask and
+    the (B, L) position ids, so that each row still starts at position 0 regardless of its padding.
+    """
+    max_len = max(row.size(0) for row in rows)
+    embeds = rows[0].new_zeros(len(rows), max_len, rows[0].size(-1))
+    attention_mask = torch.zeros(len(rows), max_len, dtype=torch.long, device=rows[0].device)
+    for i, row in enumerate(rows):
+        embeds[i, max_len - row.size(0):] = row
+        attention_mask[i, max_len - row.size(0):] = 1
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+    return embeds, attention_mask, position_ids
+
+
+def _capturing(alignment_stream_analyzer: Optional[AlignmentStreamAnalyzer]):
+    "The analyzer's attention capture for one forward, if alignment analysis is on."
+    return nullcontext() if alignment_stream_analyzer is None else alignment_stream_analyzer.capturing()
+
+
+def _collect(steps: Iterator[Tensor], n_rows: int, max_new_tokens: Optional[int], desc: str) -> Tensor:
+    "Run a decode generator to the end behind a progress bar: the (N, T) concatenation of the tokens it yields."
+    chunks = []
+    with tqdm(total=max_new_tokens, desc=desc, dynamic_ncols=True) as pbar:
+        for chunk in steps:
+            chunks.append(chunk)
+            pbar.update(chunk.size(1))
+    return torch.cat(chunks, dim=1) if chunks else torch.zeros(n_rows, 0, dtype=torch.long)
+
+
 class T3(nn.Module):
     """
     Token-To-Token (T3) TTS model using huggingface transformer models as backbones,
@@ -64,11 +107,46 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
-        self.compiled = False
+        # Decoding only ever emits the speech codes, start or stop: the remaining `speech_head` rows are skipped.
+        self.n_speech_logits = max(hp.start_speech_token, hp.stop_speech_token) + 1
+
+        # Inference backend, built once and shared by every decode call and thread. It only wraps the modules
+        # above, so it is kept out of the module tree: no duplicate `state_dict` keys, and `.to(...)` / loading
+        # weights on `T3` carry over to it.
+        self.__dict__["patched_model"] = T3HuggingfaceBackend(
+            config=self.cfg,
+            llama=self.tfmr,
+            speech_enc=self.speech_emb,
+            speech_head=self.speech_head,
+            alignment_stream_analyzer=None,
+            speech_vocab_size=self.n_speech_logits,
+        )
+        self.compile_lock = threading.Lock()
+        self._compiled_decode_step = None
+        self._draft_models = {}  # layer-skip draft backends for speculative decoding, by depth
+        self.quant_mode: Optional[str] = None  # set by `quantize`
 
     @property
     def device(self):
-        return self.speech_head.weight.device
+        return self.speech_emb.weight.device
+
+    def quantize(self, mode: str = "int8", group_size: int = 128):
+        """
+        Weight-only quantization of every backbone linear layer and of `speech_head`, for CPU inference: "int8"
+        (per-channel scales) or "int4" (per-group scales and zeros, `group_size` input channels per group).
+        Embeddings, norms and attention stay in full precision.
+
+        `speech_head` only keeps the rows decoding can emit, so a quantized model is for inference only.
+        """
+        quantize_linears_(self.tfmr, mode, group_size)
+        self.quant_mode = mode
+        self.speech_head = quantize_linear(self.speech_head, mode, group_size, n_rows=self.n_speech_logits)
+        with self.compile_lock:
+            # the backend, drafts and compiled step still point at the old modules
+            self.patched_model.speech_head = self.speech_head
+            self._draft_models.clear()
+            self._compiled_decode_step = None
+        return self
 
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
@@ -81,19 +159,39 @@ class T3(nn.Module):
             if getattr(self.hp, "input_pos_emb", None) == "learned":
                 _emb = _emb + self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
             t3_cond.cond_prompt_speech_emb = _emb
+        if t3_cond.cond_voice_emb is None and not torch.is_grad_enabled():
+            # the speaker projection and perceiver do not depend on emotion_adv: run them once per voice
+            t3_cond.cond_voice_emb = self.cond_enc.encode_voice(t3_cond)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
+    @torch.inference_mode()
+    def prefill_conditioning(self, t3_cond: T3Cond) -> CondPrefixKV:
+        """
+        Run the conditioning prefix alone through the backbone. Its KV can be reused for every request with this
+        voice and exaggeration (`inference(cond_prefix=...)`), with or without CFG.
+        """
+        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        past = DynamicCache()
+        self.tfmr(inputs_embeds=cond_emb, past_key_values=past, use_cache=True, return_dict=True)
+        return CondPrefixKV(key_cache=list(past.key_cache), value_cache=list(past.value_cache))
+
     def prepare_input_embeds(
         self,
         *,
-        t3_cond: T3Cond,
+        t3_cond: Optional[T3Cond],
         text_tokens: torch.LongTensor,
         speech_tokens: torch.LongTensor,
         cfg_weight: float = 0.0,
     ):
+        """
+        `t3_cond=None` leaves out the conditioning prefix, for when its KV is already cached (see `CondPrefixKV`).
+        """
         # prepare input embeddings (skip backbone transformer embeddings)
-        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
+        if t3_cond is not None:
+            cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        else:
+            cond_emb = text_emb[:, :0]
 
         speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
         if getattr(self.hp, "input_pos_emb", None) == "learned":
@@ -132,11 +230,10 @@ class T3(nn.Module):
             input_ids=None,  # type: ignore[arg-type]
             # position_ids=position_ids, # TODO? ROPE should be fine?
             inputs_embeds=cast(torch.FloatTensor, embeds),  # type: ignore[arg-type]
-            output_hidden_states=True,
             return_dict=True,
             use_cache=(not training),
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # final tfmr layer output, (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # final (normed) tfmr layer output, (B, seq, dim)
 
         # post-processing: splice out text and speech parts of hidden states
         len_text = text_tokens.size(1)
@@ -214,6 +311,7 @@ class T3(nn.Module):
 
         # misc conditioning
         prepend_prompt_speech_tokens: Optional[Tensor]=None,
+        cond_prefix: Optional[CondPrefixKV]=None,
 
         # HF generate args
         num_return_sequences: int = 1,
@@ -226,10 +324,109 @@ class T3(nn.Module):
         length_penalty: float = 1.0,
         repetition_penalty: float = 1.2,
         cfg_weight: float = 0.0,
+
+        # decode mode
+        static_cache: bool = False,
+        compile_step: bool = False,
+        alignment_layer_idx: Optional[int] = None,
+        speculative_k: int = 0,
+        draft_layers: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
     ):
         """
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cond_prefix: the KV of `t3_cond`'s conditioning prefix, from `prefill_conditioning`. Prefill then only
+                runs the text and initial speech tokens.
+            static_cache: decode against a preallocated, fixed-capacity KV cache instead of a growing one.
+            compile_step: run the single-token decode step through `torch.compile` (needs `static_cache`).
+            alignment_layer_idx: opt in to online alignment checks (`AlignmentStreamAnalyzer`), which capture the
+                attention maps of this one layer to suppress early EOS and cut off long tails / repetitions.
+                Every other layer keeps the fused SDPA kernel.
+            speculative_k: if > 0, decode self-speculatively: a draft made of the first `draft_layers` layers
+                proposes up to this many tokens, which the full model verifies in one forward. Tokens follow the
+                same distribution as regular decoding (single utterance, dynamic cache only).
+            draft_layers: depth of the speculative draft, defaults to a third of the layers.
+            generator: RNG for sampling, e.g. seeded for reproducible output; defaults to the global RNG.
+        """
+        steps = self._inference_steps(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            prepend_prompt_speech_tokens=prepend_prompt_speech_tokens,
+            cond_prefix=cond_prefix,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            static_cache=static_cache,
+            compile_step=compile_step,
+            alignment_layer_idx=alignment_layer_idx,
+            speculative_k=speculative_k,
+            draft_layers=draft_layers,
+            generator=generator,
+        )
+        n_rows = torch.atleast_2d(text_tokens).size(0)
+        desc = "Sampling (speculative)" if speculative_k > 0 else "Sampling"
+        return _collect(steps, n_rows, max_new_tokens or self.hp.max_speech_tokens, desc)
+
+    @torch.inference_mode()
+    def inference_stream(self, *, chunk_size: int = 1, **kwargs) -> Iterator[Tensor]:
+        """
+        Streaming `inference` for a single utterance: a generator of 1D speech token chunks, each yielded as soon
+        as its last token is sampled. Takes the same keyword arguments as `inference`.
+
+        Every chunk holds `chunk_size` tokens, except the last one, which may be shorter and ends with
+        `stop_speech_token` if it was emitted. Joined together, the chunks are exactly what `inference` returns
+        for the same arguments and RNG state.
+
+        The KV cache and sampling state live inside the generator and nothing runs between two `next` calls, so
+        the caller sets the pace (backpressure). Stopping early is just a matter of dropping or `close()`-ing the
+        generator.
+        """
+        assert chunk_size > 0, "chunk_size must be positive"
+        assert torch.atleast_2d(kwargs["text_tokens"]).size(0) == 1, "streaming tracks a single utterance"
+        pending = None
+        for tokens in self._inference_steps(**kwargs):
+            pending = tokens[0] if pending is None else torch.cat([pending, tokens[0]])
+            while pending.numel() >= chunk_size:
+                yield pending[:chunk_size]
+                pending = pending[chunk_size:]
+        if pending is not None and pending.numel() > 0:
+            yield pending
+
+    def _inference_steps(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+        prepend_prompt_speech_tokens: Optional[Tensor]=None,
+        cond_prefix: Optional[CondPrefixKV]=None,
+        max_new_tokens: Optional[int] = None,
+        stop_on_eos: bool = True,
+        temperature: float = 0.8,
+        min_p: float = 0.05,
+        top_p: float = 1.00,
+        repetition_penalty: float = 1.2,
+        cfg_weight: float = 0.0,
+        static_cache: bool = False,
+        compile_step: bool = False,
+        alignment_layer_idx: Optional[int] = None,
+        speculative_k: int = 0,
+        draft_layers: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
+        # HF generate args that `inference` accepts but does not use
+        num_return_sequences: int = 1,
+        do_sample: bool = True,
+        length_penalty: float = 1.0,
+    ) -> Iterator[Tensor]:
+        """
+        The body of `inference` and `inference_stream`: prepares the prompt and picks the decode loop, then
+        yields the (N, t) speech tokens it commits, as they are sampled. See `inference` for the arguments.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
@@ -240,36 +437,20 @@ class T3(nn.Module):
         if initial_speech_tokens is None:
             initial_speech_tokens = cast(torch.LongTensor, self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1]))
 
-        # Prepare custom input embeds
+        # CFG: both branches share the conditioning prefix, so prefill it once and fork its KV for the two rows.
+        if cfg_weight > 0.0 and cond_prefix is None and alignment_layer_idx is None:
+            cond_prefix = self.prefill_conditioning(t3_cond)
+
+        # Prepare custom input embeds (without the conditioning when its KV is cached)
         embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
+            t3_cond=t3_cond if cond_prefix is None else None,
             text_tokens=text_tokens,
             speech_tokens=cast(torch.LongTensor, initial_speech_tokens),
             cfg_weight=cfg_weight,
         )
 
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
-
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=None,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
-
-        device = embeds.device
-
         # Start from provided initial speech tokens (typically BOS). Do not duplicate BOS.
-        inputs_embeds = embeds  # includes cond + text + initial_speech_tokens
+        inputs_embeds = embeds  # includes (cond +) text + initial_speech_tokens
 
         # Classifier-free guidance setup: duplicate batch and zero-out text segment for uncond branch
         if cfg_weight > 0.0:
@@ -278,86 +459,500 @@ class T3(nn.Module):
             uncond_embeds[:, len_cond:len_cond + len_text, :] = 0
             inputs_embeds = torch.cat([inputs_embeds, uncond_embeds], dim=0)
 
-        # Track generated token ids; start with initial speech tokens (conditional branch)
-        generated_ids = cast(torch.LongTensor, initial_speech_tokens.clone())
-        predicted = []  # To store the predicted tokens
+        if speculative_k > 0:
+            assert text_tokens.size(0) == 1, "speculative decoding tracks a single utterance"
+            assert not static_cache and alignment_layer_idx is None, "not implemented"
+            yield from self._decode_speculative_steps(
+                inputs_embeds,
+                initial_speech_tokens=initial_speech_tokens,
+                max_new_tokens=max_new_tokens,
+                stop_on_eos=stop_on_eos,
+                temperature=temperature,
+                min_p=min_p,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+                speculative_k=speculative_k,
+                draft_layers=draft_layers or self.cfg.num_hidden_layers // 3,
+                prefix=cond_prefix,
+                generator=generator,
+            )
+            return
+
+        alignment_stream_analyzer = None
+        if alignment_layer_idx is not None:
+            assert text_tokens.size(0) == 1, "alignment analysis tracks a single utterance"
+            assert not compile_step, "the attention spy does not go through `torch.compile`"
+            assert cond_prefix is None, "alignment analysis needs the conditioning in the prefill"
+            alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                self.tfmr,
+                None,
+                text_tokens_slice=(len_cond, len_cond + text_tokens.size(1)),
+                alignment_layer_idx=alignment_layer_idx,
+                eos_idx=self.hp.stop_speech_token,
+            )
 
-        # Instantiate the logits processors.
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+        # All rows share the same length here, so no padding mask is needed.
+        yield from self._decode_steps(
+            inputs_embeds,
+            attention_mask=None,
+            position_ids=None,
+            initial_speech_tokens=initial_speech_tokens,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            static_cache=static_cache,
+            compile_step=compile_step,
+            alignment_stream_analyzer=alignment_stream_analyzer,
+            prefix=cond_prefix,
+            generator=generator,
+        )
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_cond: Union[T3Cond, List[T3Cond]],
+        text_tokens: List[Tensor],
+        max_new_tokens: Optional[int] = None,
+        stop_on_eos: bool = True,
+        temperature: float = 0.8,
+        min_p: float = 0.05,
+        top_p: float = 1.00,
+        repetition_penalty: float = 1.2,
+        cfg_weight: float = 0.0,
+        static_cache: bool = False,
+        compile_step: bool = False,
+        generator: Union[torch.Generator, List[Optional[torch.Generator]], None] = None,
+    ) -> List[Tensor]:
+        """
+        Decode N independent utterances in one batch. Rows are left-padded to a common length and each row
+        stops on its own `stop_speech_token`.
+
+        Args:
+            t3_cond: a single `T3Cond` shared by every row, or a list with one `T3Cond` per row.
+            text_tokens: a list of N 1D tensors, each already wrapped in start / stop text tokens.
+            static_cache, compile_step: see `inference`.
+            generator: one RNG for the batch, or one per row so each row's tokens only depend on its own seed.
+
+        Returns:
+            a list of N 1D tensors of speech tokens, each cut right after its first `stop_speech_token`.
+        """
+        n_rows = len(text_tokens)
+        t3_conds = list(t3_cond) if isinstance(t3_cond, (list, tuple)) else [t3_cond] * n_rows
+        assert len(t3_conds) == n_rows, "need exactly one T3Cond per text"
+
+        text_tokens = [t.view(-1).to(dtype=torch.long, device=self.device) for t in text_tokens]
+        for t in text_tokens:
+            _ensure_BOT_EOT(t[None], self.hp)
+        initial_speech_tokens = torch.full(
+            (n_rows, 1), self.hp.start_speech_token, dtype=torch.long, device=self.device
         )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
 
-        # ---- Generation Loop using kv_cache ----
+        inputs_embeds, attention_mask, position_ids = self._prepare_batch_embeds(
+            t3_conds, text_tokens, initial_speech_tokens, cfg_weight,
+        )
+        steps = self._decode_steps(
+            inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            initial_speech_tokens=initial_speech_tokens,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            static_cache=static_cache,
+            compile_step=compile_step,
+            generator=generator,
+        )
+        predicted = _collect(steps, n_rows, max_new_tokens or self.hp.max_speech_tokens, "Sampling")
+
+        outputs = []
+        for row in predicted:
+            eos = (row == self.hp.stop_speech_token).nonzero()
+            outputs.append(row[:int(eos[0, 0]) + 1] if len(eos) > 0 else row)
+        return outputs
+
+    def _prepare_batch_embeds(
+        self,
+        t3_conds: List[T3Cond],
+        text_tokens: List[Tensor],
+        initial_speech_tokens: Tensor,
+        cfg_weight: float,
+    ):
+        """
+        Embed every row on its own, then left-pad them into one batch. With CFG, the unconditional twins follow
+        the conditional rows, i.e. rows [0, N) are conditional and rows [N, 2N) unconditional.
+
+        Returns (inputs_embeds, attention_mask, position_ids) of shapes (R, L, dim), (R, L) and (R, L).
+        """
+        cond_rows, uncond_rows = [], []
+        for t3_cond, text, speech in zip(t3_conds, text_tokens, initial_speech_tokens):
+            rows = self._embed_rows(t3_cond, text, speech, cfg_weight)
+            cond_rows.append(rows[0])
+            uncond_rows.extend(rows[1:])
+        return _left_pad(cond_rows + uncond_rows)
+
+    def _embed_rows(self, t3_cond: T3Cond, text_tokens: Tensor, speech_tokens: Tensor, cfg_weight: float):
+        """
+        Embed a single utterance from 1D text / speech tokens. Returns its (L, dim) conditional row, followed by
+        the unconditional twin (text span zeroed) when CFG is on.
+        """
+        embeds, len_cond = self.prepare_input_embeds(
+            t3_cond=t3_cond,
+            text_tokens=cast(torch.LongTensor, text_tokens[None]),
+            speech_tokens=cast(torch.LongTensor, speech_tokens[None]),
+        )
+        rows = [embeds[0]]
+        if cfg_weight > 0.0:
+            uncond = embeds[0].clone()
+            uncond[len_cond:len_cond + text_tokens.size(0)] = 0
+            rows.append(uncond)
+        return rows
+
+    def _decode_steps(
+        self,
+        inputs_embeds: Tensor,
+        *,
+        attention_mask: Optional[Tensor],
+        position_ids: Optional[Tensor],
+        initial_speech_tokens: Tensor,
+        max_new_tokens: Optional[int],
+        stop_on_eos: bool,
+        temperature: float,
+        min_p: float,
+        top_p: float,
+        repetition_penalty: float,
+        cfg_weight: float,
+        static_cache: bool = False,
+        compile_step: bool = False,
+        alignment_stream_analyzer: Optional[AlignmentStreamAnalyzer] = None,
+        prefix: Optional[CondPrefixKV] = None,
+        generator: Union[torch.Generator, List[Optional[torch.Generator]], None] = None,
+    ) -> Iterator[Tensor]:
+        """
+        Sampling loop shared by `inference`, `inference_stream` and `inference_batch`.
+
+        `inputs_embeds` holds N conditional rows followed, with CFG, by their N unconditional twins. Each row
+        stops on its own: once it emits `stop_speech_token` it is fed that token until every row is done.
+        With a precomputed conditioning `prefix`, `inputs_embeds` only holds what follows it.
+
+        With `static_cache`, the KV cache, padding mask, positions and speech position embeddings are all
+        allocated once up front, so every decode step has the same shapes and can be run through `torch.compile`
+        (`compile_step`).
+
+        Yields the (N, 1) token sampled for every row at each step, finished rows padded with `stop_speech_token`.
+        A token is yielded before it is fed back, so consumers get it without waiting for the next forward.
+        """
         if max_new_tokens is None:
             max_new_tokens = self.hp.max_speech_tokens
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_all = output.logits[:, -1, :]  # (B or 2B, vocab)
+        assert not compile_step or static_cache, "compiling the decode step needs fixed shapes, i.e. a static cache"
+        assert prefix is None or attention_mask is None, "a shared prefix needs unpadded rows"
+
+        device = inputs_embeds.device
+        n_rows = initial_speech_tokens.size(0)
+        n_batch, prefill_len = inputs_embeds.shape[:2]
+        n_prefix = 0 if prefix is None else prefix.length
+        stop_token = self.hp.stop_speech_token
+        finished = torch.zeros(n_rows, dtype=torch.bool, device=device)
+        use_cfg = cfg_weight > 0.0
+
+        # Speech position embeddings for every step, sliced once instead of re-embedding an index per step.
+        speech_pos_embs = None
+        if getattr(self.hp, "input_pos_emb", None) == "learned":
+            # offset by existing initial speech tokens
+            pos_offset = int(initial_speech_tokens.size(1))
+            speech_pos_embs = self.speech_pos_emb.emb.weight[pos_offset:pos_offset + max_new_tokens]
+
+        # (an explicit cache object, so HF doesn't round-trip it through the legacy tuple format every step)
+        past = DynamicCache() if prefix is None else prefix.shared_cache(n_batch)
+        cache_position = None
+        step_position_ids = None
+        decode_step = self._decode_step
+        if static_cache:
+            capacity = _round_up(n_prefix + prefill_len + max_new_tokens, STATIC_CACHE_BUCKET)
+            past = StaticCache(
+                config=self.cfg,
+                batch_size=n_batch,
+                max_cache_len=capacity,
+                device=device,
+                dtype=inputs_embeds.dtype,
+            )
+            # Only left-padding is ever masked; slots that are not written yet are hidden by the causal mask
+            # built from `cache_position`, so one full-capacity mask serves every step.
+            full_mask = torch.ones(n_batch, capacity, dtype=torch.long, device=device)
+            if attention_mask is not None:
+                full_mask[:, :prefill_len] = attention_mask
+            attention_mask = full_mask
+            if position_ids is None:
+                position_ids = torch.arange(n_prefix, n_prefix + prefill_len, device=device).expand(n_batch, -1)
+            cache_position = torch.arange(capacity, device=device)
+            step_position_ids = position_ids[:, -1:] + 1 + torch.arange(max_new_tokens, device=device)
+            if compile_step:
+                decode_step = self._get_compiled_decode_step()
+            if prefix is not None:
+                prefix.fill(past, n_batch)
+
+        # Token history (starting with the initial speech tokens) and sampling state, preallocated for all steps.
+        sampler = SpeechTokenSampler(
+            initial_speech_tokens,
+            max_new_tokens,
+            self.n_speech_logits,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
+
+        # ---- Initial Forward Pass (empty kv_cache) ----
+        with _capturing(alignment_stream_analyzer):
+            output = self.patched_model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                cache_position=None if cache_position is None else cache_position[n_prefix:n_prefix + prefill_len],
+                use_cache=True,
+                return_dict=True,
+            )
+        # Initialize kv_cache with the full context.
+        past = output.past_key_values
+        logits_all = output.logits[:, -1, :]  # (N or 2N, vocab)
 
+        # ---- Generation Loop using kv_cache ----
+        for i in range(max_new_tokens):
             # CFG: combine conditional and unconditional branches
-            if cfg_weight > 0.0:
-                bs = logits_all.size(0)
-                assert bs % 2 == 0, "CFG enabled but batch size is not even"
-                half = bs // 2
-                logits = logits_all[0:half, :]
-                logits_uncond = logits_all[half:, :]
+            if use_cfg:
+                assert logits_all.size(0) == 2 * n_rows, "CFG enabled but batch is not cond + uncond rows"
+                logits = logits_all[:n_rows, :]
+                logits_uncond = logits_all[n_rows:, :]
                 logits = logits + cfg_weight * (logits - logits_uncond)
             else:
                 logits = logits_all
 
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
+            # Online alignment checks may suppress or force EOS (single utterance only).
+            if alignment_stream_analyzer is not None:
+                logits = alignment_stream_analyzer.step(logits)
 
-            # Apply repetition penalty and nucleus/min‑p filtering on the conditional branch tokens
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = min_p_warper(generated_ids, logits)
-            logits = top_p_warper(generated_ids, logits)
+            # Temperature, repetition penalty and min-p / top-p filtering, then sample: (N, 1)
+            next_token = sampler.sample(logits, generator=generator)
 
-            # Convert logits to probabilities and sample the next token(s) for the conditional branch.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
+            # Rows that already emitted EOS keep emitting it.
+            if stop_on_eos:
+                next_token = next_token.masked_fill(finished[:, None], stop_token)
 
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+            sampler.append(next_token)
+            yield next_token
 
             # Check for EOS token(s).
-            if stop_on_eos and (next_token.view(-1) == self.hp.stop_speech_token).all():
-                break
+            if stop_on_eos:
+                finished |= next_token.view(-1) == stop_token
+                if finished.all():
+                    break
+
+            if static_cache:
+                position_ids = step_position_ids[:, i:i + 1]
+                step = n_prefix + prefill_len + i
+                step_cache_position = cache_position[step:step + 1]
+            else:
+                # Left-padded batches: extend the padding mask and advance each row's own position.
+                if attention_mask is not None:
+                    attention_mask = F.pad(attention_mask, (0, 1), value=1)
+                if position_ids is not None:
+                    position_ids = position_ids[:, -1:] + 1
+                step_cache_position = None
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            if getattr(self.hp, "input_pos_emb", None) == "learned":
-                # offset by existing initial speech tokens
-                pos_offset = int(initial_speech_tokens.size(1))
-                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(pos_offset + i)
+            # Forward pass with only the new token and the cached past.
+            with _capturing(alignment_stream_analyzer):
+                logits_all = decode_step(
+                    next_token,
+                    speech_pos_emb=None if speech_pos_embs is None else speech_pos_embs[i],
+                    past_key_values=past,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    cache_position=step_cache_position,
+                    use_cfg=use_cfg,
+                )
+
+    def _decode_speculative_steps(
+        self,
+        inputs_embeds: Tensor,
+        *,
+        initial_speech_tokens: Tensor,
+        max_new_tokens: Optional[int],
+        stop_on_eos: bool,
+        temperature: float,
+        min_p: float,
+        top_p: float,
+        repetition_penalty: float,
+        cfg_weight: float,
+        speculative_k: int,
+        draft_layers: int,
+        prefix: Optional[CondPrefixKV] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> Iterator[Tensor]:
+        """
+        Self-speculative (layer-skip) variant of `_decode_steps`, for a single utterance (plus its CFG twin).
 
-            # For CFG, duplicate the new token embedding for uncond branch as well
-            if cfg_weight > 0.0:
-                next_token_embed = torch.cat([next_token_embed, next_token_embed], dim=0)
+        Every round, the draft (the first `draft_layers` layers of `tfmr`, the final norm and `speech_head`) proposes
+        up to `speculative_k` tokens one at a time, reading and extending the shared KV cache. The cache is then
+        cropped back, and the full model runs the last token and all drafts in one forward. `speculative_accept`
+        keeps the longest acceptable prefix of drafts and samples the token after it, so the output follows the
+        same distribution as `_decode_steps`. Finally the cache is cropped to the accepted tokens.
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
-            )
-            # Update the kv_cache.
-            past = output.past_key_values
+        Yields the (1, t) tokens committed by each round (the accepted drafts and the token after them), the last
+        ones ending with `stop_speech_token` if it was emitted.
+        """
+        if max_new_tokens is None:
+            max_new_tokens = self.hp.max_speech_tokens
+        stop_token = self.hp.stop_speech_token
+        use_cfg = cfg_weight > 0.0
+        draft_model = self._get_draft_model(draft_layers)
+
+        # Speech position embeddings for every sampled token, offset by the initial speech tokens.
+        speech_pos_embs = None
+        if getattr(self.hp, "input_pos_emb", None) == "learned":
+            pos_offset = int(initial_speech_tokens.size(1))
+            speech_pos_embs = self.speech_pos_emb.emb.weight[pos_offset:pos_offset + max_new_tokens]
+
+        def embed(tokens, first_step):
+            "(1, T) tokens sampled at steps `first_step`... -> (R, T, dim) inputs for every backbone row."
+            embeds = self.speech_emb(tokens)
+            if speech_pos_embs is not None:
+                embeds = embeds + speech_pos_embs[first_step:first_step + tokens.size(1)]
+            return torch.cat([embeds, embeds]) if use_cfg else embeds
+
+        def guided(logits):
+            "(R, T, vocab) backbone logits -> (T, vocab) logits of the utterance."
+            if use_cfg:
+                logits = logits[:1] + cfg_weight * (logits[:1] - logits[1:])
+            return logits[0]
+
+        # The sampler also holds drafts tentatively, hence the extra room.
+        sampler = SpeechTokenSampler(
+            initial_speech_tokens,
+            max_new_tokens + speculative_k,
+            self.n_speech_logits,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
+
+        past = DynamicCache() if prefix is None else prefix.shared_cache(inputs_embeds.size(0))
+        output = self.patched_model(inputs_embeds=inputs_embeds, past_key_values=past, use_cache=True, return_dict=True)
+        next_token = sampler.sample(guided(output.logits[:, -1:]), generator=generator)
+        sampler.append(next_token)
+        yield next_token
+        n_generated = 1  # the last one is not in the cache yet
+
+        while n_generated < max_new_tokens and not (stop_on_eos and int(next_token) == stop_token):
+            n_cached = past.get_seq_length()
+            n_history = int(sampler.lengths[0])
+
+            # ---- Draft: cheap, one token at a time, on the first layers only ----
+            drafts, draft_probs = [], []
+            token = next_token
+            for j in range(min(speculative_k, max_new_tokens - n_generated - 1)):
+                output = draft_model(inputs_embeds=embed(token, n_generated - 1 + j), past_key_values=past)
+                probs = sampler.probs(guided(output.logits))
+                token = torch.multinomial(probs, num_samples=1, generator=generator)
+                sampler.append(token)
+                drafts.append(token)
+                draft_probs.append(probs)
+                if int(token) == stop_token:
+                    break
+            past.crop(n_cached)
+            sampler.truncate(n_history)
+
+            # ---- Verify: the last token and every draft in one full forward ----
+            chunk = torch.cat([next_token] + drafts, dim=1)
+            output = self.patched_model(inputs_embeds=embed(chunk, n_generated - 1), past_key_values=past)
+            logits = guided(output.logits)  # (1 + k, vocab)
+            target_probs = []
+            for j in range(len(drafts) + 1):
+                # target distribution at each draft position, given that every earlier draft is kept
+                target_probs.append(sampler.probs(logits[j:j + 1]))
+                if j < len(drafts):
+                    sampler.append(drafts[j])
+            sampler.truncate(n_history)
+
+            n_accepted, next_token = 0, None
+            if drafts:
+                n_accepted, next_token = speculative_accept(
+                    torch.cat(target_probs), torch.cat(draft_probs), torch.cat(drafts, dim=1).view(-1), generator,
+                )
+            else:
+                next_token = torch.multinomial(target_probs[0], num_samples=1, generator=generator)
+            for token in drafts[:n_accepted]:
+                sampler.append(token)
+            if stop_on_eos and n_accepted > 0 and int(drafts[n_accepted - 1]) == stop_token:
+                yield torch.cat(drafts[:n_accepted], dim=1)
+                break  # the accepted drafts already end the utterance
+            sampler.append(next_token)
+            yield torch.cat(drafts[:n_accepted] + [next_token], dim=1)
+            past.crop(n_cached + 1 + n_accepted)
+            n_generated += n_accepted + 1
+
+    def _get_draft_model(self, n_layers: int) -> T3HuggingfaceBackend:
+        "Backend over the first `n_layers` layers of `tfmr`, built once per depth and sharing every weight."
+        with self.compile_lock:
+            if n_layers not in self._draft_models:
+                draft = layer_skip_draft(self.tfmr, n_layers)
+                self._draft_models[n_layers] = T3HuggingfaceBackend(
+                    config=draft.config,
+                    llama=draft,
+                    speech_enc=self.speech_emb,
+                    speech_head=self.speech_head,
+                    speech_vocab_size=self.n_speech_logits,
+                )
+        return self._draft_models[n_layers]
+
+    def _decode_step(
+        self,
+        next_token: Tensor,
+        *,
+        speech_pos_emb: Optional[Tensor],
+        past_key_values,
+        attention_mask: Optional[Tensor],
+        position_ids: Optional[Tensor],
+        cache_position: Optional[Tensor],
+        use_cfg: bool,
+    ) -> Tensor:
+        """
+        Single-token forward against the KV cache: embeds `next_token` (N, 1), duplicates it for the CFG branch
+        and returns the (R, vocab) logits. With a static cache every input has a fixed shape, which is what
+        makes this function a good `torch.compile` target.
+        """
+        # Get embedding for the new token.
+        next_token_embed = self.speech_emb(next_token)
+        if speech_pos_emb is not None:
+            next_token_embed = next_token_embed + speech_pos_emb
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+        # For CFG, duplicate the new token embedding for uncond branch as well
+        if use_cfg:
+            next_token_embed = torch.cat([next_token_embed, next_token_embed], dim=0)
+
+        output = self.patched_model(
+            inputs_embeds=next_token_embed,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
+            return_dict=True,
+        )
+        return output.logits[:, -1, :]
+
+    def _get_compiled_decode_step(self):
+        """`torch.compile` the decode step once; static cache capacities are bucketed so graphs get reused."""
+        with self.compile_lock:
+            if self._compiled_decode_step is None:
+                self._compiled_decode_step = torch.compile(self._decode_step, dynamic=False)
+        return self._compiled_decode_step
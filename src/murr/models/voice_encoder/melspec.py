@@ -3,6 +3,9 @@ from functools import lru_cache
 from scipy import signal
 import numpy as np
 import librosa
+import torch
+import torch.nn.functional as F
+from torch import nn
 
 
 @lru_cache()
@@ -76,3 +79,84 @@ def _normalize(s, hp, headroom_db=15):
     min_level_db = 20 * np.log10(hp.stft_magnitude_min)
     s = (s - min_level_db) / (-min_level_db + headroom_db)
     return s
+
+
+@lru_cache()
+def _mel_basis_torch(hp, device):
+    return torch.from_numpy(mel_basis(hp)).float().to(device)
+
+
+def melspectrogram_batch(wavs: torch.Tensor, wav_lens: torch.Tensor, hp):
+    """
+    Torch version of `melspectrogram` for a batch: `wavs` is (B, N) right-padded, `wav_lens` the true lengths.
+    Returns (B, T, M) mels, zero past each clip's `1 + len // hop_size` frames, and those frame counts.
+
+    Each clip is reflect-padded at its own end (as `librosa.stft(center=True)` would) before batching, so the
+    frames match `melspectrogram` on each clip alone.
+    """
+    wav_lens = torch.as_tensor(wav_lens).tolist()
+    if hp.preemphasis > 0:
+        wavs = torch.cat([wavs[:, :1], wavs[:, 1:] - hp.preemphasis * wavs[:, :-1]], dim=1).clamp(-1, 1)
+
+    half = hp.n_fft // 2
+    padded = [
+        F.pad(wav[None, None, :n], (half, half), mode="reflect")[0, 0]
+        for wav, n in zip(wavs, wav_lens)
+    ]
+    padded = nn.utils.rnn.pad_sequence(padded, batch_first=True)
+    spec = torch.stft(
+        padded,
+        n_fft=hp.n_fft,
+        hop_length=hp.hop_size,
+        win_length=hp.win_size,
+        window=torch.hann_window(hp.win_size, device=wavs.device),
+        center=False,
+        return_complex=True,
+    )
+    mel = _spec_to_mel(spec, hp)  # (B, M, T)
+
+    mel_lens = torch.tensor([1 + n // hp.hop_size for n in wav_lens])
+    mel = mel.transpose(1, 2)[:, :int(mel_lens.max())]
+    mel = mel * (torch.arange(mel.size(1), device=mel.device)[None, :, None] < mel_lens.to(mel.device)[:, None, None])
+    return mel, mel_lens
+
+
+def _spec_to_mel(spec: torch.Tensor, hp):
+    "The rest of `melspectrogram` from a complex (..., F, T) STFT: magnitudes, mel, db and normalization."
+    if hp.mel_power == 2.0:
+        spec_magnitudes = spec.real.square() + spec.imag.square()  # |spec|^2 without the square root
+    else:
+        spec_magnitudes = spec.abs() ** hp.mel_power
+
+    mel = _mel_basis_torch(hp, spec.device) @ spec_magnitudes
+    if hp.mel_type == "db":
+        mel = 20 * torch.log10(mel.clamp(min=hp.stft_magnitude_min))
+    if hp.normalized_mels:
+        min_level_db = 20 * np.log10(hp.stft_magnitude_min)
+        mel = (mel - min_level_db) / (-min_level_db + 15)
+    return mel
+
+
+def trim_silence_batch(wavs: torch.Tensor, wav_lens, top_db: float, frame_length=2048, hop_length=512):
+    """
+    Torch version of `librosa.effects.trim` for a right-padded batch: the (start, end) sample range of each clip
+    once leading and trailing frames quieter than `top_db` below its loudest frame are cut.
+    """
+    wav_lens = torch.as_tensor(wav_lens, device=wavs.device)
+    # frame RMS, centered with zero padding (the batch padding is zeros too)
+    padded = F.pad(wavs, (frame_length // 2, frame_length // 2))
+    rms = F.avg_pool1d(padded[:, None].square(), frame_length, hop_length)[:, 0].sqrt()
+    valid = torch.arange(rms.size(1), device=wavs.device)[None] < (1 + wav_lens // hop_length)[:, None]
+
+    db = 20 * torch.log10(rms.clamp(min=1e-5))
+    ref_db = 20 * torch.log10(rms.masked_fill(~valid, 0).amax(dim=1, keepdim=True).clamp(min=1e-5))
+    non_silent = ((db - ref_db) > -top_db) & valid
+
+    ranges = []
+    for row, n in zip(non_silent, wav_lens.tolist()):
+        nonzero = row.nonzero()[:, 0]
+        if nonzero.numel() == 0:
+            ranges.append((0, 0))
+        else:
+            ranges.append((int(nonzero[0]) * hop_length, min(n, (int(nonzero[-1]) + 1) * hop_length)))
+    return ranges
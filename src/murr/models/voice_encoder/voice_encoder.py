@@ -7,10 +7,11 @@ from numpy.lib.stride_tricks import as_strided
 import librosa
 import torch
 import torch.nn.functional as F
+import torchaudio
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import melspectrogram_batch, trim_silence_batch, _spec_to_mel
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -253,7 +254,7 @@ class VoiceEncoder(nn.Module):
         **kwargs
     ):
         """
-        Wrapper around embeds_from_mels
+        Wrapper around embeds_from_wav_batch for a list of numpy waveforms, returning numpy embeddings.
 
         :param trim_top_db: this argument was only added for the sake of compatibility with metavoice's implementation
         """
@@ -263,12 +264,169 @@ class VoiceEncoder(nn.Module):
                 for wav in wavs
             ]
 
+        wavs = [torch.from_numpy(np.asarray(wav, dtype=np.float32)) for wav in wavs]
+        embeds = self.embeds_from_wav_batch(wavs, self.hp.sample_rate, batch_size=batch_size, trim_top_db=trim_top_db, **kwargs)
+        embeds = embeds.numpy()
+        return self.utt_to_spk_embed(embeds) if as_spk else embeds
+
+    def embeds_from_wav_batch(
+        self,
+        wavs: Union[Tensor, List[Tensor]],
+        sample_rate,
+        wav_lens=None,
+        batch_size=32,
+        trim_top_db: Optional[float]=20,
+        **kwargs
+    ) -> Tensor:
+        """
+        Utterance embeddings of a batch of waveforms, all in torch on the model's device: silence trimming
+        (`trim_silence_batch`), mels (`melspectrogram_batch`, matching `melspectrogram`) and `inference`.
+
+        :param wavs: a (B, N) right-padded tensor with `wav_lens`, or a list of 1-D tensors
+        :returns: (B, E) embeddings on CPU
+        """
+        if isinstance(wavs, (list, tuple)):
+            wav_lens = [wav.numel() for wav in wavs]
+            wavs = nn.utils.rnn.pad_sequence([wav.view(-1).float() for wav in wavs], batch_first=True)
+        elif wav_lens is None:
+            wav_lens = [wavs.size(1)] * wavs.size(0)
+        wavs = wavs.to(self.device)
+        wav_lens = torch.as_tensor(wav_lens).tolist()
+
+        if sample_rate != self.hp.sample_rate:
+            wavs = torchaudio.functional.resample(wavs, sample_rate, self.hp.sample_rate)
+            wav_lens = [n * self.hp.sample_rate // sample_rate for n in wav_lens]
+
         if trim_top_db:
-            wavs = [librosa.effects.trim(wav, top_db=trim_top_db)[0] for wav in wavs]
+            ranges = trim_silence_batch(wavs, wav_lens, top_db=trim_top_db)
+            trimmed = [wav[start:end] for wav, (start, end) in zip(wavs, ranges)]
+            wav_lens = [end - start for start, end in ranges]
+            wavs = nn.utils.rnn.pad_sequence(trimmed, batch_first=True)
 
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        with torch.inference_mode():
+            mels, mel_lens = melspectrogram_batch(wavs, wav_lens, self.hp)
+            return self.inference(mels, mel_lens, batch_size=batch_size, **kwargs)
 
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+    def stream_session(self, overlap=0.5, rate: float=1.3, min_coverage=0.8, batch_size=32) -> "VoiceEncoderStream":
+        """
+        Start embedding one (arbitrarily long) recording incrementally: push audio chunks to the session and read
+        the running speaker embedding at any point (see `VoiceEncoderStream`).
+        """
+        return VoiceEncoderStream(self, overlap=overlap, rate=rate, min_coverage=min_coverage, batch_size=batch_size)
+
+
+class VoiceEncoderStream:
+    """
+    Incremental, constant-memory speaker embedding of a single recording, e.g. an hour of reference audio for an
+    averaged speaker profile.
+
+    Pushed samples become mel frames as soon as a full STFT window is available (with the same reflect padding at
+    both ends as `melspectrogram`), mel frames are cut into partials at the same step as `inference`, and partials
+    go through the LSTM `batch_size` at a time. Only a running sum of the L2-normalized partial embeddings is kept,
+    plus less than one STFT window of samples, one partial of mel frames and `batch_size` pending partials, however
+    long the recording.
+
+    Once finalized, `embedding()` matches `inference` on the mel of the whole recording (that is,
+    `embeds_from_wav_batch` with `trim_top_db=None`: silence trimming needs the whole signal and is not applied).
+    """
+
+    def __init__(self, ve: VoiceEncoder, overlap=0.5, rate: float=None, min_coverage=0.8, batch_size=32):
+        hp = ve.hp
+        self.ve = ve
+        self.hp = hp
+        self.frame_step = get_frame_step(overlap, rate, hp)
+        self.min_coverage = min_coverage
+        self.batch_size = batch_size
+        self.window = torch.hann_window(hp.win_size, device=ve.device)
+
+        self.samples = torch.zeros(0, device=ve.device)  # samples not framed yet (and the overlap of the next frame)
+        self.started = False  # whether the start of the signal was reflect-padded
+        self.last_sample = 0.  # for pre-emphasis across chunks
+        self.mels = torch.zeros(0, hp.num_mels, device=ve.device)  # mel frames from the next partial on
+        self.n_frames = 0
+        self.n_partials = 0
+        self.pending = []  # partials waiting for the LSTM
+        self.embed_sum = torch.zeros(hp.speaker_embed_size)
+        self.finished = False
+
+    @torch.inference_mode()
+    def push(self, wav: Union[np.ndarray, Tensor], finalize: bool = False):
+        """
+        Add a chunk of mono audio at `hp.sample_rate` (the chunks may have any length). Pass `finalize=True` with
+        the last chunk (possibly empty) to pad the end of the recording and embed its last partials.
+        """
+        assert not self.finished, "the stream was already finalized"
+        wav = torch.as_tensor(wav, dtype=torch.float32).view(-1).to(self.samples.device)
+        if self.hp.preemphasis > 0 and wav.numel():
+            prev = torch.cat([wav.new_tensor([self.last_sample]), wav[:-1]])
+            self.last_sample = float(wav[-1])
+            wav = (wav - self.hp.preemphasis * prev).clamp(-1, 1)
+        self.samples = torch.cat([self.samples, wav])
+
+        half = self.hp.n_fft // 2
+        if not self.started and (finalize or self.samples.numel() > half):
+            self.samples = F.pad(self.samples[None, None], (half, 0), mode="reflect")[0, 0]
+            self.started = True
+        if finalize:
+            self.samples = F.pad(self.samples[None, None], (0, half), mode="reflect")[0, 0]
+            self.finished = True
+
+        if self.samples.numel() >= self.hp.n_fft:
+            self._add_frames()
+        if finalize:
+            self._add_last_partials()
+        if len(self.pending) >= self.batch_size or (finalize and self.pending):
+            self._embed_pending()
+
+    def embedding(self) -> Optional[np.ndarray]:
+        """
+        The L2-normalized (E,) speaker embedding of the partials seen so far (of the whole recording once
+        finalized), or `None` before the first partial is complete.
+        """
+        if self.pending:
+            with torch.inference_mode():
+                self._embed_pending()
+        if self.n_partials == 0:
+            return None
+        return (self.embed_sum / torch.linalg.norm(self.embed_sum)).numpy()
+
+    def _add_frames(self):
+        hp = self.hp
+        spec = torch.stft(
+            self.samples,
+            n_fft=hp.n_fft,
+            hop_length=hp.hop_size,
+            win_length=hp.win_size,
+            window=self.window,
+            center=False,
+            return_complex=True,
+        )
+        mel = _spec_to_mel(spec, hp).T  # (T, M)
+        self.samples = self.samples[mel.size(0) * hp.hop_size:]
+        self.n_frames += mel.size(0)
+        self.mels = torch.cat([self.mels, mel])
+
+        # Cut the full partials
+        while self.mels.size(0) >= hp.ve_partial_frames:
+            self.pending.append(self.mels[:hp.ve_partial_frames])
+            self.mels = self.mels[self.frame_step:]
+            self.n_partials += 1
+            if len(self.pending) >= self.batch_size:
+                self._embed_pending()
+
+    def _add_last_partials(self):
+        # Zero-padded partials at the end, as many as `inference` would make for this length
+        n_wins, _ = get_num_wins(self.n_frames, self.frame_step, self.min_coverage, self.hp)
+        for _ in range(n_wins - self.n_partials):
+            partial = self.mels[:self.hp.ve_partial_frames]
+            self.pending.append(F.pad(partial, (0, 0, 0, self.hp.ve_partial_frames - partial.size(0))))
+            self.mels = self.mels[self.frame_step:]
+            self.n_partials += 1
+
+    def _embed_pending(self):
+        partial_embeds = self.ve(torch.stack(self.pending))
+        self.embed_sum += partial_embeds.sum(dim=0).cpu()
+        self.pending = []
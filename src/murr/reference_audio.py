@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+
+import librosa
+import torch
+from torch import Tensor
+
+from .models.s3tokenizer import S3_SR
+from .models.s3gen import S3GEN_SR
+from .models.s3gen.s3gen import get_resampler
+
+
+@dataclass
+class ReferenceAudio:
+    """
+    A reference clip decoded once and resampled once per rate the voice front end needs:
+        - `wav_24k`: S3Gen's prompt mel (`prompt_feat`),
+        - `wav_16k`: the S3 tokenizer, CAMPPlus and the VoiceEncoder.
+
+    Both come straight from the decoded signal with cached torchaudio kernels (`get_resampler`), rather than
+    24 kHz -> 16 kHz in librosa and then again in `S3Gen.embed_ref`.
+    """
+    wav_24k: Tensor  # (1, N)
+    wav_16k: Tensor  # (1, N)
+
+    @classmethod
+    def load(cls, wav_fpath, device="cpu") -> "ReferenceAudio":
+        wav, sr = librosa.load(wav_fpath, sr=None)  # mono, native rate
+        return cls.from_wav(torch.from_numpy(wav).float()[None], sr, device=device)
+
+    @classmethod
+    def load_any(cls, source, device="cpu") -> "ReferenceAudio":
+        "`load` for a path, `from_wav` for a `(wav, sample_rate)` pair."
+        if isinstance(source, (tuple, list)):
+            wav, sr = source
+            return cls.from_wav(torch.as_tensor(wav).float(), sr, device=device)
+        return cls.load(source, device=device)
+
+    @classmethod
+    def from_wav(cls, wav: Tensor, sr: int, device="cpu") -> "ReferenceAudio":
+        wav = torch.atleast_2d(wav).to(device)
+        return cls(wav_24k=_resample(wav, sr, S3GEN_SR), wav_16k=_resample(wav, sr, S3_SR))
+
+    def head(self, seconds: float) -> "ReferenceAudio":
+        "The first `seconds` of the clip, at both rates."
+        return ReferenceAudio(
+            wav_24k=self.wav_24k[:, :int(seconds * S3GEN_SR)],
+            wav_16k=self.wav_16k[:, :int(seconds * S3_SR)],
+        )
+
+
+def _resample(wav: Tensor, src_sr: int, dst_sr: int) -> Tensor:
+    if src_sr == dst_sr:
+        return wav
+    with torch.no_grad():
+        return get_resampler(src_sr, dst_sr, wav.device)(wav)
@@ -1,23 +1,37 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+import copy
+import hashlib
 import os
+import queue
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import librosa
+import numpy as np
 import torch
 import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.t3 import T3
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.s3tokenizer import S3_SR, S3_TOKEN_HOP, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.scheduler import T3Scheduler
+from .audio_cache import AudioCache
+from .reference_audio import ReferenceAudio
 
 
 REPO_ID = "DisMurr/murr-voice"
 
+# guards every `Conditionals.t3_prefix`: request-scoped copies of a voice share its cache across threads
+_t3_prefix_lock = threading.Lock()
+
 
 def punc_norm(text: str) -> str:
     """
@@ -61,6 +75,80 @@ def punc_norm(text: str) -> str:
     return text
 
 
+def split_sentences(text: str, max_chars: int = 250) -> List[Tuple[str, bool]]:
+    """
+    Split long-form text into segments for synthesis: paragraphs (separated by blank lines) are normalized with
+    `punc_norm` and cut after each ".", "!" or "?". Consecutive sentences of a paragraph are then packed into
+    segments of up to `max_chars` characters; a longer sentence is cut at its commas.
+
+    Returns (segment, ends_paragraph) pairs, in reading order.
+    """
+    segments = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if not paragraph.strip():
+            continue
+        pieces = []
+        for sentence in re.split(r"(?<=[.!?])\s+", punc_norm(paragraph)):
+            if len(sentence) <= max_chars:
+                pieces.append(sentence)
+            else:
+                pieces.extend(_pack(re.split(r"(?<=,)\s+", sentence), max_chars))
+        packed = _pack(pieces, max_chars)
+        segments.extend((segment, i == len(packed) - 1) for i, segment in enumerate(packed))
+    return segments
+
+
+def _pack(pieces: List[str], max_chars: int) -> List[str]:
+    "Greedily join consecutive pieces with spaces, as long as the result fits in `max_chars`."
+    packed = []
+    for piece in pieces:
+        if packed and len(packed[-1]) + 1 + len(piece) <= max_chars:
+            packed[-1] += " " + piece
+        else:
+            packed.append(piece)
+    return packed
+
+
+def _join_segments(segments: Iterable[Tuple[torch.Tensor, int]], n_fade: int) -> Iterator[torch.Tensor]:
+    """
+    Join (1, N) waveforms into one stream. Each comes with the number of silent samples to put before it: with a
+    pause, the previous segment fades out and the next one fades in over `n_fade` samples; without one, the two
+    are crossfaded over `n_fade` samples. Yields the joined audio piece by piece, holding back only the fade tail.
+    """
+    tail = None
+    for wav, n_pause in segments:
+        wav = wav.clone()
+        if tail is not None:
+            n = min(n_fade, tail.size(1), wav.size(1))
+            window = torch.hann_window(2 * n, periodic=True, dtype=wav.dtype)  # the two halves sum to one
+            fade_in, fade_out = window[:n], window[n:]
+            if n_pause > 0:
+                tail[:, tail.size(1) - n:] *= fade_out
+                yield tail
+                yield wav.new_zeros(1, n_pause)
+                wav[:, :n] *= fade_in
+            else:
+                yield tail[:, :tail.size(1) - n]
+                wav[:, :n] = wav[:, :n] * fade_in + tail[:, tail.size(1) - n:] * fade_out
+        n_tail = min(n_fade, wav.size(1))
+        yield wav[:, :wav.size(1) - n_tail]
+        tail = wav[:, wav.size(1) - n_tail:]
+    if tail is not None:
+        yield tail
+
+
+def _sanitize_cfg_weight(cfg_weight) -> float:
+    # Ensure cfg_weight is a float
+    if cfg_weight is None:
+        cfg_weight = 0.5
+    try:
+        cfg_weight = float(cfg_weight)
+    except (TypeError, ValueError):
+        cfg_weight = 0.5
+    # Keep within a reasonable range; T3 expects a float weight (0 disables CFG)
+    return max(0.0, min(2.0, cfg_weight))
+
+
 @dataclass
 class Conditionals:
     """
@@ -77,12 +165,18 @@ class Conditionals:
         - prompt_feat
         - prompt_feat_len
         - embedding
+
+    `t3_prefix` caches the T3 KV of the conditioning prefix per exaggeration (see `T3.prefill_conditioning`),
+    least recently used first out past `MurrTTS.T3_PREFIX_CACHE_SIZE` entries; it is rebuilt on demand and never
+    saved.
     """
     t3: T3Cond
     gen: dict
+    t3_prefix: "OrderedDict[float, object]" = field(default_factory=OrderedDict, repr=False, compare=False)
 
     def to(self, device):
         self.t3 = self.t3.to(device=device)
+        self.t3_prefix.clear()
         for k, v in self.gen.items():
             if torch.is_tensor(v):
                 self.gen[k] = v.to(device=device)
@@ -90,11 +184,30 @@ class Conditionals:
 
     def save(self, fpath: Path):
         arg_dict = dict(
-            t3=self.t3.__dict__,
+            t3=self.t3.saved_fields(),
             gen=self.gen
         )
         torch.save(arg_dict, fpath)
 
+    def fingerprint(self) -> str:
+        """
+        Content hash of the voice: every conditional except `emotion_adv`, which is set per request. Used to key
+        the `AudioCache`.
+        """
+        h = hashlib.sha256()
+        t3_fields = self.t3.saved_fields()
+        t3_fields.pop("emotion_adv", None)
+        if t3_fields.get("cond_prompt_speech_tokens") is not None:
+            t3_fields.pop("cond_prompt_speech_emb", None)  # derived from the tokens by T3
+        items = [(f"t3.{k}", v) for k, v in sorted(t3_fields.items())]
+        items += [(f"gen.{k}", v) for k, v in sorted(self.gen.items())]
+        for name, value in items:
+            h.update(name.encode())
+            if torch.is_tensor(value):
+                value = value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+            h.update(value.tobytes() if isinstance(value, np.ndarray) else repr(value).encode())
+        return h.hexdigest()
+
     @classmethod
     def load(cls, fpath, map_location="cpu"):
         if isinstance(map_location, str):
@@ -106,6 +219,7 @@ class Conditionals:
 class MurrTTS:
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
+    T3_PREFIX_CACHE_SIZE = 4  # conditioning-prefix KVs kept per voice (one per exaggeration), several MB each
 
     def __init__(
         self,
@@ -123,10 +237,18 @@ class MurrTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.t3_scheduler: T3Scheduler | None = None
+        self.audio_cache: AudioCache | None = None
+        self.voices = None  # VoiceRegistry, see `use_voice_registry`
     # watermarking removed
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'MurrTTS':
+    def from_local(cls, ckpt_dir, device, t3_quant=None) -> 'MurrTTS':
+        """
+        Args:
+            t3_quant: optional weight-only quantization of the T3 backbone, "int8" or "int4" (CPU serving,
+                see `T3.quantize`). `None` keeps the full-precision weights.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -151,6 +273,8 @@ class MurrTTS:
             # Handle case where t3_state is a tensor
             t3.load_state_dict({"weight": t3_state})
         t3.to(device).eval()
+        if t3_quant is not None:
+            t3.quantize(t3_quant)
 
         s3gen = S3Gen()
         s3gen.load_state_dict(
@@ -172,7 +296,7 @@ class MurrTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'MurrTTS':
+    def from_pretrained(cls, device, t3_quant=None) -> 'MurrTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -184,7 +308,7 @@ class MurrTTS:
         # Prefer local weights if available
         ckpt_dir = Path(os.getenv("MURR_WEIGHTS_DIR", "weights"))
         if ckpt_dir.exists():
-            return cls.from_local(ckpt_dir, device)
+            return cls.from_local(ckpt_dir, device, t3_quant=t3_quant)
 
         local_path = None
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
@@ -192,34 +316,233 @@ class MurrTTS:
 
         if local_path is None:
             raise RuntimeError("Failed to download any model files")
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, t3_quant=t3_quant)
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        self.conds = self.compute_conditionals(wav_fpath, exaggeration=exaggeration)
+
+    def compute_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        """
+        The `Conditionals` of the reference clip `wav_fpath`, without making it the prepared voice.
+
+        The clip is decoded once and resampled once per rate (`ReferenceAudio`). The T3 speech prompt is the head
+        of the S3Gen prompt tokens, so the S3 tokenizer runs once.
+        """
+        ref = ReferenceAudio.load(wav_fpath, device=self.device)
+        return self._conditionals_from_refs([ref], exaggeration=exaggeration)[0]
+
+    def _conditionals_from_refs(self, refs: List[ReferenceAudio], exaggeration=0.5, batch_size=16) -> List[Conditionals]:
+        """The `Conditionals` of several reference clips, with every model stage run on the whole batch."""
+        dec_refs = [ref.head(self.DEC_COND_LEN / S3GEN_SR) for ref in refs]
+        s3gen_ref_dicts = self.s3gen.embed_refs(
+            [ref.wav_24k for ref in dec_refs],
+            [ref.wav_16k for ref in dec_refs],
+            device=self.device,
+            batch_size=batch_size,
+        )
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+        # Voice-encoder speaker embeddings, one row per clip
+        ve_embeds = self.ve.embeds_from_wavs([ref.wav_16k[0].cpu().numpy() for ref in refs], sample_rate=S3_SR)
+        ve_embeds = torch.from_numpy(ve_embeds).to(self.device)
+
+        conds = []
+        for s3gen_ref_dict, ve_embed in zip(s3gen_ref_dicts, ve_embeds):
+            # Speech cond prompt tokens: the first ENC_COND_LEN of the reference
+            t3_cond_prompt_tokens = None
+            if plen := self.t3.hp.speech_cond_prompt_len:
+                n_tokens = min(plen, self.ENC_COND_LEN // S3_TOKEN_HOP)
+                t3_cond_prompt_tokens = torch.atleast_2d(s3gen_ref_dict["prompt_token"][..., :n_tokens]).to(self.device)
+
+            t3_cond = T3Cond(
+                speaker_emb=ve_embed[None],
+                cond_prompt_speech_tokens=t3_cond_prompt_tokens,
+                emotion_adv=exaggeration * torch.ones(1, 1, 1),
+            ).to(device=self.device)
+            conds.append(Conditionals(t3_cond, s3gen_ref_dict))
+        return conds
+
+    def for_worker(self) -> 'MurrTTS':
+        """
+        A shallow copy for one worker thread: the same modules (not a replica of the weights), scheduler, audio
+        cache and voice registry, with its own prepared voice. See `WorkerPool`.
+        """
+        return copy.copy(self)
+
+    def use_voice_registry(self, registry):
+        """Serve enrolled voices (`voice_id=...`) from `registry`, a `VoiceRegistry` that `MurrVC` can share."""
+        self.voices = registry
+        return registry
+
+    def enroll_voice(self, wav_fpath, voice_id=None) -> str:
+        """
+        Compute the `Conditionals` of the reference clip `wav_fpath` once and store them in the voice registry.
+        Returns the `voice_id` to pass to `generate` (by default a hash of the file, so re-enrolling is free).
+        """
+        assert self.voices is not None, "Please `use_voice_registry` first"
+        if voice_id is None:
+            voice_id = self.voices.voice_id_for(wav_fpath)
+            if voice_id in self.voices:
+                return voice_id
+        self.voices.add(voice_id, self.compute_conditionals(wav_fpath))
+        self.voices.save_index()
+        return voice_id
+
+    def enroll_voices(self, sources, voice_ids=None, batch_size=16) -> List[str]:
+        """
+        Enroll many reference clips into the voice registry: `sources` are paths or `(wav, sample_rate)` pairs.
+        Returns their `voice_id`s, in order; with the default ids (content hashes), voices already enrolled are
+        skipped.
+
+        Clips go through the models `batch_size` at a time, and the next batch is decoded and resampled in a
+        background thread while the current one is embedded.
+        """
+        assert self.voices is not None, "Please `use_voice_registry` first"
+        sources = list(sources)
+        if voice_ids is None:
+            voice_ids = [self.voices.voice_id_for(source) for source in sources]
+            todo = [i for i, voice_id in enumerate(voice_ids) if voice_id not in self.voices]
+        else:
+            assert len(voice_ids) == len(sources), "need exactly one voice_id per source"
+            todo = list(range(len(sources)))
+        todo = list({voice_ids[i]: i for i in todo}.values())  # the same clip twice is enrolled once
+
+        def load(batch):
+            return [ReferenceAudio.load_any(sources[i], device=self.device) for i in batch]
+
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            next_refs = loader.submit(load, batches[0]) if batches else None
+            for n, batch in enumerate(batches):
+                refs = next_refs.result()
+                if n + 1 < len(batches):
+                    next_refs = loader.submit(load, batches[n + 1])
+                with torch.inference_mode():
+                    conds = self._conditionals_from_refs(refs, batch_size=batch_size)
+                for i, c in zip(batch, conds):
+                    self.voices.add(voice_ids[i], c)
+        if todo:
+            self.voices.save_index()
+        return voice_ids
+
+    def _voice(self, voice_id) -> Conditionals:
+        assert self.voices is not None, "Please `use_voice_registry` first"
+        return self.voices.get(voice_id)
+
+    def enable_continuous_batching(self, max_batch_size=16) -> T3Scheduler:
+        """
+        Route the T3 decoding of all `generate` calls through one shared continuous-batching loop, so concurrent
+        callers (e.g. API worker threads) decode together instead of one after another.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3Scheduler(self.t3, max_batch_size=max_batch_size).start()
+        return self.t3_scheduler
+
+    def enable_audio_cache(self, max_bytes=256 * 2**20, cache_dir=None) -> AudioCache:
+        """
+        Cache the audio of seeded generations (`seed=...`): whole requests in `generate`, sentence segments in
+        `generate_long_stream`. Concurrent identical `generate` calls are synthesized once. See `AudioCache`.
+        """
+        if self.audio_cache is None:
+            self.audio_cache = AudioCache(max_bytes=max_bytes, cache_dir=cache_dir)
+        return self.audio_cache
+
+    def _generator(self, seed: Optional[int]) -> Optional[torch.Generator]:
+        """A fresh RNG for one utterance, or `None` (global RNG) when unseeded."""
+        if seed is None:
+            return None
+        return torch.Generator(device=self.device).manual_seed(int(seed))
+
+    def _cache_key(self, kind: str, text: str, conds: Conditionals, seed: int, decode: str, **params) -> str:
+        """
+        `AudioCache` key: everything a seeded utterance depends on, including the T3 `decode` path (the
+        scheduler's left-padded batches, `T3.inference` on the shared CFG prefix, or `T3.inference_batch`),
+        which agree in distribution but not bit for bit.
+        """
+        return AudioCache.make_key(
+            kind=kind,
+            text=punc_norm(text),
+            voice=conds.fingerprint(),
+            seed=int(seed),
+            decode=decode,
+            t3_quant=getattr(self.t3, "quant_mode", None),
+            **{k: float(v) for k, v in params.items()},
+        )
+
+    def _request_conds(self, exaggeration, audio_prompt_path=None, voice_id=None) -> Optional[Conditionals]:
+        """
+        The voice of one request at `exaggeration`: the enrolled `voice_id`, the clip at `audio_prompt_path`, or
+        else the prepared voice (`None` if there is none). Nothing is written back to the model or the registry;
+        a different exaggeration gives a copy that still shares the voice's T3 caches.
+        """
+        if voice_id is not None:
+            conds = self._voice(voice_id)
+        elif audio_prompt_path:
+            conds = self.compute_conditionals(audio_prompt_path, exaggeration=exaggeration)
+        else:
+            conds = self.conds
+        if conds is None:
+            return None
+        t3_cond = self._update_exaggeration(conds.t3, exaggeration)
+        if t3_cond is conds.t3:
+            return conds
+        return Conditionals(t3_cond, conds.gen, t3_prefix=conds.t3_prefix)
+
+    def _update_exaggeration(self, t3_cond: T3Cond, exaggeration) -> T3Cond:
+        """Return `t3_cond` with its emotion_adv set to `exaggeration`, rebuilding it only if the value changed."""
+        emotion_adv = t3_cond.emotion_adv
+        if emotion_adv is None:
+            return t3_cond
+        current = float(emotion_adv.view(-1)[0]) if torch.is_tensor(emotion_adv) else float(emotion_adv)
+        if exaggeration == current:
+            return t3_cond
+        if t3_cond.cond_voice_emb is None:
+            # cache the voice embedding on the shared cond, so every copy below reuses it
+            with torch.inference_mode():
+                self.t3.prepare_conditioning(t3_cond)
+        return t3_cond.with_emotion_adv(exaggeration * torch.ones(1, 1, 1, device=self.device))
+
+    def _cond_prefix(self, conds: Conditionals, exaggeration):
+        """T3 KV for the conditioning prefix of `conds` at this exaggeration, computed on first use."""
+        key = float(exaggeration)
+        with _t3_prefix_lock:  # the cache is shared by every request on this voice
+            cond_prefix = conds.t3_prefix.get(key)
+            if cond_prefix is not None:
+                conds.t3_prefix.move_to_end(key)
+                return cond_prefix
+        cond_prefix = self.t3.prefill_conditioning(conds.t3)
+        with _t3_prefix_lock:
+            conds.t3_prefix[key] = cond_prefix
+            while len(conds.t3_prefix) > self.T3_PREFIX_CACHE_SIZE:
+                conds.t3_prefix.popitem(last=False)
+        return cond_prefix
+
+    def _tokenize_text(self, text) -> torch.Tensor:
+        """Normalize and tokenize `text`, wrapped in start / stop text tokens: (1, L)."""
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(torch.from_numpy(s3gen_ref_wav), S3GEN_SR, device=self.device)
+    def _tokens_to_wav(self, speech_tokens, ref_dict, generator=None) -> torch.Tensor:
+        """Clean up one row of T3 speech tokens and vocode it with S3Gen: (1, N) waveform on CPU."""
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
 
-        # Speech cond prompt tokens
-        t3_cond_prompt_tokens = None
-        if plen := self.t3.hp.speech_cond_prompt_len:
-            s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward(torch.from_numpy(ref_16k_wav[:self.ENC_COND_LEN]).unsqueeze(0), max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
+        speech_tokens = speech_tokens[speech_tokens < 6561]
 
-        # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-        ve_embed = ve_embed.mean(dim=0, keepdim=True).to(self.device)
+        speech_tokens = speech_tokens.to(self.device)
 
-        t3_cond = T3Cond(
-            speaker_emb=ve_embed,
-            cond_prompt_speech_tokens=t3_cond_prompt_tokens,
-            emotion_adv=exaggeration * torch.ones(1, 1, 1),
-        ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=ref_dict,
+            generator=generator,
+        )
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        return torch.from_numpy(wav).unsqueeze(0)
 
     def generate(
         self,
@@ -231,52 +554,168 @@ class MurrTTS:
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        seed=None,
+        voice_id=None,
     ):
-        # Ensure cfg_weight is a float
-        if cfg_weight is None:
-            cfg_weight = 0.5
+        """
+        Synthesize `text` with the prepared voice (or the one in `audio_prompt_path`, or the enrolled `voice_id`):
+        a (1, N) waveform. The voice is used for this call only (see `_request_conds`), so concurrent calls can
+        use different voices.
+
+        With a `seed`, T3 sampling and the S3Gen source noise use their own seeded RNGs, so the same request
+        gives the same audio within one serving configuration (with or without `enable_continuous_batching`,
+        whose batched decode differs numerically); if `enable_audio_cache` was called, the result is also cached and concurrent
+        identical requests are synthesized once.
+        """
+        cfg_weight = _sanitize_cfg_weight(cfg_weight)
+
+        conds = self._request_conds(exaggeration, audio_prompt_path=audio_prompt_path, voice_id=voice_id)
+        assert conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+
+        # Norm and tokenize text. CFG rows are duplicated inside `T3.inference`.
+        text_tokens = self._tokenize_text(text)
+
+        def synthesize():
+            with torch.inference_mode():
+                if conds is None:
+                    raise ValueError("Conditionals not initialized. Call prepare_conditionals first.")
+
+                if self.t3_scheduler is not None:
+                    speech_tokens = self.t3_scheduler.submit(
+                        t3_cond=conds.t3,
+                        text_tokens=text_tokens[0],
+                        max_new_tokens=1000,  # TODO: use the value in config
+                        temperature=temperature,
+                        cfg_weight=cfg_weight,
+                        repetition_penalty=repetition_penalty,
+                        min_p=min_p,
+                        top_p=top_p,
+                        generator=self._generator(seed),
+                    ).result()
+                else:
+                    speech_tokens = self.t3.inference(
+                        t3_cond=conds.t3,
+                        cond_prefix=self._cond_prefix(conds, exaggeration),
+                        text_tokens=text_tokens,
+                        max_new_tokens=1000,  # TODO: use the value in config
+                        temperature=temperature,
+                        cfg_weight=cfg_weight,
+                        repetition_penalty=repetition_penalty,
+                        min_p=min_p,
+                        top_p=top_p,
+                        generator=self._generator(seed),
+                    )
+                    # Extract only the conditional batch.
+                    speech_tokens = speech_tokens[0]
+
+                return self._tokens_to_wav(speech_tokens, conds.gen, generator=self._generator(seed))
+
+        if seed is None or self.audio_cache is None or conds is None:
+            return synthesize()
+        key = self._cache_key(
+            "request", text, conds, seed,
+            decode="direct" if self.t3_scheduler is None else "scheduler",
+            exaggeration=exaggeration,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+        )
+        return self.audio_cache.get_or_compute(key, synthesize)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        chunk_size=25,
+        seed=None,
+        voice_id=None,
+    ):
+        """
+        Streaming `generate`: a generator of (1, N) waveform chunks on CPU, yielded as soon as S3Gen can vocode
+        them. T3 hands over its speech tokens every `chunk_size` tokens (`T3.inference_stream`), and S3Gen decodes
+        them incrementally (`S3Gen.stream_session`), so the first audio arrives after about `chunk_size` tokens
+        instead of after the whole utterance.
+
+        Decoding runs in the caller's thread, outside the continuous-batching scheduler. Closing the generator
+        stops synthesis. A `seed` makes the stream reproducible; chunked vocoding does not give exactly the same
+        samples as `generate`, so streams are not cached.
+        """
+        cfg_weight = _sanitize_cfg_weight(cfg_weight)
+
+        conds = self._request_conds(exaggeration, audio_prompt_path=audio_prompt_path, voice_id=voice_id)
+        if conds is None:
+            raise ValueError("Conditionals not initialized. Call prepare_conditionals first.")
+
+        text_tokens = self._tokenize_text(text)
+        token_stream = self.t3.inference_stream(
+            chunk_size=chunk_size,
+            t3_cond=conds.t3,
+            cond_prefix=self._cond_prefix(conds, exaggeration),
+            text_tokens=text_tokens,
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            generator=self._generator(seed),
+        )
+        session = self.s3gen.stream_session(ref_dict=conds.gen, generator=self._generator(seed))
         try:
-            cfg_weight = float(cfg_weight)
-        except (TypeError, ValueError):
-            cfg_weight = 0.5
-        # Keep within a reasonable range; T3 expects a float weight (0 disables CFG)
-        cfg_weight = max(0.0, min(2.0, cfg_weight))
-        
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            for speech_tokens in token_stream:
+                wav = session.push(speech_tokens)
+                if wav.numel() > 0:
+                    yield wav.cpu()
+            wav = session.push(text_tokens.new_zeros(0), finalize=True)
+            if wav.numel() > 0:
+                yield wav.cpu()
+        finally:
+            token_stream.close()
+
+    def generate_batch(
+        self,
+        texts,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        conds=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+    ):
+        """
+        Synthesize several texts with a single batched T3 decode.
+
+        `conds` is either one `Conditionals` shared by all texts or a list with one per text; it defaults to the
+        prepared voice. Returns a list of (1, N) waveforms, in the order of `texts`.
+        """
+        cfg_weight = _sanitize_cfg_weight(cfg_weight)
+
+        if conds is None:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `conds`"
+            conds = self.conds
+
+        if isinstance(conds, (list, tuple)):
+            assert len(conds) == len(texts), "need exactly one Conditionals per text"
+            conds_list = list(conds)
+            t3_cond = [self._update_exaggeration(c.t3, exaggeration) for c in conds_list]
         else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        # Update exaggeration if needed
-        if (self.conds is not None and 
-            self.conds.t3 is not None and 
-            self.conds.t3.emotion_adv is not None and
-            exaggeration != self.conds.t3.emotion_adv[0, 0, 0]):
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+            conds_list = [conds] * len(texts)
+            t3_cond = self._update_exaggeration(conds.t3, exaggeration)
 
-        if cfg_weight > 0.0:
-            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
-
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        text_tokens = [self._tokenize_text(text)[0] for text in texts]
 
         with torch.inference_mode():
-            if self.conds is None:
-                raise ValueError("Conditionals not initialized. Call prepare_conditionals first.")
-            
-            speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
+            speech_tokens = self.t3.inference_batch(
+                t3_cond=t3_cond,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
@@ -285,19 +724,141 @@ class MurrTTS:
                 min_p=min_p,
                 top_p=top_p,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
-
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
+            return [
+                self._tokens_to_wav(tokens, c.gen)
+                for tokens, c in zip(speech_tokens, conds_list)
+            ]
 
-            speech_tokens = speech_tokens.to(self.device)
+    def generate_long(self, text, **kwargs) -> torch.Tensor:
+        """Long-form `generate`: the whole of `generate_long_stream` as one (1, N) waveform."""
+        return torch.cat(list(self.generate_long_stream(text, **kwargs)), dim=1)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+    def generate_long_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        batch_size=4,
+        max_chars=250,
+        pause_ms=150,
+        paragraph_pause_ms=500,
+        crossfade_ms=10,
+        seed=None,
+        voice_id=None,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Synthesize text of any length with the prepared voice (or the enrolled `voice_id`), as a generator of (1, N) waveform pieces.
+
+        The text is cut into sentence segments (`split_sentences`), and T3 decodes them `batch_size` at a time.
+        T3 runs one batch ahead in a background thread, so it decodes batch n+1 while S3Gen vocodes batch n. At
+        most one decoded batch waits for S3Gen, so memory stays bounded whatever the text length. Segments are
+        joined with `pause_ms` of silence (`paragraph_pause_ms` after a paragraph) and `crossfade_ms` fades.
+
+        With a `seed`, every segment gets its own seeded RNGs, so a segment sounds the same whatever text surrounds
+        it; with `enable_audio_cache`, segments already synthesized are then taken from the cache.
+        """
+        cfg_weight = _sanitize_cfg_weight(cfg_weight)
+        conds = self._request_conds(exaggeration, voice_id=voice_id)
+        if conds is None:
+            raise ValueError("Conditionals not initialized. Call prepare_conditionals first.")
+
+        segments = split_sentences(text, max_chars=max_chars)
+        batches = [segments[i:i + batch_size] for i in range(0, len(segments), batch_size)]
+        decode_kwargs = dict(
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+        )
+        use_cache = seed is not None and self.audio_cache is not None
+
+        def cache_key(segment):
+            return self._cache_key(
+                "segment", segment, conds, seed,
+                decode="batch" if self.t3_scheduler is None else "scheduler",
+                exaggeration=exaggeration,
+                **decode_kwargs,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-        return torch.from_numpy(wav).unsqueeze(0)
\ No newline at end of file
+
+        decoded: "queue.Queue" = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    decoded.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def decode_batches():
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        return
+                    # one entry per segment: (ends_paragraph, speech tokens, cached audio, cache key)
+                    keys = [cache_key(segment) if use_cache else None for segment, _ in batch]
+                    cached = [self.audio_cache.get(key) if use_cache else None for key in keys]
+                    misses = [i for i, wav in enumerate(cached) if wav is None]
+                    speech_tokens = [None] * len(batch)
+                    if misses:
+                        text_tokens = [self._tokenize_text(batch[i][0])[0] for i in misses]
+                        if self.t3_scheduler is not None:
+                            futures = [
+                                self.t3_scheduler.submit(
+                                    t3_cond=conds.t3, text_tokens=t, generator=self._generator(seed), **decode_kwargs,
+                                )
+                                for t in text_tokens
+                            ]
+                            decoded_tokens = [future.result() for future in futures]
+                        else:
+                            decoded_tokens = self.t3.inference_batch(
+                                t3_cond=conds.t3,
+                                text_tokens=text_tokens,
+                                generator=None if seed is None else [self._generator(seed) for _ in misses],
+                                **decode_kwargs,
+                            )
+                        for i, tokens in zip(misses, decoded_tokens):
+                            speech_tokens[i] = tokens
+                    put([
+                        (ends_paragraph, tokens, wav, key)
+                        for (_, ends_paragraph), tokens, wav, key in zip(batch, speech_tokens, cached, keys)
+                    ])
+                put(None)
+            except Exception as e:
+                put(e)
+
+        def vocoded():
+            while True:
+                item = decoded.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                for ends_paragraph, tokens, wav, key in item:
+                    if wav is None:
+                        with torch.inference_mode():
+                            wav = self._tokens_to_wav(tokens, conds.gen, generator=self._generator(seed))
+                        if key is not None:
+                            self.audio_cache.put(key, wav)
+                    yield wav, ends_paragraph
+
+        def with_pauses():
+            pause = 0
+            for wav, ends_paragraph in vocoded():
+                yield wav, pause
+                pause = int(self.sr * (paragraph_pause_ms if ends_paragraph else pause_ms) / 1000)
+
+        worker = threading.Thread(target=decode_batches, name="MurrTTS-long-form-T3", daemon=True)
+        worker.start()
+        try:
+            yield from _join_segments(with_pauses(), n_fade=int(self.sr * crossfade_ms / 1000))
+        finally:
+            stop.set()
+            worker.join()
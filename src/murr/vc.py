@@ -1,13 +1,18 @@
 from pathlib import Path
+import copy
 import os
 
 import librosa
+import numpy as np
+import soundfile as sf
 import torch
 from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
-from .models.s3tokenizer import S3_SR
+from .models.s3tokenizer import S3_SR, S3_TOKEN_HOP, S3_TOKEN_RATE
 from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen.s3gen import fade_in_out, get_resampler
+from .reference_audio import ReferenceAudio
 
 
 REPO_ID = "DisMurr/murr-voice"
@@ -26,6 +31,7 @@ class MurrVC:
         self.sr = S3GEN_SR
         self.s3gen = s3gen
         self.device = device
+        self.voices = None  # VoiceRegistry, see `use_voice_registry`
     # watermarking removed
         if ref_dict is None:
             self.ref_dict = None
@@ -80,21 +86,30 @@ class MurrVC:
         return cls.from_local(Path(local_path).parent, device)
 
     def set_target_voice(self, wav_fpath):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        self.ref_dict = self.embed_target_voice(wav_fpath)
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(torch.from_numpy(s3gen_ref_wav), S3GEN_SR, device=self.device)
+    def embed_target_voice(self, wav_fpath) -> dict:
+        """The S3Gen `ref_dict` of the clip `wav_fpath`, without making it the target voice."""
+        ## Load reference wav, decoded once and resampled once per rate
+        ref = ReferenceAudio.load(wav_fpath, device=self.device).head(self.DEC_COND_LEN / S3GEN_SR)
+        return self.s3gen.embed_ref(ref.wav_24k, S3GEN_SR, device=self.device, ref_wav_16=ref.wav_16k)
+
+    def for_worker(self) -> 'MurrVC':
+        """A shallow copy for one worker thread: the same modules, with its own target voice; see `WorkerPool`."""
+        return copy.copy(self)
+
+    def use_voice_registry(self, registry):
+        """Convert to voices enrolled in `registry` (`voice_id=...`), e.g. the one `MurrTTS` enrolls into."""
+        self.voices = registry
+        return registry
 
     def generate(
         self,
         audio,
         target_voice_path=None,
+        voice_id=None,
     ):
-        if target_voice_path:
-            self.set_target_voice(target_voice_path)
-        else:
-            assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
+        ref_dict = self._target_ref_dict(target_voice_path, voice_id)
 
         with torch.inference_mode():
             audio_16, _ = librosa.load(audio, sr=S3_SR)
@@ -103,7 +118,133 @@ class MurrVC:
             s3_tokens, _ = self.s3gen.tokenizer(audio_16)
             wav, _ = self.s3gen.inference(
                 speech_tokens=s3_tokens,
-                ref_dict=self.ref_dict,
+                ref_dict=ref_dict,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
-        return torch.from_numpy(wav).unsqueeze(0)
\ No newline at end of file
+        return torch.from_numpy(wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        audio,
+        target_voice_path=None,
+        voice_id=None,
+        window_seconds=20.0,
+        context_seconds=1.0,
+        crossfade_seconds=0.08,
+    ):
+        """
+        Streaming `generate` for long sources: a generator of (1, N) waveform chunks on CPU, one per
+        `window_seconds` of source audio, so the first audio arrives after one window and memory is bounded by
+        the window size rather than by the length of the source.
+
+        The source is opened once and read front to back (`_SourceReader`), window by window with `context_seconds`
+        more on each side, and the windows are cut on the 40 ms token grid (`S3_TOKEN_HOP`), so the tokens each window
+        keeps start exactly where the previous window's stopped. Each window is decoded with its left context
+        tokens, which absorb S3Gen's start-of-utterance fade, and (but for the last one) `pre_lookahead_len` tokens
+        of right context. Consecutive windows are crossfaded over `crossfade_seconds` (Hann window, as
+        `S3GenStreamSession`).
+        """
+        ref_dict = self._target_ref_dict(target_voice_path, voice_id)
+        samples_per_token = S3GEN_SR // S3_TOKEN_RATE
+        n_window = max(1, int(window_seconds * S3_TOKEN_RATE))
+        n_context = int(context_seconds * S3_TOKEN_RATE)
+        n_fade = int(crossfade_seconds * S3GEN_SR)
+        lookahead = self.s3gen.flow.pre_lookahead_len
+        assert n_context >= lookahead and n_context * samples_per_token >= n_fade + len(self.s3gen.trim_fade), \
+            "context_seconds is too short for the lookahead and the crossfade"
+        window = torch.hann_window(2 * n_fade, periodic=True, device=self.device)
+
+        with _SourceReader(audio) as source:
+            n_source = source.n_samples
+            start, speech_cache = 0, None  # the first token of the next window, the held-back end of the previous one
+            while start * S3_TOKEN_HOP < n_source:
+                read_start = max(0, start - n_context)
+                read_end = start + n_window + n_context
+                is_last = read_end * S3_TOKEN_HOP >= n_source
+                with torch.inference_mode():
+                    audio_16 = source.read(read_start * S3_TOKEN_HOP, read_end * S3_TOKEN_HOP).to(self.device)
+                    s3_tokens, _ = self.s3gen.tokenizer(audio_16)
+
+                    # left context, the window and (unless the source ends here) the lookahead
+                    n_left = start - read_start
+                    if not is_last:
+                        s3_tokens = s3_tokens[:, :n_left + n_window + lookahead]
+                    wav, _ = self.s3gen.inference(speech_tokens=s3_tokens, ref_dict=ref_dict, finalize=is_last)
+
+                # keep the window, and the end of the left context to crossfade with the previous window
+                if start > 0:
+                    wav = wav[:, n_left * samples_per_token - n_fade:]
+                if speech_cache is not None and n_fade > 0:
+                    wav = fade_in_out(wav, speech_cache, window)
+                if not is_last and n_fade > 0:
+                    speech_cache = wav[:, -n_fade:]
+                    wav = wav[:, :-n_fade]
+                yield wav.cpu()
+                if is_last:
+                    break
+                start += n_window
+
+    def _target_ref_dict(self, target_voice_path=None, voice_id=None) -> dict:
+        if voice_id is not None:
+            assert self.voices is not None, "Please `use_voice_registry` first"
+            return self.voices.get(voice_id).gen
+        if target_voice_path:
+            # for this call only: concurrent calls may convert to other voices
+            return self.embed_target_voice(target_voice_path)
+        assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
+        return self.ref_dict
+
+
+class _SourceReader:
+    """
+    A source file read front to back as 16 kHz mono windows for `MurrVC.generate_stream`. The file is opened once
+    and each sample is decoded once, however much consecutive windows overlap, where `librosa.load` with an
+    `offset` would decode a compressed file from its start for every window. Only the current window is held.
+
+    Formats libsndfile can't open are decoded whole with `librosa.load` instead.
+    """
+
+    def __init__(self, audio):
+        try:
+            self._file = sf.SoundFile(audio)
+        except sf.LibsndfileError:
+            self._file = None
+            wav, self.sr = librosa.load(audio, sr=None)
+            self._buffer = wav[:, None]
+            n_native = len(wav)
+        else:
+            self.sr = self._file.samplerate
+            self._buffer = np.zeros((0, self._file.channels), dtype=np.float32)
+            n_native = self._file.frames
+        self._buffer_start = 0  # the native sample index of `_buffer[0]`
+        self.n_samples = int(round(n_native * S3_SR / self.sr))
+
+    def read(self, start: int, end: int) -> torch.Tensor:
+        "Samples `start:end` at 16 kHz, as a (1, N) tensor; `start` and `end` must not go backwards between calls."
+        native_start = int(round(start * self.sr / S3_SR))
+        native_end = int(round(end * self.sr / S3_SR))
+        assert native_start >= self._buffer_start, "windows must be read in order"
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._file is not None and native_start > buffer_end:
+            self._file.seek(native_start)
+            self._buffer, buffer_end = self._buffer[:0], native_start
+        self._buffer = self._buffer[native_start - self._buffer_start:]
+        self._buffer_start = native_start
+        if self._file is not None and native_end > buffer_end:
+            decoded = self._file.read(native_end - buffer_end, dtype="float32", always_2d=True)
+            self._buffer = np.concatenate([self._buffer, decoded])
+
+        wav = torch.from_numpy(self._buffer[:native_end - native_start].mean(axis=1))[None]
+        if self.sr != S3_SR:
+            wav = get_resampler(self.sr, S3_SR, "cpu")(wav)
+        return wav
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> "_SourceReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
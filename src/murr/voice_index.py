@@ -0,0 +1,107 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class VoiceIndex:
+    """
+    Top-k cosine search over speaker embeddings (the VoiceEncoder's `ve_embed`, as stored in `T3Cond.speaker_emb`),
+    for dedupe, "closest stock voice" lookup and clustering.
+
+    Embeddings are L2-normalized on insertion and kept as the rows of one contiguous matrix, so a query is a
+    single matrix-vector product and a `topk`. Removing a voice moves the last row into its slot, so `add` and
+    `remove` never rebuild the matrix.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._embeds = torch.zeros(0, dim)  # (capacity, dim), the first len(self) rows are in use
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, voice_id: str) -> bool:
+        return voice_id in self._rows
+
+    def voice_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._ids)
+
+    def add(self, voice_id: str, embed):
+        "Index `embed` (any shape with `dim` elements) as `voice_id`, replacing any embedding with that id."
+        embed = torch.as_tensor(embed, dtype=torch.float32).detach().cpu().view(self.dim)
+        embed = embed / embed.norm().clamp(min=1e-12)
+        with self._lock:
+            row = self._rows.get(voice_id)
+            if row is None:
+                row = len(self._ids)
+                if row == self._embeds.size(0):
+                    grown = torch.zeros(max(16, 2 * row), self.dim)
+                    grown[:row] = self._embeds[:row]
+                    self._embeds = grown
+                self._ids.append(voice_id)
+                self._rows[voice_id] = row
+            self._embeds[row] = embed
+
+    def remove(self, voice_id: str) -> bool:
+        "Drop `voice_id` from the index; returns whether it was there."
+        with self._lock:
+            row = self._rows.pop(voice_id, None)
+            if row is None:
+                return False
+            last_id = self._ids.pop()
+            if last_id != voice_id:
+                self._embeds[row] = self._embeds[len(self._ids)]
+                self._ids[row] = last_id
+                self._rows[last_id] = row
+            return True
+
+    def embedding(self, voice_id: str) -> torch.Tensor:
+        "The normalized (dim,) embedding of `voice_id`. Raises `KeyError` for unknown ids."
+        with self._lock:
+            return self._embeds[self._rows[voice_id]].clone()
+
+    def search(self, query, k: int = 5, exclude: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """
+        The (at most) `k` indexed voices closest to the `query` embedding, as `(voice_id, cosine similarity)`
+        pairs, most similar first. Voices in `exclude` (e.g. the query's own id) are left out.
+        """
+        query = torch.as_tensor(query, dtype=torch.float32).detach().cpu().view(self.dim)
+        query = query / query.norm().clamp(min=1e-12)
+        exclude = set(exclude)
+        with self._lock:
+            n = len(self._ids)
+            n_top = min(n, k + len(exclude))
+            if n_top == 0:
+                return []
+            scores, rows = torch.topk(self._embeds[:n] @ query, n_top)
+            ids = [self._ids[row] for row in rows.tolist()]
+        return [(voice_id, score) for voice_id, score in zip(ids, scores.tolist()) if voice_id not in exclude][:k]
+
+    def save(self, path: Union[str, Path]):
+        "Write the index to `path` (`.npz`); the file is replaced atomically."
+        path = Path(path)
+        with self._lock:
+            ids = np.array(self._ids, dtype=str)
+            embeds = self._embeds[:len(self._ids)].numpy().copy()
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, ids=ids, embeds=embeds)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "VoiceIndex":
+        with np.load(path, allow_pickle=False) as data:
+            ids, embeds = data["ids"].tolist(), torch.from_numpy(data["embeds"])
+        index = cls(dim=embeds.size(1))
+        index._ids = ids
+        index._rows = {voice_id: row for row, voice_id in enumerate(ids)}
+        index._embeds = embeds.clone()
+        return index
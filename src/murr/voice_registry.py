@@ -0,0 +1,139 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+
+from .tts import Conditionals
+from .voice_index import VoiceIndex
+
+
+class UnknownVoiceError(KeyError):
+    "A `voice_id` that is not enrolled (or not a valid id at all)."
+
+
+class VoiceRegistry:
+    """
+    Enrolled voices: the `Conditionals` of a reference clip (`T3Cond` plus the S3Gen `ref_dict`), computed once
+    and kept under a stable `voice_id`, so requests naming a voice skip the reference front end entirely.
+
+    Voices are persisted as `<root_dir>/<voice_id>.pt` and loaded on demand onto `device`, with at most
+    `max_loaded` of them held in memory (least recently used are dropped first). One registry can be shared by
+    `MurrTTS` and `MurrVC` (`use_voice_registry`); VC only reads the S3Gen part.
+
+    The speaker embeddings of all enrolled voices are also kept in a `VoiceIndex` (`similar_voices`), persisted as
+    `<root_dir>/voice_index.npz` by `save_index`. On startup the saved index is reconciled with the voice files,
+    so an index saved before the last enrollments or deletions is brought up to date.
+    """
+
+    def __init__(self, root_dir: Union[str, Path], device="cpu", max_loaded: int = 32):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.device = device
+        self.max_loaded = max_loaded
+        self._loaded: "OrderedDict[str, Conditionals]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.index_path = self.root_dir / "voice_index.npz"
+        self.index = self._load_index()
+
+    @staticmethod
+    def voice_id_for(source) -> str:
+        """
+        Stable id of a reference clip, a path or a `(wav, sample_rate)` pair: a hash of the file contents (or of
+        the samples), so enrolling the same clip twice is a no-op.
+        """
+        h = hashlib.sha256()
+        if isinstance(source, (tuple, list)):
+            wav, sr = source
+            wav = wav.detach().cpu().numpy() if torch.is_tensor(wav) else np.asarray(wav)
+            h.update(f"{sr}:{wav.dtype}:".encode())
+            h.update(np.ascontiguousarray(wav).tobytes())
+        else:
+            with open(source, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        return h.hexdigest()[:16]
+
+    def add(self, voice_id: str, conds: Conditionals) -> str:
+        "Persist `conds` as `voice_id` (replacing any voice with that id) and keep it loaded."
+        conds.save(self._path(voice_id))
+        self.index.add(voice_id, conds.t3.speaker_emb)
+        with self._lock:
+            self._remember(voice_id, conds.to(self.device))
+        return voice_id
+
+    def get(self, voice_id: str) -> Conditionals:
+        "The `Conditionals` of an enrolled voice, loaded from disk if needed. Raises `UnknownVoiceError` for unknown ids."
+        with self._lock:
+            conds = self._loaded.get(voice_id)
+            if conds is not None:
+                self._loaded.move_to_end(voice_id)
+                return conds
+        path = self._path(voice_id)
+        if not path.exists():
+            raise UnknownVoiceError(f"unknown voice_id {voice_id!r}")
+        conds = Conditionals.load(path, map_location="cpu").to(self.device)
+        with self._lock:
+            # another thread may have loaded it meanwhile: keep a single copy (and its T3 prefix cache)
+            conds = self._loaded.get(voice_id, conds)
+            self._remember(voice_id, conds)
+        return conds
+
+    def remove(self, voice_id: str):
+        with self._lock:
+            self._loaded.pop(voice_id, None)
+        self._path(voice_id).unlink(missing_ok=True)
+        self.index.remove(voice_id)
+
+    def similar_voices(self, voice_id: str, k: int = 5) -> List[Tuple[str, float]]:
+        """
+        The `k` enrolled voices closest to `voice_id` by speaker embedding, as `(voice_id, cosine similarity)`
+        pairs, most similar first. Raises `UnknownVoiceError` for unknown ids.
+        """
+        if voice_id not in self.index:
+            raise UnknownVoiceError(f"unknown voice_id {voice_id!r}")
+        return self.index.search(self.index.embedding(voice_id), k=k, exclude=(voice_id,))
+
+    def save_index(self):
+        "Persist the speaker-embedding index (a snapshot of all enrolled voices)."
+        self.index.save(self.index_path)
+
+    def list_voices(self) -> List[str]:
+        return sorted(path.stem for path in self.root_dir.glob("*.pt"))
+
+    def __contains__(self, voice_id: str) -> bool:
+        try:
+            return voice_id in self._loaded or self._path(voice_id).exists()
+        except UnknownVoiceError:
+            return False
+
+    def _load_index(self) -> VoiceIndex:
+        try:
+            index = VoiceIndex.load(self.index_path)
+        except (FileNotFoundError, ValueError, OSError, KeyError):
+            index = VoiceIndex()
+        voice_ids = set(self.list_voices())
+        stale = [voice_id for voice_id in index.voice_ids() if voice_id not in voice_ids]
+        missing = voice_ids.difference(index.voice_ids())
+        for voice_id in stale:
+            index.remove(voice_id)
+        for voice_id in sorted(missing):
+            index.add(voice_id, Conditionals.load(self._path(voice_id), map_location="cpu").t3.speaker_emb)
+        if stale or missing:
+            index.save(self.index_path)
+        return index
+
+    def _remember(self, voice_id: str, conds: Conditionals):
+        # (call with the lock held)
+        self._loaded[voice_id] = conds
+        self._loaded.move_to_end(voice_id)
+        while len(self._loaded) > self.max_loaded:
+            self._loaded.popitem(last=False)
+
+    def _path(self, voice_id: str) -> Path:
+        if not voice_id or not all(c.isalnum() or c in "-_" for c in voice_id):
+            raise UnknownVoiceError(f"invalid voice_id {voice_id!r}")
+        return self.root_dir / f"{voice_id}.pt"
@@ -0,0 +1,53 @@
+import queue
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class WorkerPool:
+    """
+    Bounds how many requests run on a `MurrTTS` or `MurrVC` at once, for serving from worker threads.
+
+    The pool holds `n_workers` shallow copies of the model (`model.for_worker()`). They are not replicas: every
+    copy shares the same modules and weights, which inference only reads, and only the per-request state (such
+    as the prepared voice) is its own. Each call borrows an idle copy for its duration, so this is in effect a
+    semaphore of size `n_workers` with somewhere to keep per-worker state; the rest of the callers wait their turn.
+
+    PyTorch releases the GIL inside its kernels, so the workers overlap, but they all share PyTorch's process-wide
+    intra-op thread pool, which this class leaves alone. With continuous batching (`enable_continuous_batching`)
+    T3 decodes on its own scheduler thread whatever `n_workers` is, and the workers mostly run S3Gen and the
+    reference front end, so a small `n_workers` is usually enough.
+    """
+
+    def __init__(self, model, n_workers: int = 2):
+        self.model = model
+        self.n_workers = max(1, n_workers)
+        self._idle: "queue.Queue" = queue.Queue()
+        for _ in range(self.n_workers):
+            self._idle.put(model.for_worker())
+
+    @contextmanager
+    def acquire(self, timeout: Optional[float] = None):
+        "Borrow an idle worker copy (waiting up to `timeout` seconds for one), returned to the pool on exit."
+        worker = self._idle.get(timeout=timeout)
+        try:
+            yield worker
+        finally:
+            self._idle.put(worker)
+
+    def run(self, method: str, *args, **kwargs):
+        "Call `method` on an idle worker copy."
+        with self.acquire() as worker:
+            return getattr(worker, method)(*args, **kwargs)
+
+    def stream(self, method: str, *args, **kwargs) -> Iterator:
+        "Iterate the generator `method` (e.g. `generate_stream`) on an idle worker copy, held until the stream ends."
+        with self.acquire() as worker:
+            stream = getattr(worker, method)(*args, **kwargs)
+            try:
+                yield from stream
+            finally:
+                stream.close()
+
+    @property
+    def n_idle(self) -> int:
+        return self._idle.qsize()
@@ -0,0 +1,95 @@
+# pyright: reportMissingImports=false
+from unittest.mock import patch
+
+import pytest
+import torch
+
+from src.murr.models.s3gen import S3Gen
+
+
+@pytest.fixture(scope="module")
+def s3gen():
+    torch.manual_seed(0)
+    return S3Gen().eval()
+
+
+def make_ref_dict(n_prompt_tokens=20):
+    g = torch.Generator().manual_seed(0)
+    return dict(
+        prompt_token=torch.randint(0, 6561, (1, n_prompt_tokens), generator=g),
+        prompt_token_len=torch.tensor([n_prompt_tokens]),
+        prompt_feat=torch.randn(1, 2 * n_prompt_tokens, 80, generator=g),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192, generator=g),
+    )
+
+
+def _zeros(*size, generator=None, **kwargs):
+    "Stands in for `torch.rand` / `torch.randn`: HiFT's random phases and noise, switched off."
+    return torch.zeros(*size, **kwargs)
+
+
+def test_stream_session_single_push_matches_offline(s3gen):
+    tokens = torch.randint(0, 6561, (1, 12))
+
+    torch.manual_seed(1)
+    expected, _ = s3gen.inference(tokens, ref_dict=make_ref_dict())
+    session = s3gen.stream_session(ref_dict=make_ref_dict())
+    torch.manual_seed(1)
+    wav = session.push(tokens, finalize=True)
+
+    assert torch.equal(wav, expected)
+
+
+@pytest.mark.parametrize("context_tokens", [None, 4])
+def test_stream_session_chunks_join_seamlessly(s3gen, context_tokens):
+    tokens = torch.randint(0, 6561, (1, 24))
+    # a prefix-consistent flow and noise-free source isolate the vocoder chunking and crossfades
+    mels = torch.randn(1, 80, 2 * tokens.size(1)) * 0.5 - 5
+    flow_lens = []
+
+    def flow_inference(speech_tokens, ref_dict=None, finalize=False, token_offset=0, **kwargs):
+        assert torch.equal(speech_tokens, tokens[:, token_offset:token_offset + speech_tokens.size(1)])
+        flow_lens.append(speech_tokens.size(1))
+        n_tokens = speech_tokens.size(1) - (0 if finalize else s3gen.flow.pre_lookahead_len)
+        return mels[:, :, 2 * token_offset:2 * (token_offset + n_tokens)]
+
+    with patch.object(s3gen, "flow_inference", flow_inference), \
+         patch("torch.rand", _zeros), patch("torch.randn", _zeros):
+        expected, _ = s3gen.inference(tokens, ref_dict=make_ref_dict())
+        flow_lens.clear()
+        session = s3gen.stream_session(ref_dict=make_ref_dict(), context_tokens=context_tokens)
+        # stop tokens from T3 are dropped
+        chunks = [session.push(torch.cat([tokens[0, i:i + 8], torch.tensor([6562])])) for i in range(0, 24, 8)]
+        chunks.append(session.push(tokens[:, :0], finalize=True))
+
+    assert chunks[0].numel() > 0
+    if context_tokens is not None:
+        # the left context, the 8 pushed tokens and the lookahead held back from the previous push, at most
+        assert max(flow_lens) <= context_tokens + 8 + s3gen.flow.pre_lookahead_len
+    wav = torch.cat(chunks, dim=1)
+    assert wav.shape == expected.shape
+    assert (wav - expected).abs().max() < 1e-2
+
+
+def test_seeded_inference_is_reproducible(s3gen):
+    tokens = torch.randint(0, 6561, (1, 8))
+    wavs = [
+        s3gen.inference(tokens, ref_dict=make_ref_dict(), generator=torch.Generator().manual_seed(seed))[0]
+        for seed in (3, 3, 4)
+    ]
+    assert torch.equal(wavs[0], wavs[1])
+    assert not torch.equal(wavs[0], wavs[2])
+
+
+def test_embed_refs_matches_embed_ref_per_clip(s3gen):
+    g = torch.Generator().manual_seed(0)
+    wavs_24 = [0.1 * torch.randn(1, n, generator=g) for n in (36000, 36000, 21000)]
+    wavs_16 = [wav[:, ::3].repeat_interleave(2, dim=1) for wav in wavs_24]  # any 16 kHz signal of the right length
+
+    batched = s3gen.embed_refs(wavs_24, wavs_16)
+    for wav_24, wav_16, ref_dict in zip(wavs_24, wavs_16, batched):
+        expected = s3gen.embed_ref(wav_24, 24000, ref_wav_16=wav_16)
+        assert torch.equal(ref_dict["prompt_token"], expected["prompt_token"])
+        assert torch.allclose(ref_dict["prompt_feat"], expected["prompt_feat"])
+        assert torch.allclose(ref_dict["embedding"], expected["embedding"], atol=1e-5)
@@ -0,0 +1,30 @@
+# pyright: reportMissingImports=false
+import pytest
+import torch
+from s3tokenizer.utils import padding
+
+from src.murr.models.s3tokenizer import S3Tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    torch.manual_seed(0)
+    return S3Tokenizer().eval()
+
+
+def test_batch_log_mel_is_identical_to_per_clip(tokenizer):
+    g = torch.Generator().manual_seed(0)
+    wavs = [0.1 * torch.randn(1, n, generator=g) for n in (16000 * 3 + 77, 16000 * 5, 16000 * 2 + 5, 640)]
+    wavs[2] *= 0.01  # a quiet clip: its floor must not come from the loud ones
+
+    mels, mel_lens = tokenizer.log_mel_spectrogram_batch(wavs)
+    expected_mels, expected_lens = padding([tokenizer.log_mel_spectrogram(wav).squeeze(0) for wav in wavs])
+    assert torch.equal(mel_lens, expected_lens)
+    assert torch.equal(mels, expected_mels)
+
+    tokens, token_lens = tokenizer(wavs, max_len=50)
+    expected_tokens, expected_token_lens = tokenizer.quantize(
+        expected_mels[..., :200], expected_lens.clamp(max=200),
+    )
+    assert torch.equal(token_lens, expected_token_lens.long())
+    assert torch.equal(tokens, expected_tokens.long())
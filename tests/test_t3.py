@@ -0,0 +1,392 @@
+# pyright: reportMissingImports=false
+import threading
+from unittest.mock import patch
+
+import pytest
+import torch
+from transformers import DynamicCache
+
+from src.murr.models.t3 import T3
+from src.murr.models.t3.inference.scheduler import T3Scheduler
+from src.murr.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT
+from src.murr.models.t3.modules.cond_enc import T3Cond
+from src.murr.models.t3.modules.quantized_linear import quantize_linear
+from src.murr.models.t3.modules.t3_config import T3Config
+
+
+class TinyT3Config(T3Config):
+    # The perceiver is fixed at 1024 channels, so only shrink depth and MLP width.
+    llama_config_name = "Llama_tiny"
+
+
+@pytest.fixture(scope="module")
+def tiny_t3():
+    yield make_tiny_t3()
+
+
+def make_tiny_t3():
+    tiny_cfg = dict(LLAMA_520M_CONFIG_DICT, num_hidden_layers=2, intermediate_size=256)
+    with patch.dict(LLAMA_CONFIGS, {"Llama_tiny": tiny_cfg}):
+        torch.manual_seed(0)
+        return T3(TinyT3Config()).eval()
+
+
+def make_cond(seed):
+    g = torch.Generator().manual_seed(seed)
+    return T3Cond(
+        speaker_emb=torch.randn(1, 256, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150), generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+
+
+def make_text(n, seed):
+    g = torch.Generator().manual_seed(seed)
+    hp = TinyT3Config()
+    body = torch.randint(1, 200, (n,), generator=g)
+    return torch.cat([torch.tensor([hp.start_text_token]), body, torch.tensor([hp.stop_text_token])])
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_inference_batch_matches_single(tiny_t3, cfg_weight):
+    conds = [make_cond(1), make_cond(2)]
+    texts = [make_text(5, 3), make_text(17, 4)]
+    # a tiny top_p makes sampling greedy, so rows must match regardless of the RNG stream
+    kwargs = dict(max_new_tokens=8, cfg_weight=cfg_weight, top_p=1e-4)
+
+    singles = [
+        tiny_t3.inference(t3_cond=c, text_tokens=t[None], **kwargs)[0]
+        for c, t in zip(conds, texts)
+    ]
+    batched = tiny_t3.inference_batch(t3_cond=conds, text_tokens=texts, **kwargs)
+
+    assert len(batched) == 2
+    for single, row in zip(singles, batched):
+        assert torch.equal(single[:len(row)], row)
+
+
+def test_inference_batch_stops_rows_independently(tiny_t3):
+    stop = tiny_t3.hp.stop_speech_token
+    texts = [make_text(5, 3), make_text(9, 4)]
+
+    # force row 0 to emit EOS straight away; row 1 keeps sampling
+    backend = tiny_t3.patched_model
+    real_forward = backend.forward
+
+    def biased_forward(*args, **kwargs):
+        output = real_forward(*args, **kwargs)
+        output.logits[0, ..., stop] = 1e4
+        output.logits[1:, ..., stop] = -1e4
+        return output
+
+    with patch.object(backend, "forward", biased_forward):
+        rows = tiny_t3.inference_batch(t3_cond=make_cond(1), text_tokens=texts, max_new_tokens=6)
+
+    assert rows[0].tolist() == [stop]
+    assert len(rows[1]) == 6 and stop not in rows[1].tolist()
+
+
+def test_seeded_rows_do_not_depend_on_the_batch(tiny_t3):
+    texts = [make_text(5, 3), make_text(17, 4)]
+    kwargs = dict(max_new_tokens=8, cfg_weight=0.5, temperature=1.5)
+
+    single = tiny_t3.inference(
+        t3_cond=make_cond(1), text_tokens=texts[1][None], generator=torch.Generator().manual_seed(3), **kwargs,
+    )[0]
+    torch.manual_seed(0)  # the global RNG is not used
+    generators = [torch.Generator().manual_seed(seed) for seed in (11, 3)]
+    batched = tiny_t3.inference_batch(t3_cond=make_cond(1), text_tokens=texts, generator=generators, **kwargs)
+
+    assert torch.equal(single[:len(batched[1])], batched[1])
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_static_cache_matches_dynamic_cache(tiny_t3, cfg_weight):
+    conds = [make_cond(1), make_cond(2)]
+    texts = [make_text(5, 3), make_text(17, 4)]
+    kwargs = dict(max_new_tokens=8, cfg_weight=cfg_weight, top_p=1e-4)
+
+    dynamic = tiny_t3.inference_batch(t3_cond=conds, text_tokens=texts, **kwargs)
+    static = tiny_t3.inference_batch(t3_cond=conds, text_tokens=texts, static_cache=True, **kwargs)
+
+    for d, s in zip(dynamic, static):
+        assert torch.equal(d, s)
+
+
+def test_scheduler_matches_independent_decoding(tiny_t3):
+    requests = [
+        dict(t3_cond=make_cond(1), text_tokens=make_text(5, 3), max_new_tokens=4, cfg_weight=0.0),
+        dict(t3_cond=make_cond(2), text_tokens=make_text(17, 4), max_new_tokens=9, cfg_weight=0.5),
+        dict(t3_cond=make_cond(3), text_tokens=make_text(9, 5), max_new_tokens=6, cfg_weight=0.5),
+    ]
+    expected = [
+        tiny_t3.inference_batch(
+            t3_cond=r["t3_cond"], text_tokens=[r["text_tokens"]], max_new_tokens=r["max_new_tokens"],
+            cfg_weight=r["cfg_weight"], top_p=1e-4,
+        )[0]
+        for r in requests
+    ]
+
+    # 3 rows at most: the last request has to wait for a slot to free up
+    scheduler = T3Scheduler(tiny_t3, max_batch_size=3)
+    try:
+        futures = [scheduler.submit(top_p=1e-4, **r) for r in requests]
+        results = [f.result(timeout=60) for f in futures]
+    finally:
+        scheduler.close()
+
+    for e, r in zip(expected, results):
+        assert torch.equal(e, r)
+
+
+def test_attention_spy_only_observes(tiny_t3):
+    from src.murr.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+
+    embeds, _ = tiny_t3.prepare_input_embeds(
+        t3_cond=make_cond(1),
+        text_tokens=make_text(5, 3)[None],
+        speech_tokens=torch.tensor([[tiny_t3.hp.start_speech_token]]),
+    )
+    backend = tiny_t3.patched_model
+
+    def logits():
+        with torch.inference_mode():
+            return backend(inputs_embeds=embeds, use_cache=False, return_dict=True).logits
+
+    expected = logits()
+    analyzer = AlignmentStreamAnalyzer(tiny_t3.tfmr, None, text_tokens_slice=(0, 1), alignment_layer_idx=1)
+    logits()
+    assert analyzer.last_aligned_attn is None  # only forwards run inside `capturing` are spied on
+    with analyzer.capturing():
+        spied = logits()
+    assert analyzer.last_aligned_attn.shape == (embeds.size(1), embeds.size(1))
+    assert "forward" not in vars(tiny_t3.tfmr.layers[1].self_attn)
+    torch.testing.assert_close(spied, expected)
+
+
+def test_backend_is_built_once_and_kept_out_of_state_dict(tiny_t3):
+    backend = tiny_t3.patched_model
+    tiny_t3.inference(t3_cond=make_cond(1), text_tokens=make_text(5, 3)[None], max_new_tokens=2)
+    assert tiny_t3.patched_model is backend
+    assert backend.speech_head is tiny_t3.speech_head
+    assert not any(k.startswith("patched_model.") for k in tiny_t3.state_dict())
+
+
+def test_sampler_matches_hf_logits_processors():
+    from transformers.generation.logits_process import (
+        MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper,
+    )
+    from src.murr.models.t3.inference.sampler import SpeechTokenSampler
+
+    params = [(0.8, 0.05, 1.0, 1.2), (1.0, 0.0, 0.9, 1.0), (0.5, 0.1, 0.5, 2.0)]  # temperature, min_p, top_p, penalty
+    initial = torch.full((len(params), 1), 6561)
+    temperature, min_p, top_p, penalty = zip(*params)
+    sampler = SpeechTokenSampler(
+        initial, 10, 6563, temperature=temperature, min_p=min_p, top_p=top_p, repetition_penalty=penalty,
+    )
+    generated_ids = initial
+    torch.manual_seed(0)
+    for _ in range(10):
+        logits = 3 * torch.randn(len(params), 6563)
+        expected = []
+        for row, (t, mp, tp, rp) in enumerate(params):
+            ids, scores = generated_ids[row:row + 1], logits[row:row + 1] / t
+            scores = RepetitionPenaltyLogitsProcessor(penalty=rp)(ids, scores)
+            scores = MinPLogitsWarper(min_p=mp)(ids, scores) if mp > 0 else scores
+            scores = TopPLogitsWarper(top_p=tp)(ids, scores)
+            expected.append(scores.softmax(dim=-1))
+
+        with patch("torch.multinomial", wraps=torch.multinomial) as multinomial:
+            next_tokens = sampler.sample(logits.clone())
+        torch.testing.assert_close(multinomial.call_args.args[0], torch.cat(expected))
+        sampler.append(next_tokens)
+        generated_ids = torch.cat([generated_ids, next_tokens], dim=1)
+
+    assert torch.equal(sampler.generated_tokens, generated_ids[:, 1:])
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_speculative_decoding_matches_regular_decoding(tiny_t3, cfg_weight):
+    kwargs = dict(t3_cond=make_cond(1), text_tokens=make_text(9, 3)[None], max_new_tokens=12, cfg_weight=cfg_weight)
+    regular = tiny_t3.inference(top_p=1e-4, **kwargs)
+    speculative = tiny_t3.inference(top_p=1e-4, speculative_k=3, draft_layers=1, **kwargs)
+    assert torch.equal(regular, speculative)
+
+
+def test_speculative_accept_preserves_target_distribution():
+    from src.murr.models.t3.inference.speculative import speculative_accept
+
+    target = torch.tensor([[0.5, 0.3, 0.2, 0.0], [0.25, 0.25, 0.25, 0.25]])
+    draft = torch.tensor([[0.1, 0.2, 0.3, 0.4]])
+    g = torch.Generator().manual_seed(0)
+    counts = torch.zeros(4)
+    n_trials = 20000
+    for _ in range(n_trials):
+        draft_token = torch.multinomial(draft[0], 1, generator=g)
+        n_accepted, next_token = speculative_accept(target, draft, draft_token, generator=g)
+        counts[int(draft_token) if n_accepted else int(next_token)] += 1
+    torch.testing.assert_close(counts / n_trials, target[0], atol=0.015, rtol=0)
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_cached_cond_prefix_matches_full_prefill(tiny_t3, cfg_weight):
+    cond = make_cond(1)
+    kwargs = dict(t3_cond=cond, text_tokens=make_text(9, 3)[None], max_new_tokens=8, cfg_weight=cfg_weight, top_p=1e-4)
+    prefix = tiny_t3.prefill_conditioning(cond)
+    keys = prefix.key_cache[0].clone()
+
+    assert torch.equal(tiny_t3.inference(**kwargs), tiny_t3.inference(cond_prefix=prefix, **kwargs))
+    assert torch.equal(prefix.key_cache[0], keys)  # reusable: decoding never writes into the prefix
+
+
+def test_exaggeration_change_reuses_the_voice_embedding(tiny_t3):
+    cond = make_cond(1)
+    with torch.inference_mode():
+        expected = tiny_t3.prepare_conditioning(make_cond(1).with_emotion_adv(0.9 * torch.ones(1, 1, 1)))
+        tiny_t3.prepare_conditioning(cond)
+        with patch.object(tiny_t3.cond_enc.perceiver, "forward", side_effect=AssertionError("perceiver re-run")):
+            cond_emb = tiny_t3.prepare_conditioning(cond.with_emotion_adv(0.9 * torch.ones(1, 1, 1)))
+
+    assert torch.equal(cond_emb, expected)
+    assert "cond_voice_emb" not in cond.saved_fields()
+
+
+def test_cfg_rows_start_from_the_shared_prefix(tiny_t3):
+    cond, text = make_cond(1), make_text(9, 3)[None]
+    bos = torch.tensor([[tiny_t3.hp.start_speech_token]])
+    full, len_cond = tiny_t3.prepare_input_embeds(t3_cond=cond, text_tokens=text, speech_tokens=bos)
+    uncond = full.clone()
+    uncond[:, len_cond:len_cond + text.size(1)] = 0
+    full = torch.cat([full, uncond])
+
+    with torch.inference_mode():
+        expected = tiny_t3.patched_model(inputs_embeds=full, past_key_values=DynamicCache()).logits[:, -1]
+        prefix = tiny_t3.prefill_conditioning(cond)
+        cache = prefix.shared_cache(2)
+        logits = tiny_t3.patched_model(inputs_embeds=full[:, len_cond:], past_key_values=cache).logits[:, -1]
+
+    torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-4)
+    assert cache.get_seq_length() == full.size(1)
+    assert cache.key_cache[0].size(2) == full.size(1)
+
+    # decode steps write into the layer buffers in place instead of re-concatenating the history
+    with torch.inference_mode():
+        step = torch.zeros(2, 1, full.size(2))
+        tiny_t3.patched_model(inputs_embeds=step, past_key_values=cache)  # (grows the buffers once)
+        storage = cache.key_cache[0].untyped_storage().data_ptr()
+        tiny_t3.patched_model(inputs_embeds=step, past_key_values=cache)
+    assert cache.key_cache[0].untyped_storage().data_ptr() == storage
+    assert cache.get_seq_length() == full.size(1) + 2
+    assert torch.equal(cache.key_cache[0][:, :, :len_cond], prefix.key_cache[0].expand(2, -1, -1, -1))
+
+
+@pytest.mark.parametrize("mode,atol", [("int8", 0.05), ("int4", 0.3)])
+def test_quantized_linear_matches_linear(mode, atol):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(256, 100)
+    x = torch.randn(3, 5, 256)
+    quantized = quantize_linear(linear, mode, group_size=64, n_rows=90)
+
+    with torch.inference_mode():
+        expected = linear(x)[..., :90]
+        out = quantized(x)
+    assert out.shape == expected.shape and out.dtype == x.dtype
+    assert torch.allclose(out, expected, atol=atol)
+
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_quantized_t3_stays_close_to_full_precision(mode):
+    t3, t3_q = make_tiny_t3(), make_tiny_t3().quantize(mode)
+    assert not any(isinstance(m, torch.nn.Linear) for m in t3_q.tfmr.modules())
+    assert t3_q.patched_model.speech_head is t3_q.speech_head
+
+    cond, text = make_cond(1), make_text(9, 3)
+    speech = torch.randint(0, 6561, (1, 12))
+    with torch.inference_mode():
+        probs = []
+        for model in (t3, t3_q):
+            embeds, _ = model.prepare_input_embeds(t3_cond=cond, text_tokens=text[None], speech_tokens=speech)
+            hidden = model.tfmr(inputs_embeds=embeds).last_hidden_state[:, -speech.size(1):]
+            probs.append(model.speech_head(hidden)[..., :t3.n_speech_logits].softmax(-1))
+        tokens = t3_q.inference(t3_cond=cond, text_tokens=text[None], max_new_tokens=4, cfg_weight=0.5)
+
+    assert (probs[0] - probs[1]).abs().max() < 0.05
+    assert tokens.numel() > 0 and int(tokens.max()) < t3.n_speech_logits
+
+
+@pytest.mark.parametrize("speculative_k", [0, 3])
+def test_inference_stream_chunks_join_to_inference(tiny_t3, speculative_k):
+    kwargs = dict(
+        t3_cond=make_cond(1), text_tokens=make_text(7, 3)[None], max_new_tokens=10, cfg_weight=0.5,
+        speculative_k=speculative_k, draft_layers=1,
+    )
+    torch.manual_seed(0)
+    expected = tiny_t3.inference(**kwargs)[0]
+    torch.manual_seed(0)
+    chunks = list(tiny_t3.inference_stream(chunk_size=4, **kwargs))
+
+    assert all(len(chunk) == 4 for chunk in chunks[:-1]) and 0 < len(chunks[-1]) <= 4
+    assert torch.equal(torch.cat(chunks), expected)
+
+
+def test_alignment_analysis_stays_in_its_own_decode(tiny_t3):
+    kwargs = dict(
+        t3_cond=make_cond(1), text_tokens=make_text(5, 3)[None], max_new_tokens=12, stop_on_eos=False, top_p=1e-4,
+    )
+    expected = {idx: tiny_t3.inference(alignment_layer_idx=idx, **kwargs)[0] for idx in (None, 1)}
+
+    # which threads' forwards the (shared) layer ran with attention maps, i.e. off the SDPA kernel
+    layer = tiny_t3.tfmr.layers[1].self_attn
+    eager = {}
+    handle = layer.register_forward_pre_hook(
+        lambda module, args, kw: eager.setdefault(threading.current_thread().name, set()).add(
+            bool(kw.get("output_attentions"))
+        ),
+        with_kwargs=True,
+    )
+    # two analyzed decodes and a plain one, taking turns token by token
+    threads = {"plain": None, "aligned_a": 1, "aligned_b": 1}
+    barrier = threading.Barrier(len(threads), timeout=60)
+    results = {}
+
+    def decode(name):
+        chunks = []
+        for chunk in tiny_t3.inference_stream(alignment_layer_idx=threads[name], **kwargs):
+            chunks.append(chunk)
+            barrier.wait()
+        results[name] = torch.cat(chunks)
+
+    try:
+        workers = [threading.Thread(target=decode, args=(name,), name=name) for name in threads]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=120)
+    finally:
+        handle.remove()
+
+    assert eager == {"plain": {False}, "aligned_a": {True}, "aligned_b": {True}}
+    assert "forward" not in vars(layer)
+    for name, idx in threads.items():
+        assert torch.equal(results[name], expected[idx])
+
+
+def test_scheduler_bad_arrival_only_fails_itself(tiny_t3):
+    good = dict(t3_cond=make_cond(1), text_tokens=make_text(5, 3), max_new_tokens=6, cfg_weight=0.5)
+    expected = tiny_t3.inference_batch(
+        t3_cond=good["t3_cond"], text_tokens=[good["text_tokens"]], max_new_tokens=6, cfg_weight=0.5, top_p=1e-4,
+    )[0]
+    bad = dict(good, t3_cond=T3Cond(speaker_emb=torch.randn(1, 7), emotion_adv=0.5 * torch.ones(1, 1, 1)))
+
+    scheduler = T3Scheduler(tiny_t3, max_batch_size=8)
+    try:
+        running = scheduler.submit(top_p=1e-4, **good)
+        failing, cancelled = scheduler.submit(top_p=1e-4, **bad), scheduler.submit(top_p=1e-4, **good)
+        cancelled.cancel()
+        queued = scheduler.submit(top_p=1e-4, **good)
+        with pytest.raises(Exception):
+            failing.result(timeout=60)
+        assert torch.equal(running.result(timeout=60), expected)
+        assert torch.equal(queued.result(timeout=60), expected)
+    finally:
+        scheduler.close()
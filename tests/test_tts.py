@@ -4,7 +4,7 @@ from unittest.mock import patch, MagicMock
 import torch
 import numpy as np
 
-from src.murr.tts import punc_norm, MurrTTS, Conditionals, T3Cond
+from src.murr.tts import punc_norm, split_sentences, MurrTTS, Conditionals, T3Cond
 
 @pytest.fixture
 def mock_models():
@@ -64,6 +64,17 @@ def test_punc_norm_add_full_stop():
 def test_punc_norm_no_change():
     assert punc_norm("Hello world.") == "Hello world."
 
+def test_split_sentences_packs_sentences_per_paragraph():
+    text = "first one. second one? third!\n\nnext paragraph. " + "word, " * 20
+    assert split_sentences(text, max_chars=40) == [
+        ("First one. second one? third!", True),
+        ("Next paragraph.", False),
+        ("word, word, word, word, word, word,", False),
+        ("word, word, word, word, word, word,", False),
+        ("word, word, word, word, word, word,", False),
+        ("word, word,", True),
+    ]
+
 # Tests for MurrTTS
 @patch('src.murr.tts.hf_hub_download')
 @patch('src.murr.tts.MurrTTS.from_local')
@@ -72,7 +83,7 @@ def test_from_pretrained(mock_from_local, mock_hf_hub_download):
     mock_hf_hub_download.assert_called()
     mock_from_local.assert_called()
 
-@patch('src.murr.tts.librosa.load')
+@patch('src.murr.reference_audio.librosa.load')
 def test_prepare_conditionals(mock_librosa_load, tts_instance, mock_models):
     mock_librosa_load.return_value = (np.random.rand(16000 * 10), 16000)
     mock_models["ve_instance"].embeds_from_wavs.return_value = np.random.rand(1, 256)
@@ -89,7 +100,7 @@ def test_generate_no_prompt(tts_instance):
     with pytest.raises(AssertionError, match="Please `prepare_conditionals` first or specify `audio_prompt_path`"):
         tts_instance.generate("test text")
 
-@patch('src.murr.tts.librosa.load')
+@patch('src.murr.reference_audio.librosa.load')
 def test_generate_with_audio_prompt(mock_librosa_load, tts_instance, mock_models):
     # Mock dependencies for prepare_conditionals
     mock_librosa_load.return_value = (np.random.rand(48000 * 10), 48000)
@@ -129,3 +140,369 @@ def test_generate_with_prepared_conditionals(tts_instance, mock_models):
     mock_models["tokenizer_instance"].text_to_tokens.assert_called_with("Test text.")
     mock_models["t3_instance"].inference.assert_called()
     mock_models["s3gen_instance"].inference.assert_called()
+
+
+def test_generate_batch_with_prepared_conditionals(tts_instance, mock_models):
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference_batch.return_value = [torch.tensor([4, 5, 6562]), torch.tensor([7, 6562])]
+    mock_models["s3gen_instance"].inference.return_value = (torch.tensor([[0.1, 0.2, 0.3]]), 24000)
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+
+    wavs = tts_instance.generate_batch(["first text", "second text"])
+
+    assert len(wavs) == 2
+    assert all(wav.shape == (1, 3) for wav in wavs)
+    kwargs = mock_models["t3_instance"].inference_batch.call_args.kwargs
+    assert len(kwargs["text_tokens"]) == 2
+    assert mock_models["s3gen_instance"].inference.call_count == 2
+
+
+def test_generate_reuses_conditioning_prefix_per_exaggeration(tts_instance, mock_models):
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference.return_value = torch.tensor([[4, 5, 6562]])
+    mock_models["s3gen_instance"].inference.return_value = (torch.tensor([[0.1, 0.2, 0.3]]), 24000)
+    prefill = mock_models["t3_instance"].prefill_conditioning
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+
+    tts_instance.generate("first text")
+    tts_instance.generate("second text")
+    assert prefill.call_count == 1
+    assert mock_models["t3_instance"].inference.call_args.kwargs["cond_prefix"] is prefill.return_value
+
+    tts_instance.generate("third text", exaggeration=0.7)
+    assert prefill.call_count == 2
+    assert set(tts_instance.conds.t3_prefix) == {0.5, 0.7}
+
+
+def test_conditioning_prefix_cache_is_bounded(tts_instance, mock_models):
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference.return_value = torch.tensor([[4, 5, 6562]])
+    mock_models["s3gen_instance"].inference.return_value = (torch.tensor([[0.1, 0.2, 0.3]]), 24000)
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+
+    for i in range(20):
+        tts_instance.generate("text", exaggeration=0.3 + 0.01 * i)
+        assert len(tts_instance.conds.t3_prefix) <= tts_instance.T3_PREFIX_CACHE_SIZE
+    tts_instance.generate("text", exaggeration=0.3 + 0.01 * 17)  # recently used: still cached
+    assert mock_models["t3_instance"].prefill_conditioning.call_count == 20
+
+
+def test_generate_stream_yields_audio_per_token_chunk(tts_instance, mock_models):
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference_stream.return_value = (t for t in [torch.tensor([4, 5]), torch.tensor([6, 6562])])
+    session = mock_models["s3gen_instance"].stream_session.return_value
+    session.push.side_effect = [torch.zeros(1, 0), torch.ones(1, 4), torch.ones(1, 2)]
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+
+    wavs = list(tts_instance.generate_stream("test text", chunk_size=2))
+
+    assert [wav.shape for wav in wavs] == [(1, 4), (1, 2)]
+    assert mock_models["t3_instance"].inference_stream.call_args.kwargs["chunk_size"] == 2
+    assert session.push.call_args_list[-1].kwargs == {"finalize": True}
+
+
+def test_generate_long_pipelines_batches_and_inserts_pauses(tts_instance, mock_models):
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference_batch.side_effect = lambda text_tokens, **kwargs: [torch.tensor([4, 6562])] * len(text_tokens)
+    mock_models["s3gen_instance"].inference.return_value = (torch.ones(1, 2400), None)
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+
+    text = "One. Two. Three.\n\nFour. Five."
+    wav = tts_instance.generate_long(text, batch_size=2, max_chars=1, pause_ms=100, paragraph_pause_ms=200)
+
+    sr = tts_instance.sr
+    assert mock_models["t3_instance"].inference_batch.call_count == 3
+    assert mock_models["s3gen_instance"].inference.call_count == 5
+    assert wav.shape == (1, 5 * 2400 + 3 * sr // 10 + sr // 5)
+
+
+def test_seeded_generate_is_cached_and_coalesced(tts_instance, mock_models, tmp_path):
+    import threading, time
+
+    mock_models["t3_instance"].quant_mode = None
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference.return_value = torch.tensor([[4, 5, 6562]])
+
+    def slow_vocoder(**kwargs):
+        time.sleep(0.2)
+        return torch.rand(1, 3), None
+    mock_models["s3gen_instance"].inference.side_effect = slow_vocoder
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+    tts_instance.enable_audio_cache(cache_dir=tmp_path)
+
+    wavs = [None] * 3
+    def run(i):
+        wavs[i] = tts_instance.generate("test text", seed=7)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert mock_models["s3gen_instance"].inference.call_count == 1
+    assert all(torch.equal(wav, wavs[0]) for wav in wavs)
+    assert mock_models["t3_instance"].inference.call_args.kwargs["generator"].initial_seed() == 7
+
+    # a fresh memory tier still finds the entry on disk
+    tts_instance.audio_cache.clear()
+    assert torch.equal(tts_instance.generate("test text", seed=7), wavs[0])
+    assert mock_models["s3gen_instance"].inference.call_count == 1
+
+    # another seed, or no seed, synthesizes again
+    tts_instance.generate("test text", seed=8)
+    tts_instance.generate("test text")
+    assert mock_models["s3gen_instance"].inference.call_count == 3
+
+    # so does another T3 decode path: the scheduler's result is not the direct decode's
+    tts_instance.t3_scheduler = MagicMock()
+    tts_instance.t3_scheduler.submit.return_value.result.return_value = torch.tensor([4, 5, 6562])
+    tts_instance.generate("test text", seed=7)
+    assert mock_models["s3gen_instance"].inference.call_count == 4
+    tts_instance.generate("test text", seed=7)
+    assert mock_models["s3gen_instance"].inference.call_count == 4
+
+
+def test_generate_long_reuses_cached_segments(tts_instance, mock_models):
+    mock_models["t3_instance"].quant_mode = None
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference_batch.side_effect = lambda text_tokens, **kwargs: [torch.tensor([4, 6562])] * len(text_tokens)
+    mock_models["s3gen_instance"].inference.return_value = (torch.ones(1, 2400), None)
+
+    tts_instance.conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={}
+    )
+    tts_instance.enable_audio_cache()
+
+    tts_instance.generate_long("One. Two.", max_chars=1, seed=1)
+    assert mock_models["s3gen_instance"].inference.call_count == 2
+    generators = mock_models["t3_instance"].inference_batch.call_args.kwargs["generator"]
+    assert len(generators) == 2 and generators[0] is not generators[1]
+
+    tts_instance.generate_long("Two. Three.", max_chars=1, seed=1)
+    assert mock_models["s3gen_instance"].inference.call_count == 3
+    assert len(mock_models["t3_instance"].inference_batch.call_args.kwargs["text_tokens"]) == 1
+
+
+def test_enrolled_voice_is_computed_once_and_shared(tts_instance, mock_models, tmp_path):
+    from src.murr.vc import MurrVC
+    from src.murr.voice_registry import UnknownVoiceError, VoiceRegistry
+
+    reference = tmp_path / "reference.wav"
+    reference.write_bytes(b"not really a wav")
+    conds = Conditionals(
+        t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+        gen={"embedding": torch.rand(1, 192)},
+    )
+    registry = tts_instance.use_voice_registry(VoiceRegistry(tmp_path / "voices", max_loaded=1))
+
+    with patch.object(tts_instance, "compute_conditionals", return_value=conds) as compute:
+        voice_id = tts_instance.enroll_voice(reference)
+        assert tts_instance.enroll_voice(reference) == voice_id
+    assert compute.call_count == 1
+    assert registry.list_voices() == [voice_id]
+
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference.return_value = torch.tensor([[4, 5, 6562]])
+    mock_models["s3gen_instance"].inference.return_value = (torch.ones(1, 3), None)
+    tts_instance.generate("test text", voice_id=voice_id)
+    assert mock_models["t3_instance"].inference.call_args.kwargs["t3_cond"] is conds.t3
+    assert tts_instance.conds is None
+
+    # evicted from memory by another voice, then reloaded from disk
+    registry.add("other", conds)
+    reloaded = registry.get(voice_id)
+    assert reloaded is not conds and torch.equal(reloaded.gen["embedding"], conds.gen["embedding"])
+
+    vc = MurrVC(mock_models["s3gen_instance"], "cpu")
+    vc.use_voice_registry(registry)
+    with patch("src.murr.vc.librosa.load", return_value=(np.zeros(1600, dtype=np.float32), 16000)):
+        mock_models["s3gen_instance"].tokenizer.return_value = (torch.tensor([[1, 2]]), None)
+        vc.generate("source.wav", voice_id=voice_id)
+    assert torch.equal(mock_models["s3gen_instance"].inference.call_args.kwargs["ref_dict"]["embedding"], conds.gen["embedding"])
+
+    with pytest.raises(UnknownVoiceError):
+        tts_instance.generate("test text", voice_id="unknown")
+
+
+def test_vc_generate_stream_converts_window_by_window(mock_models, tmp_path):
+    import soundfile as sf
+    from src.murr.vc import MurrVC
+
+    n_source = 16000 * 9 + 1000  # about 225 tokens
+    source = torch.arange(n_source, dtype=torch.float64) / 640  # each sample knows its token
+    source_path = tmp_path / "source.wav"
+    sf.write(source_path, source.numpy(), 16000, subtype="DOUBLE")
+    reads = []
+    sf_read = sf.SoundFile.read
+
+    def read(self, frames=-1, *args, **kwargs):
+        decoded = sf_read(self, frames, *args, **kwargs)
+        reads.append(len(decoded))
+        return decoded
+
+    def tokenizer(wav):
+        return wav[:, ::640].floor().long(), None  # token i of the window is its absolute token index
+
+    def inference(speech_tokens, ref_dict=None, finalize=True):
+        # 960 samples of the token's index per token, without the lookahead unless finalizing
+        n_tokens = speech_tokens.size(1) - (0 if finalize else 3)
+        return speech_tokens[:, :n_tokens].float().repeat_interleave(960, dim=1), None
+
+    s3gen = mock_models["s3gen_instance"]
+    s3gen.tokenizer.side_effect = tokenizer
+    s3gen.inference.side_effect = inference
+    s3gen.flow.pre_lookahead_len = 3
+    s3gen.trim_fade = torch.zeros(960)
+    vc = MurrVC(s3gen, "cpu", ref_dict={"embedding": torch.zeros(1, 192)})
+
+    with patch("soundfile.SoundFile.read", read):
+        chunks = list(vc.generate_stream(str(source_path), window_seconds=2.0, context_seconds=0.5))
+
+    # the file is read front to back, each sample once, and never more than a window and its context at a time
+    assert len(chunks) == 5 and sum(reads) == n_source and max(reads) <= 16000 * 3
+    wav = torch.cat(chunks, dim=1)
+    expected = torch.arange(n_source // 640 + 1).float().repeat_interleave(960)[None]
+    # the windows join on the token grid; the crossfades are between identical audio, so they are seamless
+    assert wav.shape == expected.shape
+    assert torch.allclose(wav, expected, atol=1e-4)
+
+
+def test_voice_registry_indexes_speaker_embeddings(tmp_path):
+    from src.murr.voice_registry import UnknownVoiceError, VoiceRegistry
+
+    base = torch.nn.functional.normalize(torch.randn(256), dim=0)
+    embeds = {"a": base, "near_a": base + 0.01 * torch.randn(256), "far": -base, "b": torch.randn(256)}
+    registry = VoiceRegistry(tmp_path)
+    for voice_id, embed in embeds.items():
+        registry.add(voice_id, Conditionals(t3=T3Cond(speaker_emb=embed[None]), gen={}))
+    registry.save_index()
+
+    similar = registry.similar_voices("a", k=2)
+    assert [voice_id for voice_id, _ in similar][0] == "near_a"
+    assert len(similar) == 2 and similar[0][1] > 0.9
+    assert registry.index.search(base, k=4)[-1][0] == "far"
+
+    # a new registry loads the saved index and catches up with changes made after it was saved
+    registry.remove("near_a")
+    registry.add("c", Conditionals(t3=T3Cond(speaker_emb=base[None]), gen={}))
+    reopened = VoiceRegistry(tmp_path)
+    assert sorted(reopened.index.voice_ids()) == ["a", "b", "c", "far"]
+    assert reopened.similar_voices("a", k=1)[0][0] == "c"
+    with pytest.raises(UnknownVoiceError):
+        reopened.similar_voices("near_a")
+
+
+def test_compute_conditionals_decodes_once_and_reuses_s3_tokens(tts_instance, mock_models):
+    sr = 44100
+    mock_models["s3gen_instance"].embed_refs.return_value = [{"prompt_token": torch.arange(250)[None]}]
+    mock_models["ve_instance"].embeds_from_wavs.return_value = np.random.rand(1, 256).astype(np.float32)
+
+    with patch('src.murr.reference_audio.librosa.load', return_value=(np.random.rand(12 * sr).astype(np.float32), sr)) as load:
+        conds = tts_instance.compute_conditionals("dummy.wav")
+
+    load.assert_called_once_with("dummy.wav", sr=None)
+    (wavs_24k, wavs_16k), _ = mock_models["s3gen_instance"].embed_refs.call_args
+    assert wavs_24k[0].shape == (1, 10 * 24000)
+    assert wavs_16k[0].shape == (1, 10 * 16000)
+    mock_models["s3gen_instance"].tokenizer.forward.assert_not_called()
+    assert torch.equal(conds.t3.cond_prompt_speech_tokens, torch.arange(150)[None])
+    assert mock_models["ve_instance"].embeds_from_wavs.call_args.args[0][0].shape == (12 * 16000,)
+
+
+def test_worker_pool_keeps_voices_request_scoped(tts_instance, mock_models, tmp_path):
+    import threading, time
+    from src.murr.worker_pool import WorkerPool
+    from src.murr.voice_registry import VoiceRegistry
+
+    registry = tts_instance.use_voice_registry(VoiceRegistry(tmp_path))
+    voices = {}
+    for name in ("a", "b"):
+        registry.add(name, Conditionals(
+            t3=T3Cond(speaker_emb=torch.rand(1, 256), emotion_adv=0.5 * torch.ones(1, 1, 1)),
+            gen={"embedding": torch.rand(1, 192)},
+        ))
+        voices[name] = registry.get(name)
+
+    mock_models["tokenizer_instance"].text_to_tokens.return_value = torch.tensor([[1, 2, 3]])
+    mock_models["t3_instance"].inference.side_effect = lambda t3_cond, **kwargs: t3_cond.speaker_emb[:, :3]
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def vocode(speech_tokens, ref_dict, **kwargs):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return speech_tokens + ref_dict["embedding"][:, :1], None
+    mock_models["s3gen_instance"].inference.side_effect = vocode
+    with patch('src.murr.tts.drop_invalid_tokens', lambda x: x):
+        pool = WorkerPool(tts_instance, n_workers=2)
+        results = {}
+
+        def run(i):
+            name = "ab"[i % 2]
+            results[i] = name, pool.run("generate", "test text", voice_id=name, exaggeration=0.3 + 0.1 * i)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert peak[0] == 2 and pool.n_idle == 2
+    for name, wav in results.values():
+        voice = voices[name]
+        assert torch.allclose(wav, voice.t3.speaker_emb[:, :3] + voice.gen["embedding"][:, :1])
+        assert float(voice.t3.emotion_adv) == 0.5  # the registry's voice is left as enrolled
+    assert tts_instance.conds is None
+
+
+def test_enroll_voices_batches_every_stage_and_skips_known_clips(tts_instance, mock_models, tmp_path):
+    from src.murr.voice_registry import VoiceRegistry
+
+    registry = tts_instance.use_voice_registry(VoiceRegistry(tmp_path))
+    mock_models["s3gen_instance"].embed_refs.side_effect = lambda wavs_24k, wavs_16k, **kwargs: [
+        {"prompt_token": torch.arange(250)[None], "embedding": wav[:, :192]} for wav in wavs_16k
+    ]
+    mock_models["ve_instance"].embeds_from_wavs.side_effect = lambda wavs, **kwargs: np.stack([w[:256] for w in wavs])
+
+    g = torch.Generator().manual_seed(0)
+    clips = [(torch.rand(16000 * (2 + i % 3), generator=g), 16000) for i in range(5)]
+    voice_ids = tts_instance.enroll_voices(clips + [clips[0]], batch_size=2)
+
+    assert len(set(voice_ids)) == 5 and voice_ids[5] == voice_ids[0]
+    assert sorted(registry.list_voices()) == sorted(set(voice_ids))
+    assert [len(c.args[0]) for c in mock_models["s3gen_instance"].embed_refs.call_args_list] == [2, 2, 1]
+    assert mock_models["ve_instance"].embeds_from_wavs.call_count == 3
+    for (wav, _), voice_id in zip(clips, voice_ids):
+        conds = registry.get(voice_id)
+        assert torch.equal(conds.t3.speaker_emb, wav[None, :256])
+        assert torch.equal(conds.gen["embedding"], wav[None, :192])
+
+    # already enrolled: nothing to compute
+    assert tts_instance.enroll_voices(clips[:2]) == voice_ids[:2]
+    assert mock_models["s3gen_instance"].embed_refs.call_count == 3
@@ -0,0 +1,70 @@
+# pyright: reportMissingImports=false
+import librosa
+import numpy as np
+import pytest
+import torch
+
+from src.murr.models.voice_encoder import VoiceEncoder
+from src.murr.models.voice_encoder.melspec import melspectrogram, melspectrogram_batch, trim_silence_batch
+
+
+@pytest.fixture(scope="module")
+def ve():
+    torch.manual_seed(0)
+    return VoiceEncoder().eval()
+
+
+def make_wavs(lengths=(16000 * 3 + 77, 16000 * 5, 16000 * 2 + 5)):
+    "Tones fading in and out over low noise, with a quiet lead-in for `trim` to cut."
+    rng = np.random.default_rng(0)
+    wavs = []
+    for n in lengths:
+        t = np.arange(n) / 16000
+        wav = 0.3 * np.sin(2 * np.pi * 200 * t) * np.clip(np.sin(2 * np.pi * 0.5 * t), 0, 1)
+        wav = (wav + 0.001 * rng.standard_normal(n)).astype(np.float32)
+        wav[:4000] *= 0.001
+        wavs.append(wav)
+    return wavs
+
+
+def test_batch_front_end_matches_librosa(ve):
+    wavs = make_wavs()
+    lens = [len(wav) for wav in wavs]
+    batch = torch.nn.utils.rnn.pad_sequence([torch.from_numpy(wav) for wav in wavs], batch_first=True)
+
+    ranges = trim_silence_batch(batch, lens, top_db=20)
+    assert ranges == [tuple(int(i) for i in librosa.effects.trim(wav, top_db=20)[1]) for wav in wavs]
+
+    mels, mel_lens = melspectrogram_batch(batch, lens, ve.hp)
+    for wav, mel, mel_len in zip(wavs, mels, mel_lens):
+        expected = melspectrogram(wav, ve.hp).T
+        assert mel_len == len(expected)
+        assert np.allclose(mel[:mel_len].numpy(), expected, atol=1e-5)
+        assert not mel[mel_len:].any()
+
+
+def test_embeds_from_wavs_matches_per_clip_mels(ve):
+    wavs = make_wavs()
+    expected = ve.embeds_from_mels(
+        [melspectrogram(librosa.effects.trim(wav, top_db=20)[0], ve.hp).T for wav in wavs], rate=1.3,
+    )
+    assert np.allclose(ve.embeds_from_wavs(wavs, sample_rate=16000), expected, atol=1e-6)
+
+
+def test_stream_session_matches_offline_embedding_in_bounded_memory(ve):
+    rng = np.random.default_rng(0)
+    wav = (0.1 * rng.standard_normal(16000 * 7 + 123)).astype(np.float32)
+    expected = ve.embeds_from_wav_batch([torch.from_numpy(wav)], 16000, trim_top_db=None)[0].numpy()
+
+    stream = ve.stream_session(batch_size=3)
+    assert stream.embedding() is None
+    start = 0
+    while start < len(wav):
+        end = start + int(rng.integers(1, 5000))
+        stream.push(wav[start:end])
+        start = end
+        # less than a window of samples and a partial of mel frames are held
+        assert stream.samples.numel() < ve.hp.n_fft and stream.mels.size(0) < ve.hp.ve_partial_frames
+    stream.push(wav[:0], finalize=True)
+
+    assert np.allclose(stream.embedding(), expected, atol=1e-6)